@@ -0,0 +1,99 @@
+# backend/app/cli.py
+
+import argparse
+import asyncio
+import csv
+import sys
+from typing import Iterator, Optional, Tuple
+
+from . import crud, fhir, ingest, models, onboarding, rollups
+from .database import AsyncSessionLocal, engine
+
+# Служебные команды: python -m app.cli <команда> ...  (запускать из каталога backend)
+
+# Допустимые заголовки колонок файла справочника
+_CODE_COLUMNS = ("code", "icd10_code", "код")
+_NAME_COLUMNS = ("name", "name_ru", "наименование", "название")
+_NAME_KK_COLUMNS = ("name_kk", "атауы")
+
+def _pick(row: dict, columns) -> Optional[str]:
+    for column in columns:
+        value = (row.get(column) or "").strip()
+        if value: return value
+    return None
+
+def read_icd10_catalog(path: str) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """CSV/TSV с заголовком: код, название и (необязательно) название на казахском. Разделитель определяется сам."""
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        dialect = csv.Sniffer().sniff(file.read(64 * 1024), delimiters=",;\t")
+        file.seek(0)
+        for row in csv.DictReader(file, dialect=dialect):
+            row = {(key or "").strip().lower(): value for key, value in row.items()}
+            code, name = _pick(row, _CODE_COLUMNS), _pick(row, _NAME_COLUMNS)
+            if code and name: yield code, name, _pick(row, _NAME_KK_COLUMNS)
+
+async def load_icd10(path: str) -> None:
+    rows = list(read_icd10_catalog(path))
+    async with AsyncSessionLocal() as db:
+        inserted, updated = await crud.upsert_icd10_catalog(db, rows)
+    print(f"Прочитано {len(rows)}, добавлено {inserted}, обновлено {updated}")
+
+async def import_users(path: str) -> None:
+    async with AsyncSessionLocal() as db:
+        result = await onboarding.import_patients(db, ingest.iter_file_rows(path))
+    print(f"Создано {result.created}, уже были {result.skipped}, с ошибками {result.failed}")
+    for error in result.errors: print(f"  строка {error.row}: {error.error}")
+
+async def backfill_labs() -> None:
+    async with AsyncSessionLocal() as db:
+        total = await crud.backfill_lab_results(db)
+    print(f"Числовых результатов анализов: {total}")
+
+async def backfill_vitals_rollups(email: Optional[str]) -> None:
+    async with AsyncSessionLocal() as db:
+        total = await rollups.backfill(db, [await _user_id(db, email)] if email else None)
+    print(f"Корзин агрегатов замеров: {total}")
+
+async def _user_id(db, email: str) -> int:
+    user = await crud.get_user_by_email(db, email)
+    if user is None: sys.exit(f"Пользователь {email} не найден")
+    return user.id
+
+async def export_fhir(email: str, path: str) -> None:
+    async with AsyncSessionLocal() as db:
+        user_id = await _user_id(db, email)
+    with open(path, "wb") as file:
+        async for chunk in fhir.iter_export(user_id): file.write(chunk)
+
+async def import_fhir(email: str, path: str, source: str) -> None:
+    async with AsyncSessionLocal() as db:
+        result = await fhir.import_resources(db, await _user_id(db, email), ingest.iter_rows(ingest.iter_file_chunks(path), fhir.NDJSON_MEDIA_TYPE), source)
+    print(f"Создано {result.created}, обновлено {result.updated}, с ошибками {result.failed}")
+    for error in result.errors: print(f"  строка {error.row}: {error.error}")
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="Служебные команды MedData.KZ")
+    commands = parser.add_subparsers(dest="command", required=True)
+    icd = commands.add_parser("load-icd10", help="Загрузить/обновить справочник МКБ-10 из CSV")
+    icd.add_argument("path", help="CSV/TSV с колонками code, name[, name_kk]")
+    users = commands.add_parser("import-users", help="Массово зарегистрировать пациентов из CSV/NDJSON/JSON")
+    users.add_argument("path", help="Колонки: email, password, first_name, last_name, birth_date, поля профиля, allergies и chronic_diseases (через ;)")
+    commands.add_parser("backfill-labs", help="Разобрать результаты анализов во всех существующих записях")
+    vitals_rollups = commands.add_parser("backfill-vitals-rollups", help="Пересобрать часовые и суточные агрегаты замеров по сырым данным")
+    vitals_rollups.add_argument("--email", help="Только этого пользователя (по умолчанию — всех)")
+    export = commands.add_parser("export-fhir", help="Выгрузить все данные пациента в FHIR NDJSON")
+    export.add_argument("email"); export.add_argument("path")
+    fhir_import = commands.add_parser("import-fhir", help="Загрузить пациенту FHIR NDJSON (например, выгрузку другой клиники)")
+    fhir_import.add_argument("email"); fhir_import.add_argument("path")
+    fhir_import.add_argument("--source", required=True, help="Метка клиники-источника; повторный импорт из нее обновляет записи")
+    args = parser.parse_args(argv)
+    models.Base.metadata.create_all(bind=engine)
+    if args.command == "load-icd10": asyncio.run(load_icd10(args.path))
+    elif args.command == "import-users": asyncio.run(import_users(args.path))
+    elif args.command == "backfill-labs": asyncio.run(backfill_labs())
+    elif args.command == "backfill-vitals-rollups": asyncio.run(backfill_vitals_rollups(args.email))
+    elif args.command == "export-fhir": asyncio.run(export_fhir(args.email, args.path))
+    elif args.command == "import-fhir": asyncio.run(import_fhir(args.email, args.path, args.source))
+
+if __name__ == "__main__":
+    main()
@@ -1,72 +1,245 @@
 # backend/app/crud.py
 
-from sqlalchemy.orm import Session, joinedload
-from typing import List, Optional
-from . import models, schemas, security
+import base64
+from datetime import datetime, time
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from . import icd_index, jobs, labs, models, refdata, rollups, scheduler, schemas, search, security, sharing, storage, sync
+
+# --- Курсорная (keyset) пагинация ---
+# Курсор кодирует пару (ключ сортировки, id) последней строки страницы.
+# Фильтр по паре идет по составному индексу (owner_id, ключ), поэтому
+# любая страница читается за одно и то же время вне зависимости от длины истории.
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(sort_value, row_id: int) -> str:
+    raw = f"{sort_value.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str, parse=datetime.fromisoformat):
+    """Возвращает (ключ сортировки, id). Бросает ValueError на битом курсоре."""
+    try:
+        sort_raw, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return parse(sort_raw), int(row_id)
+    except (UnicodeError, TypeError, ValueError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+def next_cursor(items: list, sort_attr: str, limit: Optional[int]) -> Optional[str]:
+    """Курсор для следующей страницы или None, если страница последняя."""
+    if not limit or len(items) < limit: return None
+    last = items[-1]
+    return encode_cursor(getattr(last, sort_attr), last.id)
+
+async def _keyset(db: AsyncSession, stmt, sort_col, id_col, limit: Optional[int] = None, before: Optional[str] = None,
+            after: Optional[str] = None, descending: bool = True, parse=datetime.fromisoformat, as_rows: bool = False):
+    """
+    Применяет keyset-фильтр к запросу. `before`/`after` понимаются буквально по ключу
+    сортировки: before — строки со значением меньше курсора, after — больше.
+    Результат всегда возвращается в основном порядке списка.
+    as_rows — запрос выбирает колонки, а не сущность: вернуть кортежи Row (см. fastjson).
+    """
+    if before:
+        value, row_id = decode_cursor(before, parse)
+        stmt = stmt.where(or_(sort_col < value, and_(sort_col == value, id_col < row_id)))
+    if after:
+        value, row_id = decode_cursor(after, parse)
+        stmt = stmt.where(or_(sort_col > value, and_(sort_col == value, id_col > row_id)))
+    # Если курсор "против" основного порядка, берем ближайшие к нему строки и разворачиваем
+    reverse = bool(after) if descending else bool(before) and not after
+    ascending = descending == reverse
+    stmt = stmt.order_by(*((sort_col.asc(), id_col.asc()) if ascending else (sort_col.desc(), id_col.desc())))
+    if limit: stmt = stmt.limit(limit)
+    result = await db.execute(stmt)
+    rows = list(result.all() if as_rows else result.scalars().all())
+    if reverse: rows.reverse()
+    return rows
+
+async def _iter_keyset(fetch_page, sort_attr: str, batch_size: int) -> AsyncIterator:
+    """Потоково отдает всю историю страницами фиксированного размера, не держа ее в памяти."""
+    cursor = None
+    while True:
+        page = await fetch_page(limit=batch_size, before=cursor)
+        for item in page: yield item
+        cursor = next_cursor(page, sort_attr, batch_size)
+        if cursor is None: break
 
 # --- Функции для Пользователя ---
-def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+# Размер IN-списков при поиске по справочникам и пачки вставки при массовом импорте
+LOOKUP_CHUNK_SIZE = 1000
+BULK_USER_CHUNK_SIZE = 500
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    # Аллергии и заболевания грузим сразу: в async-сессии ленивой подгрузки нет
+    stmt = select(models.User).options(selectinload(models.User.allergies), selectinload(models.User.chronic_diseases)).where(models.User.email == email)
+    return (await db.scalars(stmt)).first()
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = security.get_password_hash(user.password)
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    """Регистрация одной транзакцией: пользователь, его аллергии и заболевания (включая новые) и пустой профиль."""
+    hashed_password = await security.get_password_hash(user.password)
     db_user = models.User(
         email=user.email, hashed_password=hashed_password,
-        first_name=user.first_name, last_name=user.last_name, birth_date=user.birth_date
+        first_name=user.first_name, last_name=user.last_name, birth_date=user.birth_date,
+        allergies=[], chronic_diseases=[], profile=models.Profile(**schemas.ProfileCreate().dict())
     )
     if user.allergy_ids:
-        db_user.allergies.extend(db.query(models.Allergy).filter(models.Allergy.id.in_(user.allergy_ids)).all())
+        db_user.allergies.extend((await db.scalars(select(models.Allergy).where(models.Allergy.id.in_(user.allergy_ids)))).all())
+    new_allergies = new_diseases = False
     if user.custom_allergy:
-        existing_allergy = db.query(models.Allergy).filter(models.Allergy.name == user.custom_allergy).first()
-        if not existing_allergy:
-            new_allergy = models.Allergy(name=user.custom_allergy)
-            db.add(new_allergy); db.commit(); db.refresh(new_allergy)
-            db_user.allergies.append(new_allergy)
-        elif existing_allergy not in db_user.allergies:
-            db_user.allergies.append(existing_allergy)
+        found, new_allergies = await _get_or_create_by_name(db, models.Allergy, [user.custom_allergy])
+        if found[user.custom_allergy] not in db_user.allergies: db_user.allergies.append(found[user.custom_allergy])
     if user.chronic_disease_ids:
-        db_user.chronic_diseases.extend(db.query(models.ChronicDisease).filter(models.ChronicDisease.id.in_(user.chronic_disease_ids)).all())
+        db_user.chronic_diseases.extend((await db.scalars(select(models.ChronicDisease).where(models.ChronicDisease.id.in_(user.chronic_disease_ids)))).all())
     if user.custom_disease:
-        existing_disease = db.query(models.ChronicDisease).filter(models.ChronicDisease.name == user.custom_disease).first()
-        if not existing_disease:
-            new_disease = models.ChronicDisease(name=user.custom_disease)
-            db.add(new_disease); db.commit(); db.refresh(new_disease)
-            db_user.chronic_diseases.append(new_disease)
-        elif existing_disease not in db_user.chronic_diseases:
-            db_user.chronic_diseases.append(existing_disease)
+        found, new_diseases = await _get_or_create_by_name(db, models.ChronicDisease, [user.custom_disease])
+        if found[user.custom_disease] not in db_user.chronic_diseases: db_user.chronic_diseases.append(found[user.custom_disease])
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    create_or_update_profile(db=db, profile_data=schemas.ProfileCreate(), user_id=db_user.id)
+    await _commit_with_reference_data(db, new_allergies, new_diseases)
     return db_user
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = get_user_by_email(db, email=email)
-    if not user or not security.verify_password(password, user.hashed_password): return False
+async def get_existing_emails(db: AsyncSession, emails: List[str]) -> set:
+    existing = set()
+    for i in range(0, len(emails), LOOKUP_CHUNK_SIZE):
+        existing.update((await db.scalars(select(models.User.email).where(models.User.email.in_(emails[i:i + LOOKUP_CHUNK_SIZE])))).all())
+    return existing
+
+async def create_users_bulk(db: AsyncSession, patients: List[schemas.PatientImport], hashed_passwords: List[str], chunk_size: int = BULK_USER_CHUNK_SIZE) -> int:
+    """
+    Массовое создание пациентов одной транзакцией: все названия аллергий и заболеваний
+    разрешаются несколькими запросами на весь список, пользователи с профилями
+    вставляются пачками по chunk_size. Пароли должны быть уже захэшированы.
+    """
+    allergies, new_allergies = await _get_or_create_by_name(db, models.Allergy, [name for patient in patients for name in patient.allergies])
+    diseases, new_diseases = await _resolve_diseases(db, [value for patient in patients for value in patient.chronic_diseases])
+    profile_fields = set(schemas.ProfileBase.__fields__)
+    for i in range(0, len(patients), chunk_size):
+        users = [
+            models.User(
+                email=patient.email, hashed_password=hashed_password,
+                first_name=patient.first_name, last_name=patient.last_name, birth_date=patient.birth_date,
+                allergies=[allergies[name] for name in dict.fromkeys(patient.allergies)],
+                chronic_diseases=list({id(diseases[value]): diseases[value] for value in patient.chronic_diseases}.values()),
+                profile=models.Profile(**patient.dict(include=profile_fields)),
+            )
+            for patient, hashed_password in zip(patients[i:i + chunk_size], hashed_passwords[i:i + chunk_size])
+        ]
+        db.add_all(users); await db.flush()
+        for db_user in users: db.expunge(db_user); db.expunge(db_user.profile) # Карта сессии не растет с размером файла
+    await _commit_with_reference_data(db, new_allergies, new_diseases)
+    return len(patients)
+
+async def _commit_with_reference_data(db: AsyncSession, new_allergies: bool, new_diseases: bool) -> None:
+    if new_allergies: await refdata.bump_version(db, refdata.ALLERGIES)
+    if new_diseases: await refdata.bump_version(db, refdata.CHRONIC_DISEASES)
+    await db.commit()
+    if new_allergies or new_diseases: refdata.invalidate()
+    if new_diseases: icd_index.invalidate()
+
+async def _get_or_create_by_name(db: AsyncSession, model, names: Iterable[str]) -> Tuple[Dict[str, Any], bool]:
+    """Находит строки справочника по названиям пачками и заводит недостающие. Возвращает (название -> строка, были ли новые)."""
+    names = list(dict.fromkeys(name for name in names if name))
+    found = {}
+    for i in range(0, len(names), LOOKUP_CHUNK_SIZE):
+        found.update((row.name, row) for row in (await db.scalars(select(model).where(model.name.in_(names[i:i + LOOKUP_CHUNK_SIZE])))).all())
+    created = False
+    for name in names:
+        if name in found: continue
+        try:
+            async with db.begin_nested():
+                found[name] = model(name=name); db.add(found[name])
+            created = True
+        except IntegrityError:
+            found[name] = (await db.scalars(select(model).where(model.name == name))).one() # Добавили параллельно
+    return found, created
+
+async def _resolve_diseases(db: AsyncSession, values: Iterable[str]) -> Tuple[Dict[str, models.ChronicDisease], bool]:
+    """Значения, совпавшие с кодом МКБ-10, берутся по коду; остальные — по названию (новые заводятся)."""
+    values = list(dict.fromkeys(value for value in values if value))
+    found = {}
+    for i in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        found.update((row.icd10_code, row) for row in (await db.scalars(select(models.ChronicDisease).where(models.ChronicDisease.icd10_code.in_(values[i:i + LOOKUP_CHUNK_SIZE])))).all())
+    by_name, created = await _get_or_create_by_name(db, models.ChronicDisease, [value for value in values if value not in found])
+    return {**by_name, **found}, created
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user_by_email(db, email=email)
+    if not user: return False
+    is_valid, new_hash = await security.verify_and_update_password(password, user.hashed_password)
+    if not is_valid: return False
+    if new_hash:
+        # Стоимость bcrypt поменялась — пересчитываем хэш, пока знаем пароль
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
-def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+async def update_user(db: AsyncSession, user_id: int, user_update: schemas.UserUpdate):
+    db_user = await db.get(models.User, user_id)
     if db_user:
         update_data = user_update.dict(exclude_unset=True)
         for key, value in update_data.items():
             setattr(db_user, key, value)
-        db.commit(); db.refresh(db_user)
+        # Сменился пояс — напоминания срабатывают по новому местному времени
+        reminders = []
+        if "timezone" in update_data:
+            reminders = (await db.scalars(select(models.Reminder).where(models.Reminder.owner_id == user_id, models.Reminder.is_active.is_(True)))).all()
+            for reminder in reminders: scheduler.plan_reminder(reminder, db_user.timezone)
+        await db.commit()
+        security.invalidate_cached_user(db_user.email)
+        for reminder in reminders: scheduler.scheduler.plan(reminder.id, reminder.next_fire_at)
+    return db_user
+
+async def set_user_active(db: AsyncSession, user_id: int, is_active: bool):
+    """Активирует/деактивирует пользователя; деактивированный сразу теряет доступ."""
+    db_user = await db.get(models.User, user_id, options=[selectinload(models.User.allergies), selectinload(models.User.chronic_diseases)])
+    if db_user:
+        db_user.is_active = is_active
+        await db.commit()
+        security.invalidate_cached_user(db_user.email)
     return db_user
 
 # --- Функции для Справочников ---
-def get_allergies(db: Session): return db.query(models.Allergy).all()
-def get_chronic_diseases(db: Session): return db.query(models.ChronicDisease).all()
-def find_diseases_by_name(db: Session, query: str) -> List[models.ChronicDisease]:
-    if not query: return []
-    search_query = f"%{query}%"
-    return db.query(models.ChronicDisease).filter(models.ChronicDisease.name.ilike(search_query)).limit(10).all()
+async def get_allergies(db: AsyncSession): return (await db.scalars(select(models.Allergy))).all()
+async def get_chronic_diseases(db: AsyncSession): return (await db.scalars(select(models.ChronicDisease))).all()
+async def find_diseases_by_name(db: AsyncSession, query: str, limit: int = 10) -> List[icd_index.IcdEntry]:
+    """Автодополнение диагнозов по индексу в памяти; БД трогается только для проверки новых строк справочника."""
+    if not query or not query.strip(): return []
+    return (await icd_index.ensure_fresh(db)).search(query, limit)
+async def upsert_icd10_catalog(db: AsyncSession, rows: List[Tuple[str, str, Optional[str]]]) -> Tuple[int, int]:
+    """
+    Загружает справочник МКБ-10: (код, название, название на казахском). Новые коды добавляются,
+    у существующих обновляются названия; id строк сохраняются, поэтому выбор пользователей не теряется.
+    Название в таблице уникально — повторяющиеся в МКБ названия уточняются кодом: "... (M89.8)".
+    Возвращает (добавлено, обновлено).
+    """
+    existing = (await db.scalars(select(models.ChronicDisease))).all()
+    by_code = {disease.icd10_code: disease for disease in existing if disease.icd10_code}
+    names = {disease.name: disease for disease in existing}
+    inserted = updated = 0
+    for code, name, name_kk in rows:
+        disease = by_code.get(code)
+        if disease is None and name in names and not names[name].icd10_code:
+            disease = names[name] # Болезнь, заведенная пользователем без кода, получает код
+        if name in names and names[name] is not disease: name = f"{name} ({code})"
+        if disease is None:
+            disease = models.ChronicDisease(name=name, icd10_code=code, name_kk=name_kk)
+            db.add(disease); inserted += 1
+        elif (disease.name, disease.icd10_code, disease.name_kk) != (name, code, name_kk or disease.name_kk):
+            names.pop(disease.name, None)
+            disease.name, disease.icd10_code, disease.name_kk = name, code, name_kk or disease.name_kk
+            updated += 1
+        by_code[code] = names[name] = disease
+    if inserted or updated: await refdata.bump_version(db, refdata.CHRONIC_DISEASES)
+    await db.commit()
+    refdata.invalidate(); icd_index.invalidate()
+    return inserted, updated
 
 # --- Функции для Профиля ---
-def get_profile_by_user_id(db: Session, user_id: int):
-    return db.query(models.Profile).filter(models.Profile.user_id == user_id).first()
-def create_or_update_profile(db: Session, profile_data: schemas.ProfileUpdate, user_id: int):
-    db_profile = get_profile_by_user_id(db, user_id=user_id)
+async def get_profile_by_user_id(db: AsyncSession, user_id: int):
+    return (await db.scalars(select(models.Profile).where(models.Profile.user_id == user_id))).first()
+async def create_or_update_profile(db: AsyncSession, profile_data: schemas.ProfileUpdate, user_id: int):
+    db_profile = await get_profile_by_user_id(db, user_id=user_id)
     if not db_profile:
         db_profile = models.Profile(**profile_data.dict(), user_id=user_id)
         db.add(db_profile)
@@ -74,90 +247,369 @@ def create_or_update_profile(db: Session, profile_data: schemas.ProfileUpdate, u
         update_data = profile_data.dict(exclude_unset=True)
         for key, value in update_data.items():
             setattr(db_profile, key, value)
-    db.commit(); db.refresh(db_profile)
+    await db.commit()
+    sharing.invalidate_owner(user_id)
     return db_profile
 
 # --- Функции для Записей в ленте ---
-def get_record_by_id(db: Session, record_id: int, owner_id: int):
-    return db.query(models.Record).filter(models.Record.id == record_id, models.Record.owner_id == owner_id).first()
-def get_records_by_owner(db: Session, owner_id: int):
-    return db.query(models.Record).filter(models.Record.owner_id == owner_id).order_by(models.Record.date.desc()).all()
-def create_record(db: Session, record: schemas.RecordCreate, owner_id: int):
+async def get_record_by_id(db: AsyncSession, record_id: int, owner_id: int):
+    return (await db.scalars(select(models.Record).where(models.Record.id == record_id, models.Record.owner_id == owner_id))).first()
+async def get_records_by_owner(db: AsyncSession, owner_id: int, limit: Optional[int] = None, before: Optional[str] = None, after: Optional[str] = None, columns: Optional[list] = None):
+    """columns — выбрать только эти колонки и вернуть кортежи вместо объектов (быстрый путь списков)."""
+    stmt = select(*columns) if columns else select(models.Record)
+    stmt = stmt.where(models.Record.owner_id == owner_id)
+    return await _keyset(db, stmt, models.Record.date, models.Record.id, limit=limit, before=before, after=after, as_rows=bool(columns))
+async def search_records(db: AsyncSession, owner_id: int, query: str, limit: int = 20, offset: int = 0) -> List[models.Record]:
+    """Полнотекстовый поиск по записям владельца, от самых релевантных (см. search.py)."""
+    stmt = search.build_search(db.get_bind().dialect.name, owner_id, query)
+    if stmt is None: return []
+    return (await db.scalars(stmt.limit(limit).offset(offset))).all()
+def iter_records_by_owner(db: AsyncSession, owner_id: int, batch_size: int = MAX_PAGE_SIZE) -> AsyncIterator[models.Record]:
+    return _iter_keyset(lambda **page: get_records_by_owner(db, owner_id, **page), "date", batch_size)
+async def create_record(db: AsyncSession, record: schemas.RecordCreate, owner_id: int, blob: Optional[storage.StoredBlob] = None):
     db_record = models.Record(**record.dict(), owner_id=owner_id)
-    db.add(db_record); db.commit(); db.refresh(db_record)
+    db.add(db_record)
+    await db.flush() # id нужен для URL вложения и строки lab_results
+    if blob: await _attach_blob(db, db_record, blob)
+    await _sync_lab_result(db, db_record, is_new=True)
+    await db.commit()
+    sharing.invalidate_owner(owner_id)
+    if blob: storage.settle(blob)
     return db_record
-def update_record(db: Session, record_id: int, owner_id: int, record_data: schemas.RecordCreate):
-    db_record = get_record_by_id(db=db, record_id=record_id, owner_id=owner_id)
+async def update_record(db: AsyncSession, record_id: int, owner_id: int, record_data: schemas.RecordCreate, blob: Optional[storage.StoredBlob] = None):
+    db_record = await get_record_by_id(db=db, record_id=record_id, owner_id=owner_id)
+    released_paths = []
     if db_record:
         update_data = record_data.dict()
         for key, value in update_data.items():
             setattr(db_record, key, value)
-        db.commit(); db.refresh(db_record)
+        if blob:
+            previous_id = db_record.attachment_id
+            await _attach_blob(db, db_record, blob)
+            if previous_id: released_paths = await _release_attachment(db, previous_id)
+        await _sync_lab_result(db, db_record)
+        await db.commit()
+        sharing.invalidate_owner(owner_id)
+        if blob: storage.settle(blob)
+        await _delete_unreferenced(db, released_paths)
     return db_record
-def delete_record(db: Session, record_id: int, owner_id: int):
-    db_record = get_record_by_id(db=db, record_id=record_id, owner_id=owner_id)
-    if db_record: db.delete(db_record); db.commit()
+async def delete_record(db: AsyncSession, record_id: int, owner_id: int):
+    db_record = await get_record_by_id(db=db, record_id=record_id, owner_id=owner_id)
+    if db_record:
+        released_paths = await _release_attachment(db, db_record.attachment_id) if db_record.attachment_id else []
+        await db.execute(delete(models.LabResult).where(models.LabResult.record_id == db_record.id))
+        await db.delete(db_record); await db.commit()
+        sharing.invalidate_owner(owner_id)
+        # Файлы удаляем только после коммита: до него на блоб еще ссылается запись
+        await _delete_unreferenced(db, released_paths)
     return db_record
 
+# --- Вложения (контентно-адресуемые, со счетчиком ссылок) ---
+async def _attach_blob(db: AsyncSession, db_record: models.Record, blob: storage.StoredBlob) -> None:
+    attachment = await _acquire_attachment(db, blob)
+    db_record.attachment_id = attachment.id
+    db_record.attachment_url = storage.attachment_url(db_record.id)
+    # Файл уже обрабатывался для другой записи — берем готовые превью и текст
+    db_record.thumbnail_url = storage.thumbnail_url(db_record.id) if attachment.thumbnail_path else None
+    db_record.attachment_text = attachment.extracted_text
+
+async def _acquire_attachment(db: AsyncSession, blob: storage.StoredBlob) -> models.Attachment:
+    """Находит блоб по хэшу и увеличивает счетчик ссылок, либо заводит новый."""
+    while True:
+        attachment = (await db.scalars(select(models.Attachment).where(models.Attachment.sha256 == blob.sha256))).first()
+        if attachment is not None:
+            result = await db.execute(update(models.Attachment).where(models.Attachment.id == attachment.id).values(ref_count=models.Attachment.ref_count + 1))
+            if result.rowcount: return attachment
+            continue # Блоб удалили между SELECT и UPDATE — пробуем еще раз
+        try:
+            async with db.begin_nested():
+                attachment = models.Attachment(sha256=blob.sha256, size=blob.size, content_type=blob.content_type, storage_path=blob.storage_path, ref_count=1)
+                db.add(attachment)
+                jobs.enqueue_attachment(db, attachment)
+            return attachment
+        except IntegrityError:
+            continue # Тот же файл параллельно загрузили в другом запросе
+
+async def _release_attachment(db: AsyncSession, attachment_id: int) -> List[str]:
+    """Уменьшает счетчик ссылок. Возвращает файлы блоба (и превью), если он больше никому не нужен."""
+    await db.execute(update(models.Attachment).where(models.Attachment.id == attachment_id).values(ref_count=models.Attachment.ref_count - 1))
+    attachment = await db.get(models.Attachment, attachment_id, populate_existing=True)
+    if attachment is None or attachment.ref_count > 0: return []
+    await db.delete(attachment)
+    return [path for path in (attachment.storage_path, attachment.thumbnail_path) if path]
+
+async def _delete_unreferenced(db: AsyncSession, paths: List[str]) -> None:
+    """
+    Удаляет файлы освобожденных блобов (после коммита). Пока наша транзакция шла, тот же файл
+    могли загрузить заново и завести для него новую строку attachments — такие файлы оставляем.
+    """
+    if not paths: return
+    Attachment = models.Attachment
+    stmt = select(Attachment.storage_path, Attachment.thumbnail_path).where(or_(Attachment.storage_path.in_(paths), Attachment.thumbnail_path.in_(paths)))
+    referenced = {path for row in (await db.execute(stmt)).all() for path in row if path}
+    for path in paths:
+        if path not in referenced: storage.delete_blob(path)
+
+# --- Числовые результаты анализов (lab_results) ---
+def _lab_result_values(db_record: models.Record) -> Optional[dict]:
+    """Колонки строки lab_results для записи или None, если в записи нет числового результата."""
+    if not db_record.test_name or not db_record.test_name.strip(): return None
+    parsed = labs.parse_lab(db_record.result, db_record.reference_range)
+    if parsed is None: return None
+    return dict(
+        record_id=db_record.id, owner_id=db_record.owner_id, test_key=labs.normalize_test_name(db_record.test_name),
+        test_name=db_record.test_name.strip(), date=db_record.date, value=parsed.value, unit=parsed.unit,
+        qualifier=parsed.qualifier, ref_low=parsed.ref_low, ref_high=parsed.ref_high,
+    )
+
+async def _sync_lab_result(db: AsyncSession, db_record: models.Record, is_new: bool = False) -> None:
+    """Разбор при записи: строка lab_results создается, обновляется или удаляется вместе с записью."""
+    values = _lab_result_values(db_record)
+    existing = None if is_new else (await db.scalars(select(models.LabResult).where(models.LabResult.record_id == db_record.id))).first()
+    if values is None:
+        if existing: await db.delete(existing)
+        return
+    if existing is None:
+        db.add(models.LabResult(**values))
+    else:
+        for key, value in values.items(): setattr(existing, key, value)
+
+async def get_lab_tests(db: AsyncSession, owner_id: int):
+    """Показатели пользователя с числом результатов и датой последнего."""
+    stmt = (select(func.max(models.LabResult.test_name).label("test_name"), func.count().label("count"), func.max(models.LabResult.date).label("last_date"))
+            .where(models.LabResult.owner_id == owner_id).group_by(models.LabResult.test_key).order_by(func.max(models.LabResult.date).desc()))
+    return (await db.execute(stmt)).all()
+
+async def get_lab_series(db: AsyncSession, owner_id: int, test_name: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Ряд одного показателя за [start, end) по возрастанию даты — диапазон индекса (owner_id, test_key, date)."""
+    columns = (models.LabResult.date, models.LabResult.value, models.LabResult.unit, models.LabResult.ref_low, models.LabResult.ref_high, models.LabResult.record_id, models.LabResult.test_name)
+    stmt = select(*columns).where(models.LabResult.owner_id == owner_id, models.LabResult.test_key == labs.normalize_test_name(test_name))
+    # Даты хранятся в наивном UTC: границы с поясом переводим, как в рядах замеров
+    if start: stmt = stmt.where(models.LabResult.date >= rollups.to_utc(start))
+    if end: stmt = stmt.where(models.LabResult.date < rollups.to_utc(end))
+    return (await db.execute(stmt.order_by(models.LabResult.date, models.LabResult.id))).all()
+
+async def backfill_lab_results(db: AsyncSession, batch_size: int = LOOKUP_CHUNK_SIZE) -> int:
+    """Пересобирает lab_results по всем записям пачками по id (каждая пачка — своя транзакция). Возвращает число строк."""
+    last_id, total = 0, 0
+    while True:
+        batch = (await db.scalars(select(models.Record).where(models.Record.id > last_id, models.Record.test_name.is_not(None)).order_by(models.Record.id).limit(batch_size))).all()
+        if not batch: return total
+        last_id = batch[-1].id
+        rows = [values for values in map(_lab_result_values, batch) if values]
+        await db.execute(delete(models.LabResult).where(models.LabResult.record_id.in_([record.id for record in batch])))
+        if rows: await db.execute(insert(models.LabResult), rows)
+        await sync.bump_versions(db, {record.owner_id for record in batch}, [sync.LABS]) # Для ETag /labs/*
+        await db.commit()
+        db.expunge_all()
+        total += len(rows)
+
 # --- Функции для Замеров (Vitals) ---
-def create_vitals_record(db: Session, vitals_data: schemas.VitalsRecordCreate, user_id: int):
+# Размер пачки для executemany при массовой вставке
+BULK_CHUNK_SIZE = 5000
+
+async def create_vitals_record(db: AsyncSession, vitals_data: schemas.VitalsRecordCreate, user_id: int):
     db_vitals = models.VitalsRecord(**vitals_data.dict(), owner_id=user_id)
-    db.add(db_vitals); db.commit(); db.refresh(db_vitals)
+    db.add(db_vitals); await db.commit()
+    sharing.invalidate_owner(user_id)
     return db_vitals
-def get_vitals_by_user(db: Session, user_id: int):
-    return db.query(models.VitalsRecord).filter(models.VitalsRecord.owner_id == user_id).order_by(models.VitalsRecord.timestamp.desc()).all()
+async def insert_vitals_chunk(db: AsyncSession, vitals: List[schemas.VitalsRecordCreate], user_id: int) -> int:
+    """Вставляет пачку замеров одним executemany. Не коммитит — транзакцией управляет вызывающий."""
+    if not vitals: return 0
+    now = datetime.utcnow()
+    version = (await sync.bump_versions(db, [user_id], ["vitals"]))[user_id] # executemany идет в обход ORM — версию ставим сами
+    rows = [{**item.dict(), "timestamp": item.timestamp or now, "owner_id": user_id, "sync_version": version, "updated_at": now} for item in vitals]
+    await db.execute(insert(models.VitalsRecord), rows)
+    await rollups.add_readings(db, ((user_id, row["type"], row["timestamp"], row["value"]) for row in rows)) # Агрегаты — тоже сами
+    return len(vitals)
+async def create_vitals_records(db: AsyncSession, vitals: List[schemas.VitalsRecordCreate], user_id: int, chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    """Массовая вставка замеров пачками в одной транзакции."""
+    inserted = 0
+    for i in range(0, len(vitals), chunk_size):
+        inserted += await insert_vitals_chunk(db, vitals[i:i + chunk_size], user_id)
+    await db.commit()
+    sharing.invalidate_owner(user_id)
+    return inserted
+async def get_vitals_by_user(db: AsyncSession, user_id: int, limit: Optional[int] = None, before: Optional[str] = None, after: Optional[str] = None, columns: Optional[list] = None):
+    stmt = select(*columns) if columns else select(models.VitalsRecord)
+    stmt = stmt.where(models.VitalsRecord.owner_id == user_id)
+    return await _keyset(db, stmt, models.VitalsRecord.timestamp, models.VitalsRecord.id, limit=limit, before=before, after=after, as_rows=bool(columns))
+def iter_vitals_by_user(db: AsyncSession, user_id: int, batch_size: int = MAX_PAGE_SIZE) -> AsyncIterator[models.VitalsRecord]:
+    return _iter_keyset(lambda **page: get_vitals_by_user(db, user_id, **page), "timestamp", batch_size)
+async def get_vitals_series(db: AsyncSession, user_id: int, vitals_type: str, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Только (timestamp, value) одного типа за [start, end) по возрастанию времени — без гидрации ORM-объектов."""
+    stmt = select(models.VitalsRecord.timestamp, models.VitalsRecord.value).where(models.VitalsRecord.owner_id == user_id, models.VitalsRecord.type == vitals_type)
+    # Замеры хранятся в наивном UTC: границы с поясом переводим, как /vitals/stats
+    if start: stmt = stmt.where(models.VitalsRecord.timestamp >= rollups.to_utc(start))
+    if end: stmt = stmt.where(models.VitalsRecord.timestamp < rollups.to_utc(end))
+    return (await db.execute(stmt.order_by(models.VitalsRecord.timestamp))).all()
+
+# --- Импорт FHIR (см. fhir.py) ---
+_PATIENT_USER_FIELDS = ("first_name", "last_name", "birth_date")
+
+async def _by_external_id(db: AsyncSession, model, owner_id: int, external_ids: Iterable[str]) -> Dict[str, Any]:
+    external_ids = list(dict.fromkeys(external_ids))
+    found = {}
+    for i in range(0, len(external_ids), LOOKUP_CHUNK_SIZE):
+        stmt = select(model).where(model.owner_id == owner_id, model.external_id.in_(external_ids[i:i + LOOKUP_CHUNK_SIZE]))
+        found.update((row.external_id, row) for row in (await db.scalars(stmt)).all())
+    return found
+
+async def import_patient_batch(
+    db: AsyncSession, owner_id: int, patient: Optional[dict] = None,
+    records: Iterable[Tuple[str, dict]] = (), vitals: Iterable[Tuple[str, dict]] = (),
+    record_updates: Iterable[Tuple[int, str, dict]] = (), allergies: Iterable[str] = (), diseases: Iterable[str] = (),
+) -> Tuple[int, int, List[Tuple[int, str]]]:
+    """
+    Применяет пачку импорта одной транзакцией. Записи и замеры ищутся по external_id
+    (по LOOKUP_CHUNK_SIZE за запрос): у найденных меняются только переданные поля, остальные создаются.
+    record_updates — (номер строки, external_id записи, поля) для ресурсов, дополняющих уже
+    загруженный визит (диагноз, препарат). Возвращает (создано, обновлено, [(строка, ошибка)]).
+    """
+    created, updated, errors = 0, 0, []
+    imported_records = []
+    for model, items in ((models.Record, list(records)), (models.VitalsRecord, list(vitals))):
+        existing = await _by_external_id(db, model, owner_id, [external_id for external_id, _ in items])
+        for external_id, values in items:
+            row = existing.get(external_id)
+            if row is None:
+                row = existing[external_id] = model(**values, owner_id=owner_id, external_id=external_id)
+                db.add(row); created += 1
+            else:
+                for key, value in values.items(): setattr(row, key, value)
+                updated += 1
+            if model is models.Record: imported_records.append(row)
+    await db.flush()
+    # Разобранные результаты анализов — пересобираем пачкой, как backfill_lab_results
+    if imported_records:
+        rows = [values for values in map(_lab_result_values, dict.fromkeys(imported_records)) if values]
+        await db.execute(delete(models.LabResult).where(models.LabResult.record_id.in_([record.id for record in imported_records])))
+        if rows: await db.execute(insert(models.LabResult), rows)
+    record_updates = list(record_updates)
+    encounters = await _by_external_id(db, models.Record, owner_id, [external_id for _, external_id, _ in record_updates])
+    for row_no, external_id, values in record_updates:
+        encounter = encounters.get(external_id)
+        if encounter is None:
+            errors.append((row_no, f"Encounter {external_id} не найден")); continue
+        for key, value in values.items(): setattr(encounter, key, value)
+        updated += 1
+    new_allergies = new_diseases = False
+    email = None
+    if patient or allergies or diseases:
+        user = (await db.scalars(select(models.User).options(selectinload(models.User.profile), selectinload(models.User.allergies), selectinload(models.User.chronic_diseases)).where(models.User.id == owner_id))).one()
+        if patient:
+            patient = {key: value for key, value in patient.items() if value is not None}
+            for key in _PATIENT_USER_FIELDS:
+                if key in patient: setattr(user, key, patient.pop(key))
+            if patient and user.profile is None: user.profile = models.Profile()
+            for key, value in patient.items(): setattr(user.profile, key, value)
+            email = user.email; updated += 1
+        found, new_allergies = await _get_or_create_by_name(db, models.Allergy, allergies)
+        for allergy in found.values():
+            if allergy in user.allergies: updated += 1
+            else: user.allergies.append(allergy); created += 1
+        found, new_diseases = await _resolve_diseases(db, diseases)
+        for disease in found.values():
+            if disease in user.chronic_diseases: updated += 1
+            else: user.chronic_diseases.append(disease); created += 1
+    await _commit_with_reference_data(db, new_allergies, new_diseases)
+    sharing.invalidate_owner(owner_id)
+    if email: security.invalidate_cached_user(email)
+    db.expunge_all() # Карта сессии не растет с длиной истории
+    return created, updated, errors
 
 # --- Функции для Напоминаний ---
-def create_reminder(db: Session, reminder: schemas.ReminderCreate, owner_id: int):
+async def _owner_timezone(db: AsyncSession, owner_id: int) -> Optional[str]:
+    return await db.scalar(select(models.User.timezone).where(models.User.id == owner_id))
+async def create_reminder(db: AsyncSession, reminder: schemas.ReminderCreate, owner_id: int):
     db_reminder = models.Reminder(**reminder.dict(), owner_id=owner_id)
-    db.add(db_reminder); db.commit(); db.refresh(db_reminder)
+    scheduler.plan_reminder(db_reminder, await _owner_timezone(db, owner_id))
+    db.add(db_reminder); await db.commit()
+    scheduler.scheduler.plan(db_reminder.id, db_reminder.next_fire_at)
     return db_reminder
-def get_reminders_by_owner(db: Session, owner_id: int):
-    return db.query(models.Reminder).filter(models.Reminder.owner_id == owner_id).order_by(models.Reminder.time).all()
-def update_reminder(db: Session, reminder_id: int, reminder_data: schemas.ReminderCreate, owner_id: int):
-    db_reminder = db.query(models.Reminder).filter(models.Reminder.id == reminder_id, models.Reminder.owner_id == owner_id).first()
+async def get_reminders_by_owner(db: AsyncSession, owner_id: int, limit: Optional[int] = None, before: Optional[str] = None, after: Optional[str] = None):
+    stmt = select(models.Reminder).where(models.Reminder.owner_id == owner_id)
+    return await _keyset(db, stmt, models.Reminder.time, models.Reminder.id, limit=limit, before=before, after=after, descending=False, parse=time.fromisoformat)
+async def update_reminder(db: AsyncSession, reminder_id: int, reminder_data: schemas.ReminderCreate, owner_id: int):
+    db_reminder = (await db.scalars(select(models.Reminder).where(models.Reminder.id == reminder_id, models.Reminder.owner_id == owner_id))).first()
     if db_reminder:
         update_data = reminder_data.dict(exclude_unset=True)
         for key, value in update_data.items(): setattr(db_reminder, key, value)
-        db.commit(); db.refresh(db_reminder)
+        scheduler.plan_reminder(db_reminder, await _owner_timezone(db, owner_id))
+        await db.commit()
+        scheduler.scheduler.plan(db_reminder.id, db_reminder.next_fire_at)
     return db_reminder
-def delete_reminder(db: Session, reminder_id: int, owner_id: int):
-    db_reminder = db.query(models.Reminder).filter(models.Reminder.id == reminder_id, models.Reminder.owner_id == owner_id).first()
-    if db_reminder: db.delete(db_reminder); db.commit()
+async def delete_reminder(db: AsyncSession, reminder_id: int, owner_id: int):
+    db_reminder = (await db.scalars(select(models.Reminder).where(models.Reminder.id == reminder_id, models.Reminder.owner_id == owner_id))).first()
+    if db_reminder: await db.delete(db_reminder); await db.commit(); scheduler.scheduler.plan(reminder_id, None)
     return db_reminder
 
 # --- НАЧАЛО НОВЫХ ФУНКЦИЙ ДЛЯ ЖАЛОБ ---
 
-def create_complaint(db: Session, complaint: schemas.ComplaintCreate, owner_id: int):
+async def create_complaint(db: AsyncSession, complaint: schemas.ComplaintCreate, owner_id: int):
     """Создает новую жалобу для пользователя."""
     db_complaint = models.Complaint(**complaint.dict(), owner_id=owner_id)
     db.add(db_complaint)
-    db.commit()
-    db.refresh(db_complaint)
+    await db.commit()
     return db_complaint
 
-def get_complaints_by_owner(db: Session, owner_id: int):
-    """Получает все жалобы конкретного пользователя."""
-    return db.query(models.Complaint).filter(models.Complaint.owner_id == owner_id).order_by(models.Complaint.created_at.desc()).all()
+async def get_complaints_by_owner(db: AsyncSession, owner_id: int, limit: Optional[int] = None, before: Optional[str] = None, after: Optional[str] = None, columns: Optional[list] = None):
+    """Получает жалобы пользователя (все или одну страницу по курсору)."""
+    stmt = select(*columns) if columns else select(models.Complaint)
+    stmt = stmt.where(models.Complaint.owner_id == owner_id)
+    return await _keyset(db, stmt, models.Complaint.created_at, models.Complaint.id, limit=limit, before=before, after=after, as_rows=bool(columns))
+
+def iter_complaints_by_owner(db: AsyncSession, owner_id: int, batch_size: int = MAX_PAGE_SIZE) -> AsyncIterator[models.Complaint]:
+    """Потоково перебирает все жалобы пользователя страницами."""
+    return _iter_keyset(lambda **page: get_complaints_by_owner(db, owner_id, **page), "created_at", batch_size)
 
 # --- Функции для Курсов Лечения ---
-def create_treatment_course(db: Session, course: schemas.TreatmentCourseCreate, owner_id: int):
-    db_course = models.TreatmentCourse(**course.dict(), owner_id=owner_id)
+async def create_treatment_course(db: AsyncSession, course: schemas.TreatmentCourseCreate, owner_id: int):
+    # Пустые коллекции задаем явно: новый курс сериализуется вместе с ними
+    db_course = models.TreatmentCourse(**course.dict(), owner_id=owner_id, records=[], complaints=[])
     db.add(db_course)
-    db.commit()
-    db.refresh(db_course)
+    await db.commit()
     return db_course
 
-def get_courses_by_owner(db: Session, owner_id: int):
+# Записи и жалобы курсов подгружаются отдельными запросами IN (selectinload), а не JOIN:
+# два joinedload давали R×C строк на курс, а так строк ровно R + C
+_COURSE_DETAILS = (selectinload(models.TreatmentCourse.records), selectinload(models.TreatmentCourse.complaints))
+
+async def get_courses_by_owner(db: AsyncSession, owner_id: int):
+    """Получает все курсы пользователя вместе со связанными записями и жалобами."""
+    stmt = select(models.TreatmentCourse).options(*_COURSE_DETAILS).where(models.TreatmentCourse.owner_id == owner_id).order_by(models.TreatmentCourse.start_date.desc())
+    return (await db.scalars(stmt)).all()
+
+async def get_course(db: AsyncSession, course_id: int, owner_id: int):
+    """Один курс целиком (записи и жалобы) — для детального просмотра."""
+    stmt = select(models.TreatmentCourse).options(*_COURSE_DETAILS).where(models.TreatmentCourse.id == course_id, models.TreatmentCourse.owner_id == owner_id)
+    return (await db.scalars(stmt)).first()
+
+async def get_course_summaries(db: AsyncSession, owner_id: int) -> List[schemas.TreatmentCourseSummary]:
     """
-    Получает все курсы пользователя, сразу подгружая связанные 
-    записи и жалобы для эффективности.
+    Курсы для списка одним запросом: записи и жалобы агрегируются в подзапросах по course_id
+    и присоединяются к курсам по одной строке на курс, без выборки самих записей.
     """
-    return db.query(models.TreatmentCourse).options(
-        joinedload(models.TreatmentCourse.records),
-        joinedload(models.TreatmentCourse.complaints)
-    ).filter(models.TreatmentCourse.owner_id == owner_id).order_by(models.TreatmentCourse.start_date.desc()).all()
+    Course, Record, Complaint = models.TreatmentCourse, models.Record, models.Complaint
+    records = (select(Record.course_id, func.count().label("count"), func.min(Record.date).label("first"), func.max(Record.date).label("last"))
+               .where(Record.owner_id == owner_id, Record.course_id.is_not(None)).group_by(Record.course_id).subquery())
+    complaints = (select(Complaint.course_id, func.count().label("count"), func.max(Complaint.created_at).label("last"))
+                  .where(Complaint.owner_id == owner_id, Complaint.course_id.is_not(None)).group_by(Complaint.course_id).subquery())
+    stmt = (select(Course.id, Course.owner_id, Course.name, Course.start_date, Course.status,
+                   records.c.count, records.c.first, records.c.last, complaints.c.count, complaints.c.last)
+            .outerjoin(records, records.c.course_id == Course.id).outerjoin(complaints, complaints.c.course_id == Course.id)
+            .where(Course.owner_id == owner_id).order_by(Course.start_date.desc(), Course.id.desc()))
+    summaries = []
+    for row in await db.execute(stmt):
+        course_id, course_owner, name, start_date, status, records_count, first_record, last_record, complaints_count, last_complaint = row
+        summaries.append(schemas.TreatmentCourseSummary(
+            id=course_id, owner_id=course_owner, name=name, start_date=start_date, status=status,
+            records_count=records_count or 0, complaints_count=complaints_count or 0,
+            first_record_date=first_record, last_record_date=last_record,
+            last_activity_at=max((value for value in (last_record, last_complaint) if value is not None), default=None),
+        ))
+    return summaries
 
 
 
-# --- КОНЕЦ НОВЫХ ФУНКЦИЙ ---
\ No newline at end of file
+# --- КОНЕЦ НОВЫХ ФУНКЦИЙ ---
@@ -1,23 +1,130 @@
 # backend/app/database.py
 
-from sqlalchemy import create_engine
+import itertools
+import time
+from typing import Dict, List, Optional
+
+from fastapi import Request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from .cache import TTLCache
 from .config import settings # Импортируем наши настройки
 
+# Асинхронные драйверы для тех же баз: asyncpg для Postgres, aiosqlite для локальных прогонов
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "postgres": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def to_async_url(url: str) -> str:
+    """postgresql://... -> postgresql+asyncpg://..., sqlite://... -> sqlite+aiosqlite://..."""
+    scheme, sep, rest = url.partition("://")
+    dialect = scheme.split("+", 1)[0]
+    return f"{_ASYNC_DRIVERS.get(dialect, scheme)}{sep}{rest}"
+
+def engine_options(url: str, is_async: bool = False) -> dict:
+    """Параметры пула и таймаута запросов из настроек для движка по адресу `url`."""
+    url = make_url(url)
+    options = {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"): return options # Пул из одного соединения — настраивать нечего
+    options.update(pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW, pool_timeout=settings.DB_POOL_TIMEOUT_SECONDS, pool_recycle=settings.DB_POOL_RECYCLE_SECONDS)
+    if settings.DB_STATEMENT_TIMEOUT_MS and url.get_backend_name() == "postgresql":
+        timeout = str(settings.DB_STATEMENT_TIMEOUT_MS)
+        options["connect_args"] = {"server_settings": {"statement_timeout": timeout}} if is_async else {"options": f"-c statement_timeout={timeout}"}
+    return options
+
 # Создаем "движок" для подключения к базе данных по адресу из конфига
-engine = create_engine(settings.DATABASE_URL)
+engine = create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
 
 # Создаем фабрику сессий, через которую мы будем делать запросы
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок и фабрика сессий — ими пользуются эндпоинты.
+# expire_on_commit=False: после коммита объекты остаются читаемыми без повторного запроса
+_async_url = settings.ASYNC_DATABASE_URL or to_async_url(settings.DATABASE_URL)
+async_engine = create_async_engine(_async_url, **engine_options(_async_url, is_async=True))
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 # Базовый класс для всех наших моделей таблиц
 Base = declarative_base()
 
+# --- Реплики для чтения ---
+# GET-эндпоинты, которым не важна свежесть до миллисекунды (лента, замеры, просмотр по ссылке,
+# справочники), берут сессию через get_read_db: реплики по кругу, недоступная реплика на
+# REPLICA_RETRY_SECONDS выпадает из круга, без живых реплик — основная БД.
+# Read-your-writes: сессия запроса помнит клиента (заголовок Authorization), и если в ней был
+# закоммичен INSERT/UPDATE/DELETE, этот клиент следующие READ_YOUR_WRITES_SECONDS читает с основной БД.
+# Окно хранится в памяти процесса: при нескольких воркерах за балансировщиком без привязки клиента
+# к воркеру запись и чтение могут попасть в разные процессы — тогда окно стоит задать на балансировщике.
+read_engines = [create_async_engine(to_async_url(url), **engine_options(url, is_async=True)) for url in settings.READ_REPLICA_URLS]
+_ReadSessions = [async_sessionmaker(read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False, info={"replica": index}) for index, read_engine in enumerate(read_engines)]
+_next_replica = itertools.count()
+_replica_down_until: Dict[int, float] = {}
+recent_writers = TTLCache(max_size=settings.READ_YOUR_WRITES_MAX_CLIENTS, ttl=settings.READ_YOUR_WRITES_SECONDS)
+
+_CLIENT_KEY = "client"
+_WROTE_KEY = "wrote"
+
+def _client(request: Request) -> Optional[str]:
+    return request.headers.get("authorization")
+
+def is_replica(db: AsyncSession) -> bool:
+    return "replica" in db.info
+
+@event.listens_for(Session, "after_flush")
+def _mark_flush(session: Session, flush_context) -> None:
+    session.info[_WROTE_KEY] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_dml(orm_execute_state) -> None:
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info[_WROTE_KEY] = True
+
+@event.listens_for(Session, "after_commit")
+def _remember_writer(session: Session) -> None:
+    if session.info.pop(_WROTE_KEY, False) and session.info.get(_CLIENT_KEY) and settings.READ_YOUR_WRITES_SECONDS > 0:
+        recent_writers.set(session.info[_CLIENT_KEY], True)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_writes(session: Session) -> None:
+    session.info.pop(_WROTE_KEY, None)
+
+def _replica_order() -> List[int]:
+    """Живые реплики, начиная со следующей по кругу."""
+    if not read_engines: return []
+    start, now = next(_next_replica), time.monotonic()
+    order = [(start + offset) % len(read_engines) for offset in range(len(read_engines))]
+    return [index for index in order if _replica_down_until.get(index, 0) <= now]
+
+async def _open_replica() -> Optional[AsyncSession]:
+    for index in _replica_order():
+        db = _ReadSessions[index]()
+        try:
+            await db.connection() # Соединение берется сразу: недоступная реплика обнаружится здесь, а не посреди эндпоинта
+            return db
+        except (DBAPIError, OSError):
+            await db.close()
+            _replica_down_until[index] = time.monotonic() + settings.REPLICA_RETRY_SECONDS
+    return None
+
 # Функция для получения сессии базы данных в эндпоинтах
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# То же для асинхронных эндпоинтов
+async def get_async_db(request: Request):
+    async with AsyncSessionLocal(info={_CLIENT_KEY: _client(request)}) as db:
+        yield db
+
+# Сессия только для чтения: реплика, а сразу после записи этого клиента или без живых реплик — основная БД
+async def get_read_db(request: Request):
+    client = _client(request)
+    db = None
+    if not (client and recent_writers.get(client)): db = await _open_replica()
+    async with db or AsyncSessionLocal(info={_CLIENT_KEY: client}) as db:
+        yield db
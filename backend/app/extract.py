@@ -0,0 +1,89 @@
+# backend/app/extract.py
+
+import os
+from typing import Optional, Tuple
+
+# Чистые CPU-функции обработки вложений. Выполняются в процессах пула фоновых задач,
+# поэтому модуль не импортирует ничего из приложения. Pillow, pypdf и pypdfium2 —
+# необязательные зависимости: без них соответствующая обработка просто пропускается.
+
+MAX_TEXT_CHARS = 200_000
+
+class MissingDependency(Exception):
+    """Для обработки этого типа файлов не установлена нужная библиотека."""
+
+def _is_pdf(source_path: str, content_type: Optional[str]) -> bool:
+    return content_type == "application/pdf" or source_path.lower().endswith(".pdf")
+
+def _is_image(source_path: str, content_type: Optional[str]) -> bool:
+    if content_type: return content_type.startswith("image/")
+    return os.path.splitext(source_path)[1].lower() in {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".heic"}
+
+def _save_thumbnail(image, target_path: str, max_size: int) -> None:
+    image.thumbnail((max_size, max_size))
+    if image.mode not in ("RGB", "L"): image = image.convert("RGB")
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    tmp_path = f"{target_path}.part"
+    image.save(tmp_path, "JPEG", quality=80, optimize=True)
+    os.replace(tmp_path, target_path)
+
+def _image_thumbnail(source_path: str, target_path: str, max_size: int) -> None:
+    try:
+        from PIL import Image, ImageOps
+    except ImportError as exc:
+        raise MissingDependency("Pillow") from exc
+    with Image.open(source_path) as image:
+        image.draft("RGB", (max_size, max_size)) # Для JPEG декодирует сразу в уменьшенном масштабе
+        _save_thumbnail(ImageOps.exif_transpose(image), target_path, max_size)
+
+def _pdf_preview(source_path: str, target_path: str, max_size: int) -> None:
+    try:
+        import pypdfium2
+    except ImportError as exc:
+        raise MissingDependency("pypdfium2") from exc
+    pdf = pypdfium2.PdfDocument(source_path)
+    try:
+        page = pdf[0]
+        width, height = page.get_size()
+        scale = max_size / max(width, height, 1)
+        _save_thumbnail(page.render(scale=scale).to_pil(), target_path, max_size)
+    finally:
+        pdf.close()
+
+def _pdf_text(source_path: str) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError as exc:
+        raise MissingDependency("pypdf") from exc
+    parts, total = [], 0
+    for page in PdfReader(source_path).pages:
+        text = page.extract_text() or ""
+        parts.append(text); total += len(text)
+        if total >= MAX_TEXT_CHARS: break
+    return "\n".join(parts)[:MAX_TEXT_CHARS].strip()
+
+def process_file(source_path: str, content_type: Optional[str], thumbnail_path: str, max_size: int) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Готовит превью (JPEG не больше max_size по длинной стороне) и извлекает текст.
+    Возвращает (путь превью или None, текст или None). Уже готовое превью не пересчитывается.
+    Бросает MissingDependency, если для файла не удалось сделать вообще ничего.
+    """
+    preview, text, missing = None, None, []
+    if _is_image(source_path, content_type):
+        make_preview = _image_thumbnail
+    elif _is_pdf(source_path, content_type):
+        make_preview = _pdf_preview
+        try: text = _pdf_text(source_path) or None
+        except MissingDependency as exc: missing.append(str(exc))
+    else:
+        return None, None
+    if os.path.exists(thumbnail_path):
+        preview = thumbnail_path
+    else:
+        try:
+            make_preview(source_path, thumbnail_path, max_size); preview = thumbnail_path
+        except MissingDependency as exc:
+            missing.append(str(exc))
+    if preview is None and text is None and missing:
+        raise MissingDependency(", ".join(missing))
+    return preview, text
@@ -0,0 +1,42 @@
+# backend/app/fastjson.py
+
+import json
+from datetime import date, datetime, time
+from typing import Iterable, List, Optional, Sequence, Type
+
+from fastapi import Response
+from pydantic import BaseModel
+
+# Быстрый путь для больших списков: из БД выбираются только колонки схемы ответа (кортежи, без
+# ORM-объектов), а строки сразу кодируются в JSON — без построения и валидации модели Pydantic
+# на каждую строку. Ключи и форматы (ISO-даты, порядок полей) совпадают с обычным ответом схемы.
+# orjson — необязательная зависимость: без него кодирует стандартный json, медленнее, но так же.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def field_names(schema: Type[BaseModel]) -> List[str]:
+    """Поля схемы в порядке вывода (сначала базовых классов — как у .json())."""
+    fields = getattr(schema, "model_fields", None) or schema.__fields__
+    return list(fields)
+
+def columns(model, schema: Type[BaseModel]) -> list:
+    """Колонки модели под поля схемы, подписанные именами полей."""
+    return [getattr(model, name).label(name) for name in field_names(schema)]
+
+def _default(value):
+    if isinstance(value, (datetime, date, time)): return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dumps(value) -> bytes:
+    if orjson is not None: return orjson.dumps(value)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+def encode_rows(rows: Iterable[Sequence], names: List[str]) -> bytes:
+    """JSON-массив объектов из кортежей строк (значения в порядке `names`)."""
+    return dumps([dict(zip(names, row)) for row in rows])
+
+def rows_response(rows: Iterable[Sequence], names: List[str], headers: Optional[dict] = None) -> Response:
+    return Response(content=encode_rows(rows, names), media_type="application/json", headers=headers)
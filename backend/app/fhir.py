@@ -0,0 +1,312 @@
+# backend/app/fhir.py
+
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from . import crud, fastjson, ingest, labs, models, schemas
+from .database import AsyncSessionLocal
+
+# Выгрузка и загрузка всех данных пациента в формате FHIR R4 Bulk Data: NDJSON, ресурс на строку.
+#  * Patient — пользователь и профиль; Condition / AllergyIntolerance — его заболевания и аллергии;
+#  * запись "Encounter" — Encounter (+ Condition по diagnosis_code, + MedicationStatement по medication_name);
+#  * запись "Observation" — лабораторный Observation; замеры — Observation категории vital-signs.
+# Экспорт читает таблицы серверными курсорами (yield_per) и отдает ответ кусками — память не растет
+# с длиной истории. Импорт разбирает поток построчно и применяет его пачками по IMPORT_CHUNK_SIZE
+# (транзакция на пачку). Записи и замеры находятся по external_id = "<источник>:<Тип>/<id>",
+# поэтому повторная загрузка того же файла обновляет строки, а не дублирует их.
+# Даты в БД хранятся без пояса в UTC (клиент присылает ISO с "Z"); в FHIR они выгружаются с "+00:00".
+
+NDJSON_MEDIA_TYPE = "application/fhir+ndjson"
+
+SYSTEM = "https://meddata.kz/fhir"
+ICD10 = "http://hl7.org/fhir/sid/icd-10"
+LOINC = "http://loinc.org"
+OBSERVATION_CATEGORY = "http://terminology.hl7.org/CodeSystem/observation-category"
+CONDITION_CLINICAL = "http://terminology.hl7.org/CodeSystem/condition-clinical"
+CONDITION_CATEGORY = "http://terminology.hl7.org/CodeSystem/condition-category"
+ENCOUNTER_CLASS = "http://terminology.hl7.org/CodeSystem/v3-ActCode"
+VITALS_TYPE_SYSTEM = f"{SYSTEM}/vitals-type"
+CONCLUSION_EXTENSION = f"{SYSTEM}/StructureDefinition/conclusion"
+
+# Тип замера -> код LOINC
+VITALS_LOINC = {
+    "heart_rate": ("8867-4", "Heart rate"),
+    "blood_pressure_sys": ("8480-6", "Systolic blood pressure"),
+    "blood_pressure_dia": ("8462-4", "Diastolic blood pressure"),
+    "blood_sugar": ("15074-8", "Glucose [Moles/volume] in Blood"),
+    "weight": ("29463-7", "Body weight"),
+    "height": ("8302-2", "Body height"),
+    "temperature": ("8310-5", "Body temperature"),
+}
+_VITALS_BY_LOINC = {code: vitals_type for vitals_type, (code, _) in VITALS_LOINC.items()}
+
+EXPORT_BATCH_SIZE = 1000 # Строк на одну выборку серверного курсора
+EXPORT_BUFFER_BYTES = 64 * 1024 # Размер куска ответа
+IMPORT_CHUNK_SIZE = 500
+
+def _compact(value):
+    """Убирает пустые поля: FHIR не допускает null, пустых строк, списков и объектов."""
+    if isinstance(value, dict):
+        value = {key: _compact(item) for key, item in value.items()}
+        return {key: item for key, item in value.items() if item not in (None, "", [], {})}
+    if isinstance(value, list):
+        return [item for item in (_compact(item) for item in value) if item not in (None, "", [], {})]
+    return value
+
+def _datetime(value: Optional[datetime]) -> Optional[str]:
+    return value.replace(tzinfo=timezone.utc).isoformat() if value else None
+
+def _reference(resource_type: str, resource_id: str) -> dict:
+    return {"reference": f"{resource_type}/{resource_id}"}
+
+# --- Экспорт: модели -> ресурсы ---
+def patient_resource(user: models.User, profile: Optional[models.Profile]) -> dict:
+    return _compact({
+        "resourceType": "Patient", "id": str(user.id),
+        "identifier": [{"system": f"{SYSTEM}/patient", "value": str(user.id)}],
+        "active": user.is_active,
+        "name": [{"family": user.last_name, "given": [user.first_name]}],
+        "telecom": [{"system": "email", "value": user.email}],
+        "birthDate": user.birth_date.isoformat() if user.birth_date else None,
+        "address": [{"text": profile.address}] if profile else [],
+        "contact": [{
+            "name": {"text": profile.emergency_contact_name},
+            "telecom": [{"system": "phone", "value": profile.emergency_contact_phone}] if profile.emergency_contact_phone else [],
+        }] if profile else [],
+    })
+
+def disease_resource(user_id: int, disease: models.ChronicDisease) -> dict:
+    return _compact({
+        "resourceType": "Condition", "id": f"disease-{disease.id}",
+        "clinicalStatus": {"coding": [{"system": CONDITION_CLINICAL, "code": "active"}]},
+        "category": [{"coding": [{"system": CONDITION_CATEGORY, "code": "problem-list-item"}]}],
+        "code": {"coding": [{"system": ICD10, "code": disease.icd10_code, "display": disease.name}] if disease.icd10_code else [], "text": disease.name},
+        "subject": _reference("Patient", str(user_id)),
+    })
+
+def allergy_resource(user_id: int, allergy: models.Allergy) -> dict:
+    return {"resourceType": "AllergyIntolerance", "id": f"allergy-{allergy.id}", "code": {"text": allergy.name}, "patient": _reference("Patient", str(user_id))}
+
+def vitals_resource(vitals: models.VitalsRecord) -> dict:
+    loinc = VITALS_LOINC.get(vitals.type)
+    coding = [{"system": LOINC, "code": loinc[0], "display": loinc[1]}] if loinc else []
+    return _compact({
+        "resourceType": "Observation", "id": f"vitals-{vitals.id}", "status": "final",
+        "category": [{"coding": [{"system": OBSERVATION_CATEGORY, "code": "vital-signs"}]}],
+        "code": {"coding": coding + [{"system": VITALS_TYPE_SYSTEM, "code": vitals.type}], "text": vitals.type},
+        "subject": _reference("Patient", str(vitals.owner_id)),
+        "effectiveDateTime": _datetime(vitals.timestamp),
+        "valueQuantity": {"value": vitals.value, "unit": vitals.unit},
+    })
+
+def record_resources(record: models.Record) -> Iterator[dict]:
+    """Ресурсы одной записи ленты: сама запись и связанные с ней диагноз и препарат."""
+    record_id, subject, when = f"record-{record.id}", _reference("Patient", str(record.owner_id)), _datetime(record.date)
+    if record.resource_type == "Observation":
+        parsed = labs.parse_result(record.result)
+        low, high, _ = labs.parse_reference_range(record.reference_range)
+        yield _compact({
+            "resourceType": "Observation", "id": record_id, "status": "final",
+            "category": [{"coding": [{"system": OBSERVATION_CATEGORY, "code": "laboratory"}]}],
+            "code": {"text": record.test_name}, "subject": subject, "effectiveDateTime": when,
+            "performer": [{"display": record.lab_name}],
+            "valueQuantity": {"value": parsed[0], "unit": parsed[1], "comparator": parsed[2]} if parsed else None,
+            "valueString": None if parsed else record.result,
+            "referenceRange": [{"text": record.reference_range, "low": {"value": low}, "high": {"value": high}}],
+            "note": [{"text": record.conclusion_text}],
+        })
+        return
+    if record.resource_type == "MedicationStatement":
+        yield _compact({"resourceType": "MedicationStatement", "id": record_id, "status": "unknown", "subject": subject,
+                        "medicationCodeableConcept": {"text": record.medication_name}, "effectiveDateTime": when, "note": [{"text": record.conclusion_text}]})
+        return
+    yield _compact({
+        "resourceType": "Encounter", "id": record_id, "status": "finished",
+        "class": {"system": ENCOUNTER_CLASS, "code": "AMB"}, "subject": subject, "period": {"start": when},
+        "participant": [{"individual": {"display": record.doctor_name}}],
+        "serviceProvider": {"display": record.clinic_name},
+        "reasonCode": [{"text": record.patient_complaints}],
+        "diagnosis": [{"condition": _reference("Condition", f"{record_id}-diagnosis")}] if record.diagnosis_code else [],
+        "extension": [{"url": CONCLUSION_EXTENSION, "valueString": record.conclusion_text}],
+    })
+    encounter = _reference("Encounter", record_id)
+    if record.diagnosis_code:
+        yield {"resourceType": "Condition", "id": f"{record_id}-diagnosis", "code": {"coding": [{"system": ICD10, "code": record.diagnosis_code}]},
+               "subject": subject, "encounter": encounter, "recordedDate": when}
+    if record.medication_name:
+        yield _compact({"resourceType": "MedicationStatement", "id": f"{record_id}-medication", "status": "unknown", "subject": subject,
+                        "medicationCodeableConcept": {"text": record.medication_name}, "context": encounter, "effectiveDateTime": when})
+
+async def iter_export(user_id: int) -> AsyncIterator[bytes]:
+    """NDJSON всех данных пользователя кусками ~EXPORT_BUFFER_BYTES; сессия своя — живет, пока идет ответ."""
+    buffer = bytearray()
+    async with AsyncSessionLocal() as db:
+        user = (await db.scalars(select(models.User).options(selectinload(models.User.profile), selectinload(models.User.allergies), selectinload(models.User.chronic_diseases)).where(models.User.id == user_id))).first()
+        if user is None: return
+        head = [patient_resource(user, user.profile)]
+        head += [disease_resource(user.id, disease) for disease in user.chronic_diseases]
+        head += [allergy_resource(user.id, allergy) for allergy in user.allergies]
+        for resource in head: buffer += fastjson.dumps(resource) + b"\n"
+        streams = (
+            (select(models.Record).where(models.Record.owner_id == user_id).order_by(models.Record.date, models.Record.id), record_resources),
+            (select(models.VitalsRecord).where(models.VitalsRecord.owner_id == user_id).order_by(models.VitalsRecord.timestamp, models.VitalsRecord.id), lambda vitals: [vitals_resource(vitals)]),
+        )
+        for stmt, to_resources in streams:
+            async for row in await db.stream_scalars(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE)):
+                for resource in to_resources(row): buffer += fastjson.dumps(resource) + b"\n"
+                if len(buffer) >= EXPORT_BUFFER_BYTES:
+                    yield bytes(buffer); buffer.clear()
+    if buffer: yield bytes(buffer)
+
+# --- Импорт: ресурсы -> пачки изменений ---
+@dataclass
+class _Batch:
+    patient: Optional[dict] = None
+    records: List[Tuple[str, dict]] = field(default_factory=list)
+    vitals: List[Tuple[str, dict]] = field(default_factory=list)
+    record_updates: List[Tuple[int, str, dict]] = field(default_factory=list)
+    allergies: List[str] = field(default_factory=list)
+    diseases: List[str] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.records) + len(self.vitals) + len(self.record_updates) + len(self.allergies) + len(self.diseases) + (self.patient is not None)
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    """FHIR dateTime/date -> наивное UTC, как хранится в БД."""
+    if not value: return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+
+def _coding(concept: Optional[dict], system: str) -> Optional[str]:
+    for coding in (concept or {}).get("coding") or []:
+        if coding.get("system") == system and coding.get("code"): return coding["code"]
+    return None
+
+def _concept_text(concept: Optional[dict]) -> Optional[str]:
+    concept = concept or {}
+    if concept.get("text"): return concept["text"]
+    return next((coding.get("display") for coding in concept.get("coding") or [] if coding.get("display")), None)
+
+def _first(items: Optional[list], *path):
+    """Значение по пути в первом элементе списка: _first(resource["participant"], "individual", "display")."""
+    value = (items or [None])[0]
+    for key in path: value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+def _category(resource: dict) -> Optional[str]:
+    return _coding((resource.get("category") or [None])[0], OBSERVATION_CATEGORY)
+
+def _local_reference(reference: Optional[dict], resource_type: str) -> Optional[str]:
+    value = (reference or {}).get("reference") or ""
+    prefix = f"{resource_type}/"
+    return value[len(prefix):] if value.startswith(prefix) else None
+
+def _format_quantity(quantity: dict) -> Optional[str]:
+    if quantity.get("value") is None: return None
+    text = f"{quantity.get('comparator') or ''}{quantity['value']:g}"
+    return f"{text} {quantity['unit']}" if quantity.get("unit") else text
+
+def _record_fields(**fields) -> dict:
+    """
+    Поля записи, которые переносятся из ресурса FHIR (проверенные схемой). Остальные — вложение,
+    курс, диагноз и препарат из других ресурсов — в словарь не попадают: повторный импорт их не сбрасывает.
+    """
+    return schemas.RecordCreate(**fields).dict(exclude_unset=True)
+
+def _collect(batch: _Batch, row_no: int, resource: dict, source: str) -> None:
+    """Раскладывает ресурс по пачке; бросает ValueError/ValidationError на неподдерживаемых и битых ресурсах."""
+    resource_type, resource_id = resource.get("resourceType"), resource.get("id")
+    if resource_type != "Patient" and not resource_id: raise ValueError("У ресурса нет id")
+    external_id = f"{source}:{resource_type}/{resource_id}"
+    if resource_type == "Patient":
+        name = (resource.get("name") or [{}])[0]
+        contact = (resource.get("contact") or [{}])[0]
+        batch.patient = {
+            "first_name": " ".join(name.get("given") or []) or None, "last_name": name.get("family"),
+            "birth_date": date.fromisoformat(resource["birthDate"]) if resource.get("birthDate") else None,
+            "address": _first(resource.get("address"), "text"),
+            "emergency_contact_name": (contact.get("name") or {}).get("text"),
+            "emergency_contact_phone": _first(contact.get("telecom"), "value"),
+        }
+    elif resource_type == "Encounter":
+        conclusion = next((item.get("valueString") for item in resource.get("extension") or [] if item.get("url") == CONCLUSION_EXTENSION), None)
+        batch.records.append((external_id, _record_fields(
+            resource_type="Encounter", date=_parse_datetime((resource.get("period") or {}).get("start")),
+            doctor_name=_first(resource.get("participant"), "individual", "display"),
+            clinic_name=(resource.get("serviceProvider") or {}).get("display"),
+            patient_complaints=_first(resource.get("reasonCode"), "text"), conclusion_text=conclusion,
+        )))
+    elif resource_type == "Observation" and _category(resource) == "vital-signs":
+        concept = resource.get("code")
+        vitals_type = _coding(concept, VITALS_TYPE_SYSTEM) or _VITALS_BY_LOINC.get(_coding(concept, LOINC)) or _concept_text(concept)
+        quantity = resource.get("valueQuantity") or {}
+        batch.vitals.append((external_id, schemas.VitalsRecordCreate(
+            type=vitals_type, value=quantity.get("value"), unit=quantity.get("unit") or "",
+            timestamp=_parse_datetime(resource.get("effectiveDateTime")),
+        ).dict(exclude_none=True))) # Без времени — текущее (как в POST /vitals/)
+    elif resource_type == "Observation":
+        result = _format_quantity(resource["valueQuantity"]) if resource.get("valueQuantity") else resource.get("valueString")
+        batch.records.append((external_id, _record_fields(
+            resource_type="Observation", date=_parse_datetime(resource.get("effectiveDateTime") or resource.get("issued")),
+            test_name=_concept_text(resource.get("code")), result=result,
+            reference_range=_first(resource.get("referenceRange"), "text"),
+            lab_name=_first(resource.get("performer"), "display"), conclusion_text=_first(resource.get("note"), "text"),
+        )))
+    elif resource_type == "Condition":
+        code = _coding(resource.get("code"), ICD10)
+        encounter_id = _local_reference(resource.get("encounter"), "Encounter")
+        if encounter_id: batch.record_updates.append((row_no, f"{source}:Encounter/{encounter_id}", {"diagnosis_code": code or _concept_text(resource.get("code"))}))
+        elif code or _concept_text(resource.get("code")): batch.diseases.append(code or _concept_text(resource.get("code")))
+        else: raise ValueError("Condition без кода и названия")
+    elif resource_type == "MedicationStatement":
+        medication = _concept_text(resource.get("medicationCodeableConcept"))
+        if not medication: raise ValueError("MedicationStatement без названия препарата")
+        encounter_id = _local_reference(resource.get("context"), "Encounter")
+        if encounter_id:
+            batch.record_updates.append((row_no, f"{source}:Encounter/{encounter_id}", {"medication_name": medication}))
+        else:
+            batch.records.append((external_id, _record_fields(
+                resource_type="MedicationStatement", date=_parse_datetime(resource.get("effectiveDateTime") or resource.get("dateAsserted")),
+                medication_name=medication, conclusion_text=_first(resource.get("note"), "text"),
+            )))
+    elif resource_type == "AllergyIntolerance":
+        allergy = _concept_text(resource.get("code"))
+        if not allergy: raise ValueError("AllergyIntolerance без названия")
+        batch.allergies.append(allergy)
+    else:
+        raise ValueError(f"Ресурс {resource_type} не поддерживается")
+
+async def import_resources(db: AsyncSession, user_id: int, rows: AsyncIterator[ingest.Row], source: str) -> schemas.FhirImportResult:
+    """Импортирует поток ресурсов пользователю user_id; `source` — метка клиники-источника для external_id."""
+    batch, created, updated, failed, errors = _Batch(), 0, 0, 0, []
+    def fail(row_no: int, error: str) -> None:
+        nonlocal failed
+        failed += 1
+        if len(errors) < ingest.MAX_REPORTED_ERRORS: errors.append(schemas.FhirImportError(row=row_no, error=error))
+    async def apply() -> None:
+        nonlocal batch, created, updated
+        if not len(batch): return
+        batch_created, batch_updated, missing = await crud.import_patient_batch(
+            db, user_id, patient=batch.patient, records=batch.records, vitals=batch.vitals,
+            record_updates=batch.record_updates, allergies=batch.allergies, diseases=batch.diseases,
+        )
+        created += batch_created; updated += batch_updated
+        for row_no, error in missing: fail(row_no, error)
+        batch = _Batch()
+    async for row_no, data, error in rows:
+        if error is None:
+            try: _collect(batch, row_no, data, source)
+            except ValidationError as exc: error = ingest.format_validation_error(exc)
+            except (KeyError, TypeError, ValueError) as exc: error = str(exc) or type(exc).__name__
+            except AttributeError: error = "Некорректная структура ресурса" # Объект там, где по FHIR ожидается список (или наоборот)
+        if error is not None:
+            fail(row_no, error); continue
+        if len(batch) >= IMPORT_CHUNK_SIZE: await apply()
+    await apply()
+    return schemas.FhirImportResult(created=created, updated=updated, failed=failed, errors=errors)
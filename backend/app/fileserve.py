@@ -0,0 +1,104 @@
+# backend/app/fileserve.py
+
+import os
+from typing import Optional, Tuple
+
+import anyio
+from fastapi import Request, Response
+from starlette.types import Receive, Scope, Send
+
+from .config import settings
+
+# Отдача файлов вложений: сильные ETag, 304, Range-запросы (докачка больших PDF),
+# zero-copy sendfile, если его поддерживает ASGI-сервер, и опциональная передача
+# самой отдачи фронт-прокси через X-Accel-Redirect (nginx).
+
+CHUNK_SIZE = 256 * 1024
+# URL записи не меняется при замене файла, поэтому кэш всегда перепроверяется по ETag
+CACHE_CONTROL = "private, no-cache"
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header: return False
+    if header.strip() == "*": return True
+    return etag in (tag.strip() for tag in header.split(","))
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Разбирает одиночный диапазон "bytes=a-b" / "bytes=a-" / "bytes=-n" в (start, end) включительно.
+    Возвращает None, если заголовка нет или он не поддерживается (тогда отдается весь файл).
+    Бросает ValueError, если диапазон невыполним (416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header or size == 0: return None
+    start_raw, sep, end_raw = header[len("bytes="):].strip().partition("-")
+    if not sep or not (start_raw or end_raw) or not all(part == "" or part.isdigit() for part in (start_raw, end_raw)): return None
+    if not start_raw:
+        length = int(end_raw)
+        if length == 0: raise ValueError("Unsatisfiable range")
+        return max(size - length, 0), size - 1
+    start = int(start_raw)
+    end = min(int(end_raw), size - 1) if end_raw else size - 1
+    if start >= size or start > end: raise ValueError("Unsatisfiable range")
+    return start, end
+
+class FileRangeResponse(Response):
+    """Отдает кусок файла [start, end]; через sendfile, если сервер поддерживает zerocopy."""
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, media_type: Optional[str], send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path, self.start, self.end, self.send_body = path, start, end, send_body
+        self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        count = self.end - self.start + 1
+        async with await anyio.open_file(self.path, "rb") as file:
+            if "http.response.zerocopy" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopy", "file": file.wrapped, "offset": self.start, "count": count, "more_body": False})
+                return
+            await file.seek(self.start)
+            while count > 0:
+                chunk = await file.read(min(CHUNK_SIZE, count))
+                if not chunk: break
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+def serve_file(request: Request, storage_path: str, etag: str, media_type: Optional[str]) -> Response:
+    """
+    Ответ на запрос файла из UPLOAD_DIR с учетом If-None-Match, Range и If-Range.
+    storage_path — путь относительно UPLOAD_DIR (он же уходит прокси в X-Accel-Redirect).
+    """
+    path = os.path.join(settings.UPLOAD_DIR, storage_path)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if settings.ATTACHMENT_ACCEL_REDIRECT_PREFIX:
+        # Байты отдает прокси (он же обрабатывает Range); приложение только проверило доступ
+        headers["X-Accel-Redirect"] = settings.ATTACHMENT_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + storage_path.replace(os.sep, "/")
+        return Response(status_code=200, headers=headers, media_type=media_type)
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return Response(status_code=404)
+    send_body = request.method != "HEAD"
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return FileRangeResponse(path, start, end, 206, headers, media_type, send_body)
+    return FileRangeResponse(path, 0, size - 1, 200, headers, media_type, send_body)
+
+def legacy_etag(storage_path: str) -> Optional[str]:
+    """ETag для старых файлов без хэша (до контентно-адресуемого хранилища): размер + mtime."""
+    try:
+        stat = os.stat(os.path.join(settings.UPLOAD_DIR, storage_path))
+    except FileNotFoundError:
+        return None
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
@@ -0,0 +1,68 @@
+# backend/app/httpcache.py
+
+import re
+from typing import Iterable, Tuple
+
+from fastapi import Depends, HTTPException, Request, Response
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, schemas, security
+from .database import get_read_db
+
+# Условные GET для данных пользователя. Каждая транзакция, меняющая коллекцию, пишет в
+# collection_versions версию владельца (см. sync.py), поэтому ETag ответа — это
+# (пользователь, коллекции, наибольшая их версия), и он известен после одного запроса по
+# первичному ключу, до выборки самих данных. Совпал с If-None-Match — пустой 304, и данные не
+# читаются и не сериализуются. ETag слабый: тело может отдаваться сжатым или нет.
+# Браузер перепроверяет такие ответы сам (Cache-Control: no-cache), фронтенду ничего делать не нужно.
+
+# Ответ только для этого пользователя; хранить можно, но перед показом — перепроверить
+CACHE_CONTROL = "private, no-cache"
+
+async def collection_version(db: AsyncSession, owner_id: int, collections: Iterable[str]) -> int:
+    """Наибольшая версия коллекций: версии всех коллекций берутся из одного счетчика владельца."""
+    Version = models.CollectionVersion
+    stmt = select(func.max(Version.version)).where(Version.owner_id == owner_id, Version.collection.in_(list(collections)))
+    return await db.scalar(stmt) or 0
+
+def make_etag(owner_id: int, collections: Tuple[str, ...], version: int) -> str:
+    return f'W/"{owner_id}-{"+".join(collections)}-{version}"'
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+def matches(request: Request, etag: str) -> bool:
+    """Слабое сравнение с If-None-Match (как требует RFC 9110 для GET)."""
+    header = request.headers.get("if-none-match")
+    if not header: return False
+    return header.strip() == "*" or _opaque(etag) in (_opaque(tag) for tag in header.split(","))
+
+def conditional(*collections: str):
+    """
+    Зависимость GET-эндпоинта, чей ответ зависит от `collections` пользователя. Отвечает 304
+    по If-None-Match, иначе добавляет ETag в ответ и возвращает заголовки — эндпоинты,
+    собирающие Response сами, передают их в него.
+    """
+    async def check(request: Request, response: Response, db: AsyncSession = Depends(get_read_db), current_user: schemas.User = Depends(security.get_current_active_user)) -> dict:
+        etag = make_etag(current_user.id, collections, await collection_version(db, current_user.id, collections))
+        headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Vary": "Authorization"}
+        if matches(request, etag): raise HTTPException(status_code=304, headers=headers)
+        response.headers.update(headers)
+        return headers
+    return check
+
+class CompressionExcept:
+    """
+    Оборачивает сжимающий middleware (GZip/Brotli) и пропускает мимо него пути по `excluded`:
+    вложения уже сжаты, а сжатие убрало бы Content-Length, Range и отдачу через sendfile.
+    """
+    def __init__(self, app, middleware, excluded: str, **options):
+        self.app = app
+        self.compressing = middleware(app, **options)
+        self.excluded = re.compile(excluded)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.excluded.match(scope["path"]): await self.app(scope, receive, send)
+        else: await self.compressing(scope, receive, send)
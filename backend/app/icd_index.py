@@ -0,0 +1,179 @@
+# backend/app/icd_index.py
+
+import asyncio
+import bisect
+import heapq
+import math
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, refdata
+from .cache import TTLCache
+from .config import settings
+
+# Поиск по справочнику МКБ-10 для автодополнения диагнозов без похода в БД.
+# Названия (русские и казахские) разбиваются на триграммы как в pg_trgm; запрос
+# сравнивается по доле совпавших триграмм, поэтому опечатки не мешают поиску.
+# Коды ищутся по префиксу в отсортированном списке. Индекс сверяется с версией справочника
+# (reference_data_versions, см. refdata.py): изменения этого воркера — сразу после коммита
+# (invalidate()), других воркеров — не позже чем через ICD_INDEX_REFRESH_SECONDS. Если
+# изменились только новые строки, они дописываются в индекс, иначе он строится заново.
+
+MIN_SIMILARITY = 0.5 # Доля триграмм запроса, которые должны найтись в названии
+RESULT_CACHE_SIZE = 4096
+
+# ё и казахские буквы сводим к русским, чтобы "қант" находил "кант", а "ёж" — "еж"
+_LETTERS = str.maketrans({"ё": "е", "й": "и", "ә": "а", "ғ": "г", "қ": "к", "ң": "н", "ө": "о", "ұ": "у", "ү": "у", "һ": "х", "і": "и"})
+# Кириллические буквы, похожие на латинские: "Е11" набирают в русской раскладке
+_CODE_LETTERS = str.maketrans("АВЕКМНОРСТХ", "ABEKMHOPCTX")
+_NON_WORD = re.compile(r"[^\w]+")
+_CODE_QUERY = re.compile(r"^[A-Z]\d{1,4}$")
+
+def normalize(text: str) -> str:
+    return " ".join(_NON_WORD.sub(" ", text.lower().translate(_LETTERS)).replace("_", " ").split())
+
+def normalize_code(code: str) -> str:
+    return code.upper().translate(_CODE_LETTERS).replace(".", "").replace(" ", "")
+
+def trigrams(text: str, partial_last_word: bool = False) -> List[str]:
+    """
+    Триграммы слов с отступом как в pg_trgm ("  сах", " са", ..., "ар "). Для запроса
+    последнее слово еще набирается, поэтому у него нет завершающего пробела — так префикс
+    слова совпадает с началом длинного слова из справочника.
+    """
+    grams = []
+    words = text.split()
+    for i, word in enumerate(words):
+        padded = f"  {word}" if partial_last_word and i == len(words) - 1 else f"  {word} "
+        grams.extend(padded[j:j + 3] for j in range(len(padded) - 2))
+    return list(dict.fromkeys(grams))
+
+@dataclass
+class IcdEntry:
+    id: int
+    name: str
+    icd10_code: Optional[str]
+    name_kk: Optional[str]
+    search_text: str = "" # Нормализованные названия, каждое с новой строки
+
+class IcdIndex:
+    """Неизменяемые после добавления записи + инвертированный индекс триграмм."""
+    def __init__(self):
+        self.entries: List[IcdEntry] = []
+        self.max_id = 0
+        self._gram_ids: Dict[str, int] = {}
+        self._postings: List[List[int]] = [] # gram id -> позиции записей
+        self._codes: List[Tuple[str, int]] = [] # (нормализованный код, позиция), отсортировано
+        # Автодополнение повторяет одни и те же префиксы ("д", "ди", "диа"...) — готовые ответы кэшируются
+        self._results = TTLCache(max_size=RESULT_CACHE_SIZE, ttl=float("inf"))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, disease_id: int, name: str, icd10_code: Optional[str], name_kk: Optional[str] = None) -> None:
+        position = len(self.entries)
+        search_names = tuple(normalize(value) for value in (name, name_kk) if value)
+        for gram in dict.fromkeys(gram for value in search_names for gram in trigrams(value)):
+            gram_id = self._gram_ids.get(gram)
+            if gram_id is None:
+                gram_id = self._gram_ids[gram] = len(self._postings)
+                self._postings.append([])
+            self._postings[gram_id].append(position)
+        self.entries.append(IcdEntry(disease_id, name, icd10_code, name_kk, "".join(f"\n{value}" for value in search_names)))
+        if icd10_code: bisect.insort(self._codes, (normalize_code(icd10_code), position))
+        self.max_id = max(self.max_id, disease_id)
+        self._results.clear()
+
+    def _search_codes(self, code: str, limit: int) -> List[IcdEntry]:
+        start = bisect.bisect_left(self._codes, (code, -1))
+        found = []
+        for normalized, position in self._codes[start:]:
+            if not normalized.startswith(code) or len(found) >= limit: break
+            found.append(self.entries[position])
+        return found
+
+    def _search_names(self, query: str, limit: int) -> List[IcdEntry]:
+        query_grams = [self._gram_ids.get(gram) for gram in trigrams(query, partial_last_word=True)]
+        if not query_grams: return []
+        needed = max(1, math.ceil(len(query_grams) * MIN_SIMILARITY))
+        # Число совпавших триграмм для каждой записи считается одним проходом по спискам (в C)
+        hits = Counter(chain.from_iterable(self._postings[gram] for gram in query_grams if gram is not None))
+        name_prefix, word_prefix = f"\n{query}", f" {query}"
+        scored = []
+        for position, count in hits.items():
+            if count < needed: continue
+            entry = self.entries[position]
+            # Бонус за совпадение с началом названия или с началом слова
+            bonus = 0.5 if name_prefix in entry.search_text else 0.25 if word_prefix in entry.search_text else 0.0
+            scored.append((-(count / len(query_grams) + bonus), len(entry.name), position))
+        return [self.entries[position] for *_, position in heapq.nsmallest(limit, scored)]
+
+    def search(self, query: str, limit: int = 10) -> List[IcdEntry]:
+        """Сначала совпадения по коду (если запрос похож на код), затем по названию по убыванию релевантности."""
+        normalized = normalize(query)
+        key = (normalized, query.strip().upper(), limit)
+        found = self._results.get(key)
+        if found is not None: return found
+        found = []
+        code = normalize_code(query.strip())
+        if _CODE_QUERY.match(code): found = self._search_codes(code, limit)
+        if normalized and len(found) < limit:
+            seen = {entry.id for entry in found}
+            found.extend(entry for entry in self._search_names(normalized, limit) if entry.id not in seen)
+        found = found[:limit]
+        self._results.set(key, found)
+        return found
+
+def build(rows: Iterable[Tuple[int, str, Optional[str], Optional[str]]]) -> IcdIndex:
+    new_index = IcdIndex()
+    for row in rows: new_index.add(*row)
+    return new_index
+
+index = IcdIndex()
+_version: Optional[int] = None # Версия справочника, по которой построен индекс
+_checked_at: Optional[float] = None
+_refresh_lock = asyncio.Lock()
+
+_COLUMNS = (models.ChronicDisease.id, models.ChronicDisease.name, models.ChronicDisease.icd10_code, models.ChronicDisease.name_kk)
+
+def invalidate() -> None:
+    """Заставляет сверить индекс со справочником при следующем поиске (вызывать после коммита изменений)."""
+    global _checked_at
+    _checked_at = None
+
+def _is_stale(force: bool) -> bool:
+    return force or _checked_at is None or time.monotonic() - _checked_at >= settings.ICD_INDEX_REFRESH_SECONDS
+
+def _apply(rows: List[Tuple[int, str, Optional[str], Optional[str]]]) -> None:
+    """Дописывает новые строки, если уже проиндексированные не изменились и не удалены; иначе перестраивает индекс."""
+    global index
+    indexed = {entry.id: (entry.id, entry.name, entry.icd10_code, entry.name_kk) for entry in index.entries}
+    current = [tuple(row) for row in rows]
+    kept = [row for row in current if row[0] in indexed]
+    if len(kept) == len(indexed) and all(indexed[row[0]] == row for row in kept):
+        for row in current:
+            if row[0] not in indexed: index.add(*row)
+    else:
+        index = build(current)
+
+async def ensure_fresh(db: AsyncSession, force: bool = False) -> IcdIndex:
+    """Индекс, сверенный с версией справочника; при ее изменении справочник перечитывается целиком."""
+    global _version, _checked_at
+    if not _is_stale(force): return index
+    async with _refresh_lock:
+        if not _is_stale(force): return index
+        version = await db.scalar(select(models.ReferenceDataVersion.version).where(models.ReferenceDataVersion.name == refdata.CHRONIC_DISEASES)) or 0
+        # Версия не изменилась, но индекс пуст, а справочник нет — строки залили в обход версий
+        empty = not index.entries and bool(await db.scalar(select(func.count()).select_from(models.ChronicDisease)))
+        if force or version != _version or empty:
+            _apply((await db.execute(select(*_COLUMNS).order_by(models.ChronicDisease.id))).all())
+            _version = version
+        _checked_at = time.monotonic()
+        return index
@@ -0,0 +1,168 @@
+# backend/app/ingest.py
+
+import codecs
+import csv
+import json
+import os
+import re
+from typing import AsyncIterator, List, Optional, Tuple
+
+import anyio
+
+from fastapi import Request
+from pydantic import ValidationError
+
+# Сколько ошибок по строкам возвращаем клиенту; остальные только считаются
+MAX_REPORTED_ERRORS = 1000
+
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines", "application/fhir+ndjson"}
+CSV_TYPES = {"text/csv", "application/csv"}
+
+# (номер строки с 1, разобранный объект, текст ошибки)
+Row = Tuple[int, Optional[dict], Optional[str]]
+
+def format_validation_error(exc: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in exc.errors())
+
+# Формат файла для импорта из командной строки — по расширению
+FILE_TYPES = {".ndjson": "application/x-ndjson", ".jsonl": "application/x-ndjson", ".csv": "text/csv", ".json": "application/json"}
+FILE_CHUNK_SIZE = 256 * 1024
+
+async def iter_payload_rows(request: Request) -> AsyncIterator[Row]:
+    """
+    Потоково разбирает тело запроса на строки-объекты, не читая его целиком в память.
+    Формат выбирается по Content-Type: NDJSON, CSV (первая строка — заголовок) или JSON-массив.
+    Ошибки отдельных строк возвращаются вместе с номером строки, битый JSON-массив — ValueError.
+    """
+    async for row in iter_rows(request.stream(), request.headers.get("content-type", "")):
+        yield row
+
+async def iter_file_chunks(path: str) -> AsyncIterator[bytes]:
+    async with await anyio.open_file(path, "rb") as file:
+        while chunk := await file.read(FILE_CHUNK_SIZE): yield chunk
+
+async def iter_file_rows(path: str) -> AsyncIterator[Row]:
+    """То же для файла на диске (команды CLI); формат — по расширению, по умолчанию JSON-массив."""
+    async for row in iter_rows(iter_file_chunks(path), FILE_TYPES.get(os.path.splitext(path)[1].lower(), "application/json")):
+        yield row
+
+async def iter_rows(chunks: AsyncIterator[bytes], content_type: str) -> AsyncIterator[Row]:
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type in NDJSON_TYPES:
+        rows = _iter_ndjson(chunks)
+    elif content_type in CSV_TYPES:
+        rows = _iter_csv(chunks)
+    else:
+        rows = _iter_json_array(chunks)
+    async for row in rows:
+        yield row
+
+async def _iter_text(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text: yield text
+    tail = decoder.decode(b"", final=True)
+    if tail: yield tail
+
+async def _iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    buffer = ""
+    async for text in _iter_text(chunks):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines: yield line.rstrip("\r")
+    if buffer: yield buffer.rstrip("\r")
+
+def _parse_row(row_no: int, text: str) -> Row:
+    try: data = json.loads(text)
+    except ValueError as exc: return row_no, None, f"Некорректный JSON: {exc}"
+    if not isinstance(data, dict): return row_no, None, "Ожидался JSON-объект"
+    return row_no, data, None
+
+async def _iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    row_no = 0
+    async for line in _iter_lines(chunks):
+        if not line.strip(): continue
+        row_no += 1
+        yield _parse_row(row_no, line)
+
+async def _iter_csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[str]]:
+    """
+    Записи CSV по строкам потока. Пока в записи нечетное число кавычек, поле в кавычках
+    не закрыто (перевод строки внутри значения) — запись продолжается следующей строкой.
+    """
+    lines, quotes = [], 0
+    async for line in _iter_lines(chunks):
+        if not lines and not line.strip(): continue
+        lines.append(line + "\n"); quotes += line.count('"')
+        if quotes % 2: continue
+        yield next(csv.reader(lines))
+        lines, quotes = [], 0
+    if lines: yield next(csv.reader(lines)) # Кавычка так и не закрылась — разбираем как есть
+
+async def _iter_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    header = None
+    row_no = 0
+    async for values in _iter_csv_records(chunks):
+        if header is None:
+            header = [name.strip() for name in values]; continue
+        row_no += 1
+        if len(values) != len(header):
+            yield row_no, None, f"Ожидалось {len(header)} колонок, получено {len(values)}"; continue
+        # Пустая ячейка — значит "не задано" (например, timestamp по умолчанию)
+        yield row_no, {key: (value if value != "" else None) for key, value in zip(header, values)}, None
+
+# Символы, меняющие структуру JSON вне строк и внутри строк
+_JSON_STRUCTURE = re.compile(r'[\[\]{}",]')
+_JSON_STRING_END = re.compile(r'["\\]')
+
+async def _iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    """
+    Элементы JSON-массива по мере поступления. Границы элементов (запятые верхнего уровня)
+    ищутся одним проходом с учетом вложенности и строк — каждый символ просматривается один
+    раз, сколько бы кусков ни пришло; затем элемент разбирается целиком. Битый или пустой
+    элемент — ошибка этой строки; ValueError — только если тело не JSON-массив или он оборван.
+    """
+    started = finished = in_string = escaped = False
+    depth, row_no, parts = 0, 0, []
+    def element(text: str, last: bool) -> Optional[Row]:
+        nonlocal row_no
+        text = text.strip()
+        if not text and last and row_no == 0: return None # Пустой массив
+        row_no += 1
+        return _parse_row(row_no, text) if text else (row_no, None, "Пустой элемент массива")
+    async for text in _iter_text(chunks):
+        if finished: continue
+        pos = 0
+        if not started:
+            stripped = text.lstrip()
+            if not stripped: continue
+            if stripped[0] != "[": raise ValueError("Ожидался JSON-массив")
+            started, pos = True, len(text) - len(stripped) + 1
+        start = pos
+        while pos < len(text):
+            if in_string:
+                if escaped:
+                    escaped, pos = False, pos + 1; continue
+                match = _JSON_STRING_END.search(text, pos)
+                if match is None: pos = len(text); break
+                pos = match.end()
+                if match.group() == "\\": escaped = True
+                else: in_string = False
+                continue
+            match = _JSON_STRUCTURE.search(text, pos)
+            if match is None: pos = len(text); break
+            char, pos = match.group(), match.end()
+            if char == '"': in_string = True
+            elif char in "[{": depth += 1
+            elif depth > 0 and char in "]}": depth -= 1
+            elif char == "," and depth == 0:
+                row = element("".join(parts) + text[start:pos - 1], last=False)
+                if row: yield row
+                parts, start = [], pos
+            elif char == "]" and depth == 0:
+                row = element("".join(parts) + text[start:pos - 1], last=True)
+                if row: yield row
+                parts, finished = [], True; break
+        if not finished: parts.append(text[start:pos])
+    if not finished: raise ValueError("Некорректный JSON-массив")
@@ -0,0 +1,157 @@
+# backend/app/jobs.py
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import String, cast, delete, literal, or_, select, update
+
+from . import extract, models, sharing, storage, sync
+from .config import settings
+from .database import AsyncSessionLocal
+
+# Фоновая обработка вложений: превью и извлечение текста.
+# Очередь хранится в таблице attachment_jobs, поэтому переживает перезапуск: задача,
+# взятая упавшим процессом, снова становится доступной, когда истекает ее аренда (lease).
+# Захват задачи — условный UPDATE, так что несколько воркеров не возьмут одну задачу дважды.
+# Упавшая задача возвращается в PENDING с locked_until в будущем (экспоненциальная пауза),
+# чтобы битый файл не сжигал все попытки подряд.
+
+logger = logging.getLogger(__name__)
+
+THUMB_DIR = "thumbs"
+
+PENDING, RUNNING, DONE, FAILED, SKIPPED = "pending", "running", "done", "failed", "skipped"
+
+def thumbnail_storage_path(sha256: str) -> str:
+    return os.path.join(THUMB_DIR, sha256[:2], f"{sha256}.jpg")
+
+def retry_delay(attempts: int) -> timedelta:
+    """Пауза перед следующей попыткой: ATTACHMENT_JOB_RETRY_SECONDS, 2x, 4x, ..."""
+    return timedelta(seconds=settings.ATTACHMENT_JOB_RETRY_SECONDS * 2 ** max(attempts - 1, 0))
+
+def enqueue_attachment(db, attachment: models.Attachment) -> None:
+    """Ставит вложение в очередь в рамках текущей транзакции."""
+    db.add(models.AttachmentJob(attachment=attachment, status=PENDING))
+
+class AttachmentProcessor:
+    def __init__(self):
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks = []
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def wake(self) -> None:
+        """Будит воркеры сразу после загрузки, не дожидаясь очередного опроса."""
+        if self._wakeup: self._wakeup.set()
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._pool = ProcessPoolExecutor(max_workers=settings.ATTACHMENT_WORKERS)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(settings.ATTACHMENT_WORKERS)]
+
+    async def stop(self) -> None:
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._pool: self._pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                job_id = await self._claim()
+                if job_id is None:
+                    self._wakeup.clear()
+                    try: await asyncio.wait_for(self._wakeup.wait(), timeout=settings.ATTACHMENT_JOB_POLL_SECONDS)
+                    except asyncio.TimeoutError: pass
+                    continue
+                await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Attachment worker error")
+                await asyncio.sleep(settings.ATTACHMENT_JOB_POLL_SECONDS)
+
+    async def _claim(self) -> Optional[int]:
+        now = datetime.utcnow()
+        Job = models.AttachmentJob
+        claimable = or_(
+            (Job.status == PENDING) & (Job.locked_until.is_(None) | (Job.locked_until <= now)), # Пауза после неудачи истекла
+            (Job.status == RUNNING) & (Job.locked_until < now), # Аренда упавшего воркера истекла
+        )
+        async with AsyncSessionLocal() as db:
+            candidates = (await db.scalars(select(models.AttachmentJob.id).where(claimable).order_by(models.AttachmentJob.id).limit(5))).all()
+            for job_id in candidates:
+                result = await db.execute(
+                    update(models.AttachmentJob)
+                    .where(models.AttachmentJob.id == job_id, claimable)
+                    .values(status=RUNNING, attempts=models.AttachmentJob.attempts + 1, updated_at=now,
+                            locked_until=now + timedelta(seconds=settings.ATTACHMENT_JOB_LEASE_SECONDS))
+                )
+                await db.commit()
+                if result.rowcount: return job_id
+        return None
+
+    async def _process(self, job_id: int) -> None:
+        async with AsyncSessionLocal() as db:
+            job = await db.get(models.AttachmentJob, job_id)
+            attachment = await db.get(models.Attachment, job.attachment_id) if job else None
+            if attachment is None:
+                if job: await db.delete(job); await db.commit()
+                return
+            source = storage.absolute_path(attachment.storage_path)
+            sha256, thumb_path = attachment.sha256, thumbnail_storage_path(attachment.sha256)
+            await db.commit() # Не держим транзакцию, пока файл обрабатывается
+            loop = asyncio.get_running_loop()
+            owner_ids = []
+            retry_at = None
+            try:
+                preview, text = await loop.run_in_executor(
+                    self._pool, extract.process_file, source, attachment.content_type,
+                    storage.absolute_path(thumb_path), settings.THUMBNAIL_SIZE,
+                )
+            except extract.MissingDependency as exc:
+                job.status, job.error = SKIPPED, f"Не установлено: {exc}"
+            except Exception as exc:
+                job.error = repr(exc)
+                job.status = FAILED if job.attempts >= settings.ATTACHMENT_JOB_MAX_ATTEMPTS else PENDING
+                if job.status == PENDING: retry_at = datetime.utcnow() + retry_delay(job.attempts)
+                logger.warning("Attachment job %s failed: %r", job_id, exc)
+            else:
+                now = datetime.utcnow()
+                # UPDATE блокирует строку: удаление последней записи с файлом либо дождется нас
+                # и увидит превью, либо уже удалило строку — тогда превью убираем сами
+                result = await db.execute(
+                    update(models.Attachment).where(models.Attachment.id == attachment.id)
+                    .values(thumbnail_path=thumb_path if preview else None, extracted_text=text, processed_at=now)
+                    .execution_options(synchronize_session=False)
+                )
+                if not result.rowcount:
+                    await db.rollback()
+                    await self._drop_orphan(db, job_id, sha256, thumb_path if preview else None)
+                    return
+                job.status, job.error = DONE, None
+                # Результат копируется во все записи с этим файлом — ленте не нужен JOIN.
+                # UPDATE в обход ORM, поэтому версии для /sync ставим сами (по версии на владельца)
+                owner_ids = (await db.scalars(select(models.Record.owner_id).where(models.Record.attachment_id == attachment.id).distinct())).all()
+                record_thumbnail_url = literal("/records/") + cast(models.Record.id, String) + literal("/attachment?variant=thumbnail")
+                for owner_id, version in (await sync.bump_versions(db, owner_ids, ["records"])).items():
+                    await db.execute(
+                        update(models.Record).where(models.Record.attachment_id == attachment.id, models.Record.owner_id == owner_id)
+                        .values(thumbnail_url=record_thumbnail_url if preview else None, attachment_text=text, sync_version=version, updated_at=now)
+                    )
+            job.locked_until = retry_at
+            job.updated_at = datetime.utcnow()
+            await db.commit()
+            for owner_id in owner_ids: sharing.invalidate_owner(owner_id) # В ленте появилось превью
+
+    async def _drop_orphan(self, db, job_id: int, sha256: str, thumb_path: Optional[str]) -> None:
+        """Вложение удалили во время обработки: превью никому не нужно, если тот же файл не загрузили заново."""
+        reuploaded = await db.scalar(select(models.Attachment.id).where(models.Attachment.sha256 == sha256))
+        if thumb_path and reuploaded is None: storage.delete_blob(thumb_path)
+        await db.execute(delete(models.AttachmentJob).where(models.AttachmentJob.id == job_id))
+        await db.commit()
+
+processor = AttachmentProcessor()
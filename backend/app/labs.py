@@ -0,0 +1,111 @@
+# backend/app/labs.py
+
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+# Разбор свободного текста результатов анализов ("7,2 %", "<0.5 мг/л", норма "4,0 – 6,0")
+# в числа для таблицы lab_results, и анализ ряда одного показателя за один проход.
+# Модуль чистый: ничего не знает о БД, чтобы им пользовались и crud, и backfill.
+
+_NUMBER = r"[-+]?\d+(?:[.,]\d+)?"
+_RESULT = re.compile(rf"^\s*(?P<qualifier>[<>≤≥]=?)?\s*(?P<value>{_NUMBER})\s*(?P<unit>[^\d\s/].*)?$")
+_RANGE = re.compile(rf"^\s*(?:от\s*)?(?P<low>{_NUMBER})\s*(?:-|–|—|\.\.\.?|до)\s*(?P<high>{_NUMBER})\s*(?P<unit>[^\d\s/].*)?$", re.IGNORECASE)
+_UPPER = re.compile(rf"^\s*(?:<=?|≤|до|менее)\s*(?P<high>{_NUMBER})\s*(?P<unit>[^\d\s].*)?$", re.IGNORECASE)
+_LOWER = re.compile(rf"^\s*(?:>=?|≥|от|более)\s*(?P<low>{_NUMBER})\s*(?P<unit>[^\d\s].*)?$", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+# Изменение меньше этой доли от среднего за весь период считаем стабильным
+STABLE_CHANGE_RATIO = 0.05
+
+@dataclass
+class ParsedLab:
+    value: float
+    unit: Optional[str]
+    qualifier: Optional[str] # "<" / ">" — результат за пределом чувствительности метода
+    ref_low: Optional[float]
+    ref_high: Optional[float]
+
+def _number(text: str) -> float:
+    return float(text.replace(",", "."))
+
+def _unit(text: Optional[str]) -> Optional[str]:
+    unit = (text or "").strip()
+    return unit or None
+
+def normalize_test_name(name: str) -> str:
+    """Ключ показателя для группировки: "HbA1c ", "hba1c" и "HBA1C" — один ряд."""
+    return _SPACES.sub(" ", name.strip().lower().replace("ё", "е"))
+
+def parse_result(text: Optional[str]) -> Optional[Tuple[float, Optional[str], Optional[str]]]:
+    """(значение, единица, "<"/">"/None) или None, если результат не числовой ("отрицательно", "120/80")."""
+    match = _RESULT.match(text or "")
+    if not match: return None
+    qualifier = match.group("qualifier")
+    if qualifier: qualifier = "<" if qualifier[0] in "<≤" else ">"
+    return _number(match.group("value")), _unit(match.group("unit")), qualifier
+
+def parse_reference_range(text: Optional[str]) -> Tuple[Optional[float], Optional[float], Optional[str]]:
+    """(нижняя граница, верхняя граница, единица); любая часть может отсутствовать."""
+    text = text or ""
+    match = _RANGE.match(text)
+    if match: return _number(match.group("low")), _number(match.group("high")), _unit(match.group("unit"))
+    match = _UPPER.match(text)
+    if match: return None, _number(match.group("high")), _unit(match.group("unit"))
+    match = _LOWER.match(text)
+    if match: return _number(match.group("low")), None, _unit(match.group("unit"))
+    return None, None, None
+
+def parse_lab(result: Optional[str], reference_range: Optional[str]) -> Optional[ParsedLab]:
+    parsed = parse_result(result)
+    if parsed is None: return None
+    value, unit, qualifier = parsed
+    low, high, range_unit = parse_reference_range(reference_range)
+    if unit and range_unit and _SPACES.sub("", unit.lower()) != _SPACES.sub("", range_unit.lower()):
+        low = high = None # Норма указана в других единицах — сравнивать с ней нельзя
+    return ParsedLab(value=value, unit=unit or range_unit, qualifier=qualifier, ref_low=low, ref_high=high)
+
+def flag(value: float, low: Optional[float], high: Optional[float]) -> Optional[str]:
+    if low is None and high is None: return None
+    if low is not None and value < low: return "low"
+    if high is not None and value > high: return "high"
+    return "normal"
+
+@dataclass
+class SeriesAnalysis:
+    flags: List[Optional[str]]
+    out_of_range: int
+    minimum: Optional[float]
+    maximum: Optional[float]
+    mean: Optional[float]
+    slope_per_year: Optional[float] # Наклон линейной регрессии, единиц в год
+    direction: Optional[str] # "up" / "down" / "stable"
+
+def analyze_series(dates: Sequence[datetime], values: Sequence[float], lows: Sequence[Optional[float]], highs: Sequence[Optional[float]]) -> SeriesAnalysis:
+    """
+    Один проход по ряду: флаги выхода за норму, min/max/среднее и накопление сумм
+    для наклона линейной регрессии значения по времени (x — годы от первой точки).
+    """
+    n = len(values)
+    flags, out_of_range = [], 0
+    minimum = maximum = None
+    sum_x = sum_y = sum_xx = sum_xy = 0.0
+    start = dates[0] if n else None
+    for date, value, low, high in zip(dates, values, lows, highs):
+        point_flag = flag(value, low, high)
+        flags.append(point_flag)
+        if point_flag in ("low", "high"): out_of_range += 1
+        if minimum is None or value < minimum: minimum = value
+        if maximum is None or value > maximum: maximum = value
+        x = (date - start).total_seconds() / (365.25 * 86400)
+        sum_x += x; sum_y += value; sum_xx += x * x; sum_xy += x * value
+    mean = sum_y / n if n else None
+    slope = direction = None
+    denominator = n * sum_xx - sum_x * sum_x
+    if n >= 2 and denominator > 1e-12:
+        slope = (n * sum_xy - sum_x * sum_y) / denominator
+        span = (dates[-1] - start).total_seconds() / (365.25 * 86400)
+        change = slope * span
+        direction = "stable" if abs(change) <= STABLE_CHANGE_RATIO * abs(mean or 0) else ("up" if change > 0 else "down")
+    return SeriesAnalysis(flags=flags, out_of_range=out_of_range, minimum=minimum, maximum=maximum, mean=mean, slope_per_year=slope, direction=direction)
@@ -1,41 +1,111 @@
 # backend/app/main.py
 
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.staticfiles import StaticFiles
 from datetime import timedelta, datetime
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Literal, Optional
 from jose import JWTError, jwt
-import shutil
+from pydantic import ValidationError
+import mimetypes
 import os
 
-from . import crud, models, schemas, security
-from .database import engine, get_db
+from . import crud, fastjson, fhir, httpcache, icd_index, ingest, jobs, labs, metrics, models, onboarding, refdata, rollups, scheduler, schemas, security, sharing, storage, sync
+from .fileserve import legacy_etag, serve_file
+from .downsample import lttb_indices
+from .database import AsyncSessionLocal, async_engine, engine, get_async_db, get_read_db, is_replica, read_engines, recent_writers
 from .config import settings
 
+# brotli — необязательная зависимость: без него ответы сжимаются gzip
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
 models.Base.metadata.create_all(bind=engine)
-app = FastAPI(title="MedData.KZ API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Фоновые воркеры обработки вложений живут вместе с приложением
+    if settings.ATTACHMENT_PROCESSING_ENABLED: jobs.processor.start()
+    # Индекс МКБ-10 строится заранее, чтобы первое автодополнение не ждало загрузки справочника
+    async with AsyncSessionLocal() as db: await icd_index.ensure_fresh(db)
+    # Планировщик напоминаний: после перезапуска сам догоняет пропущенное из reminders.next_fire_at
+    if settings.REMINDERS_ENABLED: scheduler.scheduler.start()
+    yield
+    await scheduler.scheduler.stop()
+    await jobs.processor.stop()
+
+app = FastAPI(title="MedData.KZ API", lifespan=lifespan)
 
 origins = ["*"]
 app.add_middleware(
-    CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor", "ETag"],
 )
 
-os.makedirs("uploads", exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Большие списки (лента, замеры) сжимаются. Вложения отдаются как есть: они уже сжаты,
+# отвечают на Range и уходят через sendfile с Content-Length
+if settings.COMPRESSION_MINIMUM_SIZE:
+    if BrotliMiddleware is not None: compression = dict(middleware=BrotliMiddleware, minimum_size=settings.COMPRESSION_MINIMUM_SIZE, gzip_fallback=True)
+    else: compression = dict(middleware=GZipMiddleware, minimum_size=settings.COMPRESSION_MINIMUM_SIZE, compresslevel=6)
+    app.add_middleware(httpcache.CompressionExcept, excluded=r"^/records/\d+/attachment$", **compression)
+
+# Метрики: длительность запросов и время в SQL по маршрутам, пул, кэши (см. metrics.py)
+if settings.METRICS_ENABLED:
+    metrics.instrument_engine(engine, "sync")
+    metrics.instrument_engine(async_engine.sync_engine, "async")
+    for index, read_engine in enumerate(read_engines): metrics.instrument_engine(read_engine.sync_engine, f"replica{index}")
+    metrics.register_cache("auth", security.get_auth_cache_stats)
+    metrics.register_cache("share_snapshots", sharing.get_snapshot_stats)
+    metrics.register_cache("read_your_writes", recent_writers.stats)
+    metrics.register_collector("meddata_reminders_planned", "Напоминания в куче планировщика", lambda: {(): scheduler.scheduler.stats()["planned"]})
+    app.add_middleware(metrics.MetricsMiddleware)
+
+# Файлы вложений не раздаются публично: только через /records/{id}/attachment с проверкой владельца
+os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+
+# --- Пагинация списков ---
+# Без `limit` эндпоинты отдают весь список, как раньше. С `limit` отдается одна страница,
+# а курсор следующей страницы приходит в заголовке X-Next-Cursor. Для лент по убыванию даты
+# он передается обратно в `before`, для напоминаний (по возрастанию времени) — в `after`.
+async def _paginate(response: Response, fetch, sort_attr: str, limit: Optional[int], before: Optional[str], after: Optional[str]):
+    try: items = await fetch(limit=limit, before=before, after=after)
+    except ValueError: raise HTTPException(status_code=400, detail="Некорректный курсор")
+    cursor = crud.next_cursor(items, sort_attr, limit)
+    if cursor: response.headers["X-Next-Cursor"] = cursor
+    return items
+
+# Быстрый путь для длинных лент (записи, замеры, жалобы): выбираются только колонки схемы ответа
+# и кодируются сразу в JSON, без ORM-объектов и валидации Pydantic на каждую строку (см. fastjson.py).
+# Ответ тот же, что дал бы response_model; курсор — в заголовке самого ответа.
+async def _paginate_rows(fetch, model, schema, sort_attr: str, limit: Optional[int], before: Optional[str], after: Optional[str], headers: Optional[dict] = None) -> Response:
+    try: rows = await fetch(columns=fastjson.columns(model, schema), limit=limit, before=before, after=after)
+    except ValueError: raise HTTPException(status_code=400, detail="Некорректный курсор")
+    cursor = crud.next_cursor(rows, sort_attr, limit)
+    headers = dict(headers or {})
+    if cursor: headers["X-Next-Cursor"] = cursor
+    return fastjson.rows_response(rows, fastjson.field_names(schema), headers=headers)
+
+# Условные GET: коллекции пользователя, от которых зависит ответ эндпоинта (см. httpcache.py)
+_COURSE_COLLECTIONS = ("courses", "records", "complaints")
+_LAB_COLLECTIONS = ("records", sync.LABS)
 
 # --- Эндпоинты аутентификации ---
 @app.post("/users/", response_model=schemas.User)
-def create_user_endpoint(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def create_user_endpoint(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await crud.get_user_by_email(db, email=user.email)
     if db_user: raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    return await crud.create_user(db=db, user=user)
 
 @app.post("/token", response_model=schemas.Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.authenticate_user(db, email=form_data.username, password=form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await crud.authenticate_user(db, email=form_data.username, password=form_data.password)
     if not user: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password", headers={"WWW-Authenticate": "Bearer"})
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(data={"sub": user.email}, expires_delta=access_token_expires)
@@ -43,167 +113,347 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
 
 # --- Эндпоинты для обмена данными ---
 @app.post("/share/generate-token", response_model=schemas.Token)
-def generate_sharing_token(current_user: models.User = Depends(security.get_current_active_user)):
-    token_data = {"sub": current_user.email, "scope": "sharing"}
-    token = security.create_access_token(data=token_data, expires_delta=timedelta(minutes=10))
-    return {"access_token": token, "token_type": "bearer"}
+async def generate_sharing_token(current_user: models.User = Depends(security.get_current_active_user)):
+    return {"access_token": security.create_sharing_token(current_user.email), "token_type": "bearer"}
 
+# Просмотр по ссылке отдается из кэша готовых снимков (см. sharing.py). Без параметров — все
+# разделы целиком, как раньше; ?sections=records,vitals и ?limit= позволяют грузить историю частями.
 @app.get("/share/view/{token}", response_model=schemas.SharedHealthData)
-def view_shared_data(token: str, db: Session = Depends(get_db)):
+async def view_shared_data(token: str, sections: Optional[str] = None, limit: Optional[int] = Query(None, ge=1, le=crud.MAX_PAGE_SIZE), records_before: Optional[str] = None, vitals_before: Optional[str] = None, db: AsyncSession = Depends(get_read_db)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Ссылка недействительна или срок ее действия истек")
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         email: Optional[str] = payload.get("sub"); scope: Optional[str] = payload.get("scope")
         if email is None or scope != "sharing": raise credentials_exception
     except JWTError: raise credentials_exception
-    user = crud.get_user_by_email(db, email=email)
-    if user is None: raise credentials_exception
-    profile = crud.get_profile_by_user_id(db, user_id=user.id)
-    if profile is None: raise HTTPException(status_code=404, detail="Профиль не найден")
-    records = crud.get_records_by_owner(db, owner_id=user.id)
-    vitals = crud.get_vitals_by_user(db, user_id=user.id)
-    return schemas.SharedHealthData(profile=profile, records=records, vitals=vitals)
+    try: wanted = sharing.parse_sections(sections)
+    except ValueError as exc: raise HTTPException(status_code=400, detail=str(exc))
+    key = (sharing.token_key(payload, token), wanted, limit, records_before, vitals_before)
+    body = sharing.get_snapshot(key)
+    if body is None:
+        user = await crud.get_user_by_email(db, email=email)
+        if user is None: raise credentials_exception
+        generation = sharing.owner_generation(user.id)
+        fields = {}
+        if "profile" in wanted:
+            fields["profile"] = await crud.get_profile_by_user_id(db, user_id=user.id)
+            if fields["profile"] is None: raise HTTPException(status_code=404, detail="Профиль не найден")
+        try:
+            if "records" in wanted:
+                records = await crud.get_records_by_owner(db, owner_id=user.id, limit=limit, before=records_before)
+                fields.update(records=records, next_records_cursor=crud.next_cursor(records, "date", limit))
+            if "vitals" in wanted:
+                vitals = await crud.get_vitals_by_user(db, user_id=user.id, limit=limit, before=vitals_before)
+                fields.update(vitals=vitals, next_vitals_cursor=crud.next_cursor(vitals, "timestamp", limit))
+        except ValueError: raise HTTPException(status_code=400, detail="Некорректный курсор")
+        body = schemas.SharedHealthData(**fields).json().encode()
+        # Снимок с реплики сразу после изменений пациента может быть отставшим — такой не кэшируем
+        if not (is_replica(db) and sharing.changed_within(user.id, settings.READ_YOUR_WRITES_SECONDS)):
+            sharing.put_snapshot(key, user.id, generation, body, payload["exp"])
+    return Response(content=body, media_type="application/json")
 
 # --- Эндпоинты для справочников ---
+# Справочники отдаются из кэша готовых ответов с ETag (см. refdata.py)
 @app.get("/allergies/", response_model=List[schemas.Allergy])
-def read_allergies(db: Session = Depends(get_db)): return crud.get_allergies(db)
+async def read_allergies(request: Request, db: AsyncSession = Depends(get_read_db)):
+    return await refdata.respond(request, db, refdata.ALLERGIES, crud.get_allergies, schemas.Allergy)
 
 @app.get("/chronic-diseases/", response_model=List[schemas.ChronicDisease])
-def read_chronic_diseases(db: Session = Depends(get_db)): return crud.get_chronic_diseases(db)
+async def read_chronic_diseases(request: Request, db: AsyncSession = Depends(get_read_db)):
+    return await refdata.respond(request, db, refdata.CHRONIC_DISEASES, crud.get_chronic_diseases, schemas.ChronicDisease)
 
 @app.get("/diagnoses/find-icd", response_model=List[schemas.ChronicDisease])
-def find_icd_code_by_text(q: str, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.find_diseases_by_name(db=db, query=q)
+async def find_icd_code_by_text(q: str, db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.find_diseases_by_name(db=db, query=q)
 
 # --- ЗАЩИЩЕННЫЕ ЭНДПОИНТЫ ---
-@app.get("/users/me/", response_model=schemas.User)
-def read_users_me(current_user: models.User = Depends(security.get_current_active_user)): return current_user
-
-@app.get("/profile/me", response_model=schemas.Profile)
-def read_user_profile(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    profile = crud.get_profile_by_user_id(db, user_id=current_user.id)
+@app.get("/users/me/", response_model=schemas.User, dependencies=[Depends(httpcache.conditional(sync.PROFILE))])
+async def read_users_me(db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    # Не из кэша аутентификации: он может отставать от версии, которой подписан ответ
+    return await crud.get_user_by_email(db, email=current_user.email)
+
+@app.put("/users/me/", response_model=schemas.User)
+async def update_users_me(user_update: schemas.UserUpdate, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    await crud.update_user(db, current_user.id, user_update)
+    return await crud.get_user_by_email(db, email=current_user.email)
+
+@app.get("/profile/me", response_model=schemas.Profile, dependencies=[Depends(httpcache.conditional(sync.PROFILE))])
+async def read_user_profile(db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    profile = await crud.get_profile_by_user_id(db, user_id=current_user.id)
     if profile is None: raise HTTPException(status_code=404, detail="Профиль не найден")
     return profile
 
 @app.put("/profile/me", response_model=schemas.Profile)
-def update_user_profile(profile_data: schemas.ProfileUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.create_or_update_profile(db=db, profile_data=profile_data, user_id=current_user.id)
+async def update_user_profile(profile_data: schemas.ProfileUpdate, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.create_or_update_profile(db=db, profile_data=profile_data, user_id=current_user.id)
 
 @app.get("/vitals/", response_model=List[schemas.VitalsRecord])
-def read_vitals_for_user(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)): return crud.get_vitals_by_user(db=db, user_id=current_user.id)
+async def read_vitals_for_user(limit: Optional[int] = Query(None, ge=1, le=crud.MAX_PAGE_SIZE), before: Optional[str] = None, after: Optional[str] = None, cache: dict = Depends(httpcache.conditional("vitals")), db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await _paginate_rows(lambda **page: crud.get_vitals_by_user(db=db, user_id=current_user.id, **page), models.VitalsRecord, schemas.VitalsRecord, "timestamp", limit, before, after, cache)
+
+@app.get("/vitals/series", response_model=schemas.VitalsSeries, dependencies=[Depends(httpcache.conditional("vitals"))])
+async def read_vitals_series(type: str, from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None, points: int = Query(500, ge=3, le=5000), db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    """Ряд одного типа замеров за [from, to), прореженный LTTB до `points` точек независимо от числа сырых строк."""
+    rows = await crud.get_vitals_series(db=db, user_id=current_user.id, vitals_type=type, start=from_, end=to)
+    timestamps = [row[0] for row in rows]
+    values = [row[1] for row in rows]
+    if len(rows) > points:
+        keep = lttb_indices([ts.timestamp() for ts in timestamps], values, points)
+        timestamps = [timestamps[i] for i in keep]
+        values = [values[i] for i in keep]
+    return schemas.VitalsSeries(type=type, total=len(rows), timestamps=timestamps, values=values)
+
+@app.get("/vitals/stats", response_model=schemas.VitalsStats, dependencies=[Depends(httpcache.conditional("vitals", sync.VITALS_ROLLUPS))])
+async def read_vitals_stats(type: str, from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None, interval: Optional[Literal["hour", "day", "week", "month"]] = None, db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    """Количество, min/max, среднее и СКО замеров за [from, to) и по интервалам — из агрегатов, без чтения всех замеров (см. rollups.py)."""
+    if from_ and to and rollups.to_utc(from_) >= rollups.to_utc(to): raise HTTPException(status_code=400, detail="from должен быть раньше to")
+    return await rollups.range_stats(db, current_user.id, type, from_, to, interval)
+
+# --- Анализы: числовые ряды из записей с результатами ---
+@app.get("/labs/tests", response_model=List[schemas.LabTest], dependencies=[Depends(httpcache.conditional(*_LAB_COLLECTIONS))])
+async def read_lab_tests(db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return [schemas.LabTest(test_name=row.test_name, count=row.count, last_date=row.last_date) for row in await crud.get_lab_tests(db=db, owner_id=current_user.id)]
+
+@app.get("/labs/trends", response_model=schemas.LabTrend, dependencies=[Depends(httpcache.conditional(*_LAB_COLLECTIONS))])
+async def read_lab_trend(test_name: str, from_: Optional[datetime] = Query(None, alias="from"), to: Optional[datetime] = None, db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    """Ряд показателя за [from, to) с флагами выхода за норму и линейным трендом. Точки в других единицах, чем последняя, не смешиваются."""
+    rows = await crud.get_lab_series(db=db, owner_id=current_user.id, test_name=test_name, start=from_, end=to)
+    if not rows: raise HTTPException(status_code=404, detail="Нет числовых результатов по этому анализу")
+    unit = rows[-1].unit
+    rows = [row for row in rows if row.unit == unit]
+    dates, values, lows, highs = [row.date for row in rows], [row.value for row in rows], [row.ref_low for row in rows], [row.ref_high for row in rows]
+    analysis = labs.analyze_series(dates, values, lows, highs)
+    return schemas.LabTrend(
+        test_name=rows[-1].test_name, unit=unit, dates=dates, values=values, ref_low=lows, ref_high=highs,
+        flags=analysis.flags, record_ids=[row.record_id for row in rows], out_of_range=analysis.out_of_range,
+        min=analysis.minimum, max=analysis.maximum, mean=analysis.mean, slope_per_year=analysis.slope_per_year, direction=analysis.direction,
+    )
 
 @app.post("/vitals/", response_model=schemas.VitalsRecord)
-def create_vitals_for_user(vitals_data: schemas.VitalsRecordCreate, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.create_vitals_record(db=db, vitals_data=vitals_data, user_id=current_user.id)
+async def create_vitals_for_user(vitals_data: schemas.VitalsRecordCreate, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.create_vitals_record(db=db, vitals_data=vitals_data, user_id=current_user.id)
+
+@app.post("/vitals/batch", response_model=schemas.VitalsBatchResult)
+async def create_vitals_batch_for_user(request: Request, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    """
+    Пакетная загрузка замеров: JSON-массив, NDJSON (application/x-ndjson) или CSV (text/csv)
+    с колонками type,value,unit,timestamp. Тело разбирается потоково, валидные строки пишутся
+    пачками в одной транзакции, невалидные пропускаются и перечисляются в `errors`.
+    """
+    inserted, failed, errors, chunk = 0, 0, [], []
+    try:
+        async for row_no, data, error in ingest.iter_payload_rows(request):
+            if error is None:
+                try: chunk.append(schemas.VitalsRecordCreate(**data))
+                except ValidationError as exc: error = ingest.format_validation_error(exc)
+            if error is not None:
+                failed += 1
+                if len(errors) < ingest.MAX_REPORTED_ERRORS: errors.append(schemas.VitalsBatchError(row=row_no, error=error))
+                continue
+            if len(chunk) >= crud.BULK_CHUNK_SIZE:
+                inserted += await crud.insert_vitals_chunk(db, chunk, current_user.id); chunk = []
+        inserted += await crud.insert_vitals_chunk(db, chunk, current_user.id)
+        await db.commit()
+        sharing.invalidate_owner(current_user.id)
+    except ValueError as exc:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=str(exc))
+    return schemas.VitalsBatchResult(inserted=inserted, failed=failed, errors=errors)
+
+# Блокировка и разблокировка пользователя; заблокированный теряет доступ сразу (кэш входа сбрасывается)
+@app.put("/admin/users/{user_id}/active", response_model=schemas.User)
+async def set_user_active(user_id: int, is_active: bool, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_admin_user)):
+    db_user = await crud.set_user_active(db=db, user_id=user_id, is_active=is_active)
+    if db_user is None: raise HTTPException(status_code=404, detail="Пользователь не найден")
+    return db_user
+
+# Массовый импорт пациентов клиники: тело — CSV, NDJSON или JSON-массив (как у /vitals/batch).
+# Все строки вставляются одной транзакцией; строки с ошибками пропускаются и перечисляются в ответе.
+@app.post("/admin/users/import", response_model=schemas.UserImportResult)
+async def import_users(request: Request, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_admin_user)):
+    try:
+        return await onboarding.import_patients(db, ingest.iter_payload_rows(request))
+    except ValueError as exc:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=str(exc))
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Импорт отменен: часть email зарегистрировали во время импорта, повторите его")
 
 @app.get("/records/", response_model=List[schemas.RecordForTimeline])
-def read_user_records(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.get_records_by_owner(db=db, owner_id=current_user.id)
+async def read_user_records(limit: Optional[int] = Query(None, ge=1, le=crud.MAX_PAGE_SIZE), before: Optional[str] = None, after: Optional[str] = None, cache: dict = Depends(httpcache.conditional("records")), db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await _paginate_rows(lambda **page: crud.get_records_by_owner(db=db, owner_id=current_user.id, **page), models.Record, schemas.RecordForTimeline, "date", limit, before, after, cache)
+
+# Поиск по записям: релевантные сначала. Следующая страница — offset + limit, если пришло ровно limit записей
+@app.get("/records/search", response_model=List[schemas.RecordForTimeline], dependencies=[Depends(httpcache.conditional("records"))])
+async def search_user_records(q: str = Query(..., min_length=1, max_length=200), limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0, le=1000), db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.search_records(db=db, owner_id=current_user.id, query=q, limit=limit, offset=offset)
 
 @app.post("/records/", response_model=schemas.RecordForTimeline)
-def create_user_record(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user), date: datetime = Form(...), resource_type: str = Form(...), course_id: Optional[int] = Form(None), doctor_name: Optional[str] = Form(None), clinic_name: Optional[str] = Form(None), patient_complaints: Optional[str] = Form(None), conclusion_text: Optional[str] = Form(None), diagnosis_code: Optional[str] = Form(None), medication_name: Optional[str] = Form(None), lab_name: Optional[str] = Form(None),
+async def create_user_record(db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user), date: datetime = Form(...), resource_type: str = Form(...), course_id: Optional[int] = Form(None), doctor_name: Optional[str] = Form(None), clinic_name: Optional[str] = Form(None), patient_complaints: Optional[str] = Form(None), conclusion_text: Optional[str] = Form(None), diagnosis_code: Optional[str] = Form(None), medication_name: Optional[str] = Form(None), lab_name: Optional[str] = Form(None),
     test_name: Optional[str] = Form(None),
     result: Optional[str] = Form(None),
     reference_range: Optional[str] = Form(None),
     file: Optional[UploadFile] = File(None)):
-    attachment_url_to_save = None
-    if file and file.filename:
-        file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"{current_user.id}_{int(datetime.now().timestamp())}{file_extension}"
-        file_path = os.path.join("uploads", unique_filename)
-        with open(file_path, "wb") as buffer: shutil.copyfileobj(file.file, buffer)
-        attachment_url_to_save = f"/uploads/{unique_filename}"
-    record_data = schemas.RecordCreate(date=date, resource_type=resource_type, doctor_name=doctor_name, clinic_name=clinic_name, patient_complaints=patient_complaints, conclusion_text=conclusion_text, diagnosis_code=diagnosis_code, medication_name=medication_name, attachment_url=attachment_url_to_save, lab_name=lab_name, test_name=test_name, result=result, reference_range=reference_range, course_id=course_id)
-    return crud.create_record(db=db, record=record_data, owner_id=current_user.id)
+    blob = await storage.save_upload(file) if file and file.filename else None
+    record_data = schemas.RecordCreate(date=date, resource_type=resource_type, doctor_name=doctor_name, clinic_name=clinic_name, patient_complaints=patient_complaints, conclusion_text=conclusion_text, diagnosis_code=diagnosis_code, medication_name=medication_name, lab_name=lab_name, test_name=test_name, result=result, reference_range=reference_range, course_id=course_id)
+    try:
+        db_record = await crud.create_record(db=db, record=record_data, owner_id=current_user.id, blob=blob)
+    finally:
+        if blob: storage.discard(blob)
+    if blob: jobs.processor.wake()
+    return db_record
 
 @app.put("/records/{record_id}", response_model=schemas.RecordForTimeline)
-def update_user_record(record_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user), date: datetime = Form(...), resource_type: str = Form(...), course_id: Optional[int] = Form(None), doctor_name: Optional[str] = Form(None), clinic_name: Optional[str] = Form(None), patient_complaints: Optional[str] = Form(None), conclusion_text: Optional[str] = Form(None), diagnosis_code: Optional[str] = Form(None), medication_name: Optional[str] = Form(None), lab_name: Optional[str] = Form(None),test_name: Optional[str] = Form(None),result: Optional[str] = Form(None),reference_range: Optional[str] = Form(None),attachment_url: Optional[str] = Form(None), file: Optional[UploadFile] = File(None)):
-    existing_record = crud.get_record_by_id(db=db, record_id=record_id, owner_id=current_user.id)
+async def update_user_record(record_id: int, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user), date: datetime = Form(...), resource_type: str = Form(...), course_id: Optional[int] = Form(None), doctor_name: Optional[str] = Form(None), clinic_name: Optional[str] = Form(None), patient_complaints: Optional[str] = Form(None), conclusion_text: Optional[str] = Form(None), diagnosis_code: Optional[str] = Form(None), medication_name: Optional[str] = Form(None), lab_name: Optional[str] = Form(None),test_name: Optional[str] = Form(None),result: Optional[str] = Form(None),reference_range: Optional[str] = Form(None),attachment_url: Optional[str] = Form(None), file: Optional[UploadFile] = File(None)):
+    existing_record = await crud.get_record_by_id(db=db, record_id=record_id, owner_id=current_user.id)
     if not existing_record: raise HTTPException(status_code=404, detail="Record not found or access denied")
     attachment_url_to_save = existing_record.attachment_url
-    if file and file.filename:
-        file_extension = os.path.splitext(file.filename)[1]
-        unique_filename = f"{current_user.id}_{int(datetime.now().timestamp())}{file_extension}"
-        file_path = os.path.join("uploads", unique_filename)
-        with open(file_path, "wb") as buffer: shutil.copyfileobj(file.file, buffer)
-        attachment_url_to_save = f"/uploads/{unique_filename}"
+    blob = await storage.save_upload(file) if file and file.filename else None
     record_data = schemas.RecordCreate(date=date, resource_type=resource_type, doctor_name=doctor_name, clinic_name=clinic_name, patient_complaints=patient_complaints, conclusion_text=conclusion_text, diagnosis_code=diagnosis_code, medication_name=medication_name, attachment_url=attachment_url_to_save,lab_name=lab_name, test_name=test_name, result=result, reference_range=reference_range, course_id=course_id)
-    updated_record = crud.update_record(db=db, record_id=record_id, owner_id=current_user.id, record_data=record_data)
+    try:
+        updated_record = await crud.update_record(db=db, record_id=record_id, owner_id=current_user.id, record_data=record_data, blob=blob)
+    finally:
+        if blob: storage.discard(blob)
     if updated_record is None: raise HTTPException(status_code=404, detail="Record not found or access denied")
+    if blob: jobs.processor.wake()
     return updated_record
 
 @app.delete("/records/{record_id}", response_model=schemas.RecordForTimeline)
-def delete_user_record(record_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    deleted_record = crud.delete_record(db=db, record_id=record_id, owner_id=current_user.id)
+async def delete_user_record(record_id: int, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    deleted_record = await crud.delete_record(db=db, record_id=record_id, owner_id=current_user.id)
     if deleted_record is None: raise HTTPException(status_code=404, detail="Record not found or access denied")
     return deleted_record
 
+# Ссылки и <img> не шлют заголовок Authorization: фронтенд берет здесь короткий токен на файлы
+# этой записи и передает его параметром ?access_token= (токен входа в URL не принимается)
+@app.post("/records/{record_id}/attachment-token", response_model=schemas.Token)
+async def issue_attachment_token(record_id: int, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    record = await crud.get_record_by_id(db=db, record_id=record_id, owner_id=current_user.id)
+    if not record or not record.attachment_url: raise HTTPException(status_code=404, detail="Attachment not found")
+    return {"access_token": security.create_attachment_token(current_user.email, record_id), "token_type": "bearer"}
+
+@app.api_route("/records/{record_id}/attachment", methods=["GET", "HEAD"])
+async def read_record_attachment(record_id: int, request: Request, variant: Literal["original", "thumbnail"] = "original", db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user_for_files)):
+    record = await crud.get_record_by_id(db=db, record_id=record_id, owner_id=current_user.id)
+    if not record: raise HTTPException(status_code=404, detail="Record not found or access denied")
+    if record.attachment_id:
+        attachment = await db.get(models.Attachment, record.attachment_id)
+        if variant == "thumbnail":
+            if not attachment.thumbnail_path: raise HTTPException(status_code=404, detail="Thumbnail not ready")
+            return serve_file(request, attachment.thumbnail_path, f'"{attachment.sha256}-thumb"', "image/jpeg")
+        return serve_file(request, attachment.storage_path, f'"{attachment.sha256}"', attachment.content_type)
+    # Старые вложения, сохраненные до хранилища блобов
+    legacy_path = storage.legacy_storage_path(record.attachment_url)
+    etag = legacy_etag(legacy_path) if legacy_path and variant == "original" else None
+    if not etag: raise HTTPException(status_code=404, detail="Attachment not found")
+    return serve_file(request, legacy_path, etag, mimetypes.guess_type(legacy_path)[0])
+
 # --- защищенный ЭНДПОИНТы ДЛЯ ЖАЛОБ ---
 
 @app.post("/complaints/", response_model=schemas.Complaint)
-def create_new_complaint(
+async def create_new_complaint(
     complaint: schemas.ComplaintCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: models.User = Depends(security.get_current_active_user)
 ):
     """Создать новую жалобу."""
-    return crud.create_complaint(db=db, complaint=complaint, owner_id=current_user.id)
+    return await crud.create_complaint(db=db, complaint=complaint, owner_id=current_user.id)
 
 @app.get("/complaints/", response_model=List[schemas.Complaint])
-def read_user_complaints(
-    db: Session = Depends(get_db),
+async def read_user_complaints(
+    limit: Optional[int] = Query(None, ge=1, le=crud.MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    cache: dict = Depends(httpcache.conditional("complaints")),
+    db: AsyncSession = Depends(get_read_db),
     current_user: models.User = Depends(security.get_current_active_user)
 ):
-    """Получить все жалобы текущего пользователя."""
-    return crud.get_complaints_by_owner(db=db, owner_id=current_user.id)
+    """Получить жалобы текущего пользователя (целиком или постранично)."""
+    return await _paginate_rows(lambda **page: crud.get_complaints_by_owner(db=db, owner_id=current_user.id, **page), models.Complaint, schemas.Complaint, "created_at", limit, before, after, cache)
 
 
 # --- Эндпоинты для напоминаний ---
-@app.get("/reminders/", response_model=List[schemas.Reminder])
-def read_user_reminders(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.get_reminders_by_owner(db=db, owner_id=current_user.id)
+@app.get("/reminders/", response_model=List[schemas.Reminder], dependencies=[Depends(httpcache.conditional("reminders"))])
+async def read_user_reminders(response: Response, limit: Optional[int] = Query(None, ge=1, le=crud.MAX_PAGE_SIZE), before: Optional[str] = None, after: Optional[str] = None, db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await _paginate(response, lambda **page: crud.get_reminders_by_owner(db=db, owner_id=current_user.id, **page), "time", limit, before, after)
 
 @app.post("/reminders/", response_model=schemas.Reminder)
-def create_new_reminder(reminder: schemas.ReminderCreate, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.create_reminder(db=db, reminder=reminder, owner_id=current_user.id)
+async def create_new_reminder(reminder: schemas.ReminderCreate, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.create_reminder(db=db, reminder=reminder, owner_id=current_user.id)
 
 @app.put("/reminders/{reminder_id}", response_model=schemas.Reminder)
-def update_existing_reminder(reminder_id: int, reminder_data: schemas.ReminderCreate, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    updated_reminder = crud.update_reminder(db=db, reminder_id=reminder_id, reminder_data=reminder_data, owner_id=current_user.id)
+async def update_existing_reminder(reminder_id: int, reminder_data: schemas.ReminderCreate, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    updated_reminder = await crud.update_reminder(db=db, reminder_id=reminder_id, reminder_data=reminder_data, owner_id=current_user.id)
     if updated_reminder is None: raise HTTPException(status_code=404, detail="Напоминание не найдено")
     return updated_reminder
 
 @app.delete("/reminders/{reminder_id}", response_model=schemas.Reminder)
-def delete_existing_reminder(reminder_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    deleted_reminder = crud.delete_reminder(db=db, reminder_id=reminder_id, owner_id=current_user.id)
-    if deleted__reminder is None: raise HTTPException(status_code=404, detail="Напоминание не найдено")
+async def delete_existing_reminder(reminder_id: int, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    deleted_reminder = await crud.delete_reminder(db=db, reminder_id=reminder_id, owner_id=current_user.id)
+    if deleted_reminder is None: raise HTTPException(status_code=404, detail="Напоминание не найдено")
     return deleted_reminder
 
 # --- НОВЫЕ ЭНДПОИНТЫ ДЛЯ КУРСОВ ЛЕЧЕНИЯ И ЖАЛОБ ---
 @app.post("/courses/", response_model=schemas.TreatmentCourse)
-def create_treatment_course_for_user(course: schemas.TreatmentCourseCreate, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.create_treatment_course(db=db, course=course, owner_id=current_user.id)
-
-@app.get("/courses/", response_model=List[schemas.TreatmentCourse])
-def read_courses_for_user(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.get_courses_by_owner(db=db, owner_id=current_user.id)
-
-@app.post("/complaints/", response_model=schemas.Complaint)
-def create_new_complaint(complaint: schemas.ComplaintCreate, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.create_complaint(db=db, complaint=complaint, owner_id=current_user.id)
+async def create_treatment_course_for_user(course: schemas.TreatmentCourseCreate, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.create_treatment_course(db=db, course=course, owner_id=current_user.id)
+
+@app.get("/courses/", response_model=List[schemas.TreatmentCourse], dependencies=[Depends(httpcache.conditional(*_COURSE_COLLECTIONS))])
+async def read_courses_for_user(db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.get_courses_by_owner(db=db, owner_id=current_user.id)
+
+# Список курсов без записей и жалоб (счетчики и даты), детали — по одному курсу
+@app.get("/courses/summary", response_model=List[schemas.TreatmentCourseSummary], dependencies=[Depends(httpcache.conditional(*_COURSE_COLLECTIONS))])
+async def read_course_summaries(db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await crud.get_course_summaries(db=db, owner_id=current_user.id)
+
+@app.get("/courses/{course_id}", response_model=schemas.TreatmentCourse, dependencies=[Depends(httpcache.conditional(*_COURSE_COLLECTIONS))])
+async def read_course(course_id: int, db: AsyncSession = Depends(get_read_db), current_user: models.User = Depends(security.get_current_active_user)):
+    course = await crud.get_course(db=db, course_id=course_id, owner_id=current_user.id)
+    if course is None: raise HTTPException(status_code=404, detail="Курс не найден")
+    return course
+
+# --- Инкрементальная синхронизация ---
+# Без since — полный снимок всех коллекций; дальше клиент передает полученный cursor и получает
+# только изменения и id удаленных объектов. Актуальному клиенту отвечает один запрос по PK (см. sync.py)
+@app.get("/sync", response_model=schemas.SyncChanges)
+async def sync_changes(since: Optional[str] = None, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    try: version = sync.decode_cursor(since) if since else None
+    except ValueError: raise HTTPException(status_code=400, detail="Некорректный курсор")
+    return Response(content=await sync.changes(db, current_user.id, version), media_type="application/json")
+
+# --- FHIR: выгрузка и загрузка всех данных пациента (перенос между клиниками) ---
+@app.get("/fhir/$export")
+async def export_fhir(current_user: models.User = Depends(security.get_current_active_user)):
+    """NDJSON, ресурс на строку; отдается потоком, читается серверными курсорами (см. fhir.py)."""
+    headers = {"Content-Disposition": f'attachment; filename="meddata-{current_user.id}.ndjson"'}
+    return StreamingResponse(fhir.iter_export(current_user.id), media_type=fhir.NDJSON_MEDIA_TYPE, headers=headers)
+
+@app.post("/fhir/$import", response_model=schemas.FhirImportResult)
+async def import_fhir(request: Request, source: str = Query(..., min_length=1, description="Метка клиники-источника: повторный импорт из нее обновляет, а не дублирует"), db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    """Тело — NDJSON ресурсов FHIR (как у /fhir/$export); применяется пачками, каждая — своя транзакция."""
+    try:
+        return await fhir.import_resources(db, current_user.id, ingest.iter_payload_rows(request), source)
+    except ValueError as exc:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=str(exc))
 
-@app.get("/complaints/", response_model=List[schemas.Complaint])
-def read_user_complaints(db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_active_user)):
-    return crud.get_complaints_by_owner(db=db, owner_id=current_user.id)
+# --- Метрики для Prometheus ---
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    if not settings.METRICS_ENABLED: raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # --- Служебный эндпоинт ---
 @app.get("/seed-initial-data")
-def seed_initial_data(db: Session = Depends(get_db)):
-    if db.query(models.Allergy).count() == 0:
+async def seed_initial_data(db: AsyncSession = Depends(get_async_db)):
+    if await db.scalar(select(func.count()).select_from(models.Allergy)) == 0:
         allergies_to_add = [ models.Allergy(name="Пенициллин"), models.Allergy(name="Аспирин"), models.Allergy(name="Пыльца растений"), models.Allergy(name="Шерсть животных"), models.Allergy(name="Орехи"), ]
-        db.add_all(allergies_to_add)
-    if db.query(models.ChronicDisease).count() == 0:
+        db.add_all(allergies_to_add); await refdata.bump_version(db, refdata.ALLERGIES)
+    if await db.scalar(select(func.count()).select_from(models.ChronicDisease)) == 0:
         diseases_to_add = [ models.ChronicDisease(name="Сахарный диабет 2 типа", icd10_code="E11"), models.ChronicDisease(name="Артериальная гипертензия", icd10_code="I10"), models.ChronicDisease(name="Бронхиальная астма", icd10_code="J45"), models.ChronicDisease(name="Хроническая болезнь почек (ХБП)", icd10_code="N18"), models.ChronicDisease(name="Ревматоидный артрит", icd10_code="M05"), models.ChronicDisease(name="Остеоартроз", icd10_code="M15"), models.ChronicDisease(name="Гастрит и дуоденит", icd10_code="K29"), ]
-        db.add_all(diseases_to_add)
-    db.commit()
+        db.add_all(diseases_to_add); await refdata.bump_version(db, refdata.CHRONIC_DISEASES)
+    await db.commit()
+    refdata.invalidate(); icd_index.invalidate()
     return {"status": "Initial data seeded successfully"}
\ No newline at end of file
@@ -0,0 +1,230 @@
+# backend/app/metrics.py
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import settings
+
+# Метрики приложения в текстовом формате Prometheus (GET /metrics), без внешних зависимостей.
+#  * MetricsMiddleware — гистограмма длительности запросов по шаблону маршрута ("/records/{record_id}"),
+#    а также число SQL-запросов и время в БД на каждый запрос: разница с общей длительностью —
+#    это ORM, сериализация и прочая работа приложения.
+#  * События движков SQLAlchemy считают запросы и их время и относят к текущему маршруту через
+#    contextvar (SQLAlchemy переносит контекст в greenlet асинхронного движка); запросы вне
+#    HTTP-запроса (фоновые воркеры, планировщик) идут под маршрутом "-".
+#  * Запросы дольше SLOW_QUERY_MS пишутся в лог с отпечатком: текст без литералов и с
+#    IN-списками, свернутыми в "(...)", — одинаковые по форме запросы дают один отпечаток.
+#  * Пул соединений, кэши и планировщик снимаются в момент чтения /metrics.
+# На запрос приходится несколько вызовов perf_counter и пара обновлений под блокировкой.
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды и штуки
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+NO_ROUTE = "-"
+UNMATCHED_ROUTE = "<unmatched>" # 404 по произвольным путям — одна метка, а не по метке на путь
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock: items = list(self._values.items())
+        for values, total in items: yield f"{self.name}{_format_labels(self.labels, values)} {_number(total)}"
+
+_LE_INF = 'le="+Inf"'
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values: Dict[Tuple[str, ...], list] = {} # метки -> [счетчики корзин..., сумма, число]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value) # Первая корзина с границей >= value
+        with self._lock:
+            row = self._values.get(label_values)
+            if row is None: row = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets): row[index] += 1
+            row[-2] += value; row[-1] += 1
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock: items = [(values, list(row)) for values, row in self._values.items()]
+        for values, row in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(self.labels, values, _LE_INF)} {row[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labels, values)} {_number(row[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labels, values)} {row[-1]}"
+
+REQUEST_DURATION = Histogram("meddata_http_request_duration_seconds", "Длительность HTTP-запроса", ("method", "route", "status"))
+REQUEST_DB_TIME = Histogram("meddata_http_request_db_seconds", "Суммарное время SQL-запросов за HTTP-запрос", ("method", "route"))
+REQUEST_DB_QUERIES = Histogram("meddata_http_request_db_queries", "Число SQL-запросов за HTTP-запрос", ("method", "route"), COUNT_BUCKETS)
+QUERY_DURATION = Histogram("meddata_db_query_duration_seconds", "Длительность SQL-запроса", ("route",), QUERY_BUCKETS)
+SLOW_QUERIES = Counter("meddata_db_slow_queries_total", "SQL-запросы дольше SLOW_QUERY_MS", ("route",))
+_METRICS = [REQUEST_DURATION, REQUEST_DB_TIME, REQUEST_DB_QUERIES, QUERY_DURATION, SLOW_QUERIES]
+
+# --- Учет SQL ---
+def _route(scope) -> str:
+    # Роутер Starlette кладет найденный маршрут в scope; до этого (и для 404) маршрута нет
+    return getattr(scope.get("route"), "path", None) or UNMATCHED_ROUTE
+
+class RequestStats:
+    __slots__ = ("scope", "queries", "db_seconds")
+    def __init__(self, scope):
+        self.scope, self.queries, self.db_seconds = scope, 0, 0.0
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("meddata_request_stats", default=None)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*(?:\?|%\(\w+\)s|:\w+|\$\d+|__\[POSTCOMPILE_\w+\])(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+|\$\d+|__\[POSTCOMPILE_\w+\]))*\s*\)")
+_SPACES = re.compile(r"\s+")
+
+def fingerprint(statement: str) -> Tuple[str, str]:
+    """(короткий хэш, нормализованный текст) запроса: литералы -> ?, списки параметров -> (...)."""
+    normalized = _SPACES.sub(" ", _IN_LISTS.sub("(...)", _LITERALS.sub("?", statement))).strip()
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("meddata_query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    starts = conn.info.get("meddata_query_start")
+    if not starts: return
+    elapsed = time.perf_counter() - starts.pop()
+    stats = _current.get()
+    route = _route(stats.scope) if stats is not None else NO_ROUTE
+    if stats is not None:
+        stats.queries += 1; stats.db_seconds += elapsed
+    QUERY_DURATION.observe(elapsed, route)
+    if settings.SLOW_QUERY_MS is not None and elapsed * 1000 >= settings.SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(route)
+        digest, normalized = fingerprint(statement)
+        logger.warning("Медленный запрос %.1f мс [%s] %s: %s", elapsed * 1000, digest, route, normalized[:settings.SLOW_QUERY_LOG_CHARS])
+
+def _handle_error(exception_context) -> None:
+    # Упавший запрос не доходит до after_cursor_execute — снимаем его отметку времени
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("meddata_query_start"): conn.info["meddata_query_start"].pop()
+
+_instrumented: List[Tuple[Engine, str]] = []
+
+def instrument_engine(engine: Engine, name: str) -> None:
+    """Подключает учет SQL и отдачу состояния пула к движку (для асинхронного — его sync_engine)."""
+    if any(known is engine for known, _ in _instrumented): return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+    _instrumented.append((engine, name))
+
+# --- Middleware ---
+class MetricsMiddleware:
+    """Чистый ASGI-middleware: в отличие от BaseHTTPMiddleware не буферизует тело и не создает задач."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send); return
+        stats, status = RequestStats(scope), 500
+        token = _current.set(stats)
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start": status = message["status"]
+            await send(message)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            route, method = _route(scope), scope["method"]
+            REQUEST_DURATION.observe(elapsed, method, route, str(status))
+            REQUEST_DB_TIME.observe(stats.db_seconds, method, route)
+            REQUEST_DB_QUERIES.observe(stats.queries, method, route)
+
+# --- Снимки состояния при чтении /metrics ---
+Samples = Dict[Tuple[Tuple[str, str], ...], float] # ((метка, значение), ...) -> число
+_collectors: List[Tuple[str, str, str, Callable[[], Samples]]] = []
+
+def register_collector(name: str, help: str, collect: Callable[[], Samples], type: str = "gauge") -> None:
+    """collect() вызывается при каждом чтении /metrics; type — "gauge" или "counter" (накопленные счетчики)."""
+    _collectors.append((name, help, type, collect))
+
+def _pool_stats() -> Samples:
+    values = {}
+    for engine, name in _instrumented:
+        pool = engine.pool
+        for state in ("size", "checkedin", "checkedout", "overflow"):
+            method = getattr(pool, state, None)
+            if method is not None: values[(("engine", name), ("state", state))] = max(method(), 0) # overflow у QueuePool отрицателен, пока пул не переполнен
+    return values
+
+register_collector("meddata_db_pool_connections", "Соединения пула по состояниям (size — размер пула)", _pool_stats)
+
+# Кэши процесса (cache.TTLCache.stats): попадания/промахи и заполненность
+_caches: List[Tuple[str, Callable[[], dict]]] = []
+
+def register_cache(name: str, stats: Callable[[], dict]) -> None:
+    _caches.append((name, stats))
+
+def _cache_lookups() -> Samples:
+    values = {}
+    for name, stats in _caches:
+        current = stats()
+        values[(("cache", name), ("result", "hit"))] = current["hits"]
+        values[(("cache", name), ("result", "miss"))] = current["misses"]
+    return values
+
+register_collector("meddata_cache_lookups_total", "Обращения к кэшам процесса", _cache_lookups, "counter")
+register_collector("meddata_cache_entries", "Заполненность кэшей процесса", lambda: {(("cache", name),): stats()["size"] for name, stats in _caches})
+
+def render() -> str:
+    lines = []
+    for metric in _METRICS: lines.extend(metric.collect())
+    for name, help, type, collect in _collectors:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        try: values = collect()
+        except Exception:
+            logger.exception("Metrics collector %s failed", name); continue
+        for labels, value in values.items():
+            names, label_values = tuple(key for key, _ in labels), tuple(value for _, value in labels)
+            lines.append(f"{name}{_format_labels(names, label_values)} {_number(value)}")
+    return "\n".join(lines) + "\n"
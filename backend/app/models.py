@@ -1,9 +1,9 @@
 # backend/app/models.py
-from sqlalchemy import Column, Integer, String, Float, DateTime, Text, ForeignKey, Boolean, Table, Date
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, ForeignKey, Boolean, Table, Date, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime
-from sqlalchemy import Time, ARRAY
+from sqlalchemy import Time, ARRAY, JSON
 
 user_allergy_association = Table('user_allergy_association', Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
@@ -16,6 +16,7 @@ user_disease_association = Table('user_disease_association', Base.metadata,
 
 class Reminder(Base):
     __tablename__ = "reminders"
+    __table_args__ = (Index("ix_reminders_owner_sync_version", "owner_id", "sync_version"),)
 
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
@@ -23,8 +24,14 @@ class Reminder(Base):
     title = Column(String, nullable=False) # Напр. "Выпить Витамин D" или "Замерить сахар"
     time = Column(Time, nullable=False) # Время напоминания, напр. 09:00
     # Дни недели для повторения: 0=Пн, 1=Вт, ..., 6=Вс
-    days_of_week = Column(ARRAY(Integer), nullable=True) 
+    # (в SQLite массивов нет — там тот же список хранится как JSON)
+    days_of_week = Column(ARRAY(Integer).with_variant(JSON(), "sqlite"), nullable=True)
     is_active = Column(Boolean, default=True)
+    # Ближайшее срабатывание в UTC (с учетом пояса владельца); NULL — выключено или уже отработало
+    next_fire_at = Column(DateTime, nullable=True, index=True)
+    # Для /sync: версия владельца при последнем изменении (см. sync.py)
+    sync_version = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
     
     owner = relationship("User")
 
@@ -38,6 +45,33 @@ class ChronicDisease(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
     icd10_code = Column(String, unique=True, nullable=True)
+    name_kk = Column(String, nullable=True) # Название на казахском (из справочника МКБ-10)
+
+class ReferenceDataVersion(Base):
+    """Номер версии справочника; растет при каждом изменении, по нему воркеры сверяют свои кэши."""
+    __tablename__ = "reference_data_versions"
+    name = Column(String, primary_key=True) # "allergies", "chronic_diseases"
+    version = Column(Integer, nullable=False, default=0)
+
+class VitalsRollup(Base):
+    """Сводка замеров одного типа за час или сутки UTC; ведется вместе с vitals_records (см. rollups.py)."""
+    __tablename__ = "vitals_rollups"
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    type = Column(String, primary_key=True)
+    granularity = Column(String, primary_key=True) # "hour" / "day"
+    bucket = Column(DateTime, primary_key=True) # Начало часа или суток
+    count = Column(Integer, nullable=False)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+    sum = Column(Float, nullable=False)
+    sum_sq = Column(Float, nullable=False) # Сумма квадратов — для дисперсии
+
+class CollectionVersion(Base):
+    """Версия коллекции пользователя для ETag: users.sync_version транзакции, последней менявшей коллекцию."""
+    __tablename__ = "collection_versions"
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    collection = Column(String, primary_key=True) # "records", "vitals", ..., "profile", "labs"
+    version = Column(Integer, nullable=False)
 
 class User(Base):
     __tablename__ = "users"
@@ -48,6 +82,9 @@ class User(Base):
     last_name = Column(String, nullable=True)
     birth_date = Column(Date, nullable=True)
     is_active = Column(Boolean, default=True)
+    timezone = Column(String, nullable=True) # IANA, напр. "Asia/Almaty"; NULL — DEFAULT_TIMEZONE
+    # Счетчик изменений данных пользователя: растет с каждой транзакцией, меняющей синхронизируемые коллекции
+    sync_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     records = relationship("Record", back_populates="owner")
     profile = relationship("Profile", back_populates="user", uselist=False)
@@ -60,16 +97,33 @@ class User(Base):
 
 class VitalsRecord(Base):
     __tablename__ = "vitals_records"
+    # Составные индексы под keyset-пагинацию ленты замеров и выборку ряда одного типа для графиков
+    __table_args__ = (
+        Index("ix_vitals_records_owner_timestamp", "owner_id", "timestamp", "id"),
+        Index("ix_vitals_records_owner_type_timestamp", "owner_id", "type", "timestamp"),
+        Index("ix_vitals_records_owner_sync_version", "owner_id", "sync_version"),
+        Index("ix_vitals_records_owner_external_id", "owner_id", "external_id", unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
     timestamp = Column(DateTime, default=datetime.utcnow)
     type = Column(String, index=True)
     value = Column(Float, nullable=False)
     unit = Column(String)
+    external_id = Column(String, nullable=True) # Id в системе-источнике при импорте FHIR (см. fhir.py)
+    # Для /sync: версия владельца при последнем изменении (см. sync.py)
+    sync_version = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
     owner = relationship("User", back_populates="vitals")
 
 class Record(Base):
     __tablename__ = "records"
+    # Составной индекс под keyset-пагинацию ленты здоровья
+    __table_args__ = (
+        Index("ix_records_owner_date", "owner_id", "date", "id"),
+        Index("ix_records_owner_sync_version", "owner_id", "sync_version"),
+        Index("ix_records_owner_external_id", "owner_id", "external_id", unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     resource_type = Column(String, nullable=False)
     date = Column(DateTime, nullable=False)
@@ -80,14 +134,68 @@ class Record(Base):
     diagnosis_code = Column(String, nullable=True)
     medication_name = Column(String, nullable=True)
     attachment_url = Column(String, nullable=True)
+    attachment_id = Column(Integer, ForeignKey("attachments.id"), nullable=True)
+    # Заполняются фоновой обработкой вложения
+    thumbnail_url = Column(String, nullable=True)
+    attachment_text = Column(Text, nullable=True)
     lab_name = Column(String, nullable=True)
     test_name = Column(String, nullable=True)
     result = Column(String, nullable=True)
     reference_range = Column(String, nullable=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
-    course_id = Column(Integer, ForeignKey("treatment_courses.id"), nullable=True)
+    course_id = Column(Integer, ForeignKey("treatment_courses.id"), nullable=True, index=True) # Индекс — для подгрузки курса
+    external_id = Column(String, nullable=True) # Id в системе-источнике при импорте FHIR (см. fhir.py)
+    # Для /sync: версия владельца при последнем изменении (см. sync.py)
+    sync_version = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
     owner = relationship("User", back_populates="records")
     course = relationship("TreatmentCourse", back_populates="records")
+    attachment = relationship("Attachment")
+
+class LabResult(Base):
+    """Числовой результат анализа, разобранный из текста записи (Record.result / reference_range)."""
+    __tablename__ = "lab_results"
+    # Ряд одного показателя пользователя читается одним диапазоном индекса
+    __table_args__ = (Index("ix_lab_results_owner_test_date", "owner_id", "test_key", "date"),)
+    id = Column(Integer, primary_key=True, index=True)
+    record_id = Column(Integer, ForeignKey("records.id", ondelete="CASCADE"), unique=True, nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    test_key = Column(String, nullable=False) # Нормализованное название показателя (labs.normalize_test_name)
+    test_name = Column(String, nullable=False) # Как ввел пользователь
+    date = Column(DateTime, nullable=False)
+    value = Column(Float, nullable=False)
+    unit = Column(String, nullable=True)
+    qualifier = Column(String, nullable=True) # "<" / ">"
+    ref_low = Column(Float, nullable=True)
+    ref_high = Column(Float, nullable=True)
+
+class Attachment(Base):
+    """Уникальный файл в хранилище вложений; один файл может быть прикреплен к нескольким записям."""
+    __tablename__ = "attachments"
+    id = Column(Integer, primary_key=True, index=True)
+    sha256 = Column(String(64), unique=True, index=True, nullable=False)
+    size = Column(Integer, nullable=False)
+    content_type = Column(String, nullable=True)
+    storage_path = Column(String, nullable=False) # Относительно UPLOAD_DIR
+    ref_count = Column(Integer, nullable=False, default=0) # Сколько записей ссылается на файл
+    created_at = Column(DateTime, default=datetime.utcnow)
+    thumbnail_path = Column(String, nullable=True) # Превью (тоже относительно UPLOAD_DIR)
+    extracted_text = Column(Text, nullable=True)
+    processed_at = Column(DateTime, nullable=True)
+
+class AttachmentJob(Base):
+    """Задача фоновой обработки вложения (очередь в БД, переживает перезапуск)."""
+    __tablename__ = "attachment_jobs"
+    __table_args__ = (Index("ix_attachment_jobs_status_id", "status", "id"),)
+    id = Column(Integer, primary_key=True, index=True)
+    attachment_id = Column(Integer, ForeignKey("attachments.id", ondelete="CASCADE"), nullable=False)
+    status = Column(String, nullable=False, default="pending") # pending / running / done / failed / skipped
+    attempts = Column(Integer, nullable=False, default=0)
+    locked_until = Column(DateTime, nullable=True) # Аренда задачи воркером; у PENDING — не брать раньше (пауза после неудачи)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    attachment = relationship("Attachment")
 
 class Profile(Base):
     __tablename__ = "profiles"
@@ -123,23 +231,42 @@ class Profile(Base):
 
 class TreatmentCourse(Base):
     __tablename__ = "treatment_courses"
+    __table_args__ = (Index("ix_treatment_courses_owner_sync_version", "owner_id", "sync_version"),)
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
     name = Column(String, nullable=False)
     start_date = Column(Date, nullable=True)
     status = Column(String, default="active")
+    # Для /sync: версия владельца при последнем изменении (см. sync.py)
+    sync_version = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
     owner = relationship("User", back_populates="courses")
     records = relationship("Record", back_populates="course")
     complaints = relationship("Complaint", back_populates="course")
 
 class Complaint(Base):
     __tablename__ = "complaints"
+    __table_args__ = (Index("ix_complaints_owner_created_at", "owner_id", "created_at", "id"), Index("ix_complaints_owner_sync_version", "owner_id", "sync_version"))
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
-    course_id = Column(Integer, ForeignKey("treatment_courses.id"), nullable=True)
+    course_id = Column(Integer, ForeignKey("treatment_courses.id"), nullable=True, index=True)
     complaint_text = Column(Text, nullable=False)
     start_date = Column(Date, nullable=True)
     status = Column(String, default="active")
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Для /sync: версия владельца при последнем изменении (см. sync.py)
+    sync_version = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
     owner = relationship("User", back_populates="complaints")
-    course = relationship("TreatmentCourse", back_populates="complaints")
\ No newline at end of file
+    course = relationship("TreatmentCourse", back_populates="complaints")
+
+class SyncTombstone(Base):
+    """След удаленного объекта синхронизируемой коллекции: клиент узнает об удалении через /sync."""
+    __tablename__ = "sync_tombstones"
+    __table_args__ = (Index("ix_sync_tombstones_owner_sync_version", "owner_id", "sync_version"),)
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    collection = Column(String, nullable=False) # "records", "vitals", ...
+    object_id = Column(Integer, nullable=False)
+    sync_version = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,50 @@
+# backend/app/onboarding.py
+
+import asyncio
+from typing import AsyncIterator, List, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, ingest, passwords, schemas
+from .config import settings
+
+# Массовый импорт пациентов клиники (CLI и админский эндпоинт).
+# Порядок: разбор и проверка всех строк -> отсев уже зарегистрированных email ->
+# параллельное хэширование паролей вне транзакции -> одна транзакция на вставку.
+# Импорт либо проходит целиком, либо не оставляет в БД ничего (кроме ошибок по строкам,
+# которые просто пропускаются и перечисляются в ответе).
+
+async def hash_passwords(plain_passwords: List[str]) -> List[str]:
+    """
+    Хэширует пароли в общем пуле процессов, держа в нем не больше PASSWORD_HASH_WORKERS задач
+    импорта одновременно — входы и регистрации пользователей не ждут за всем списком.
+    """
+    limit = asyncio.Semaphore(max(settings.PASSWORD_HASH_WORKERS, 1))
+    async def hash_one(password: str) -> str:
+        async with limit:
+            while True:
+                try: return await passwords.hash_password_async(password)
+                except passwords.HasherBusyError: await asyncio.sleep(0.05) # Очередь занята запросами API
+    return await asyncio.gather(*(hash_one(password) for password in plain_passwords))
+
+async def import_patients(db: AsyncSession, rows: AsyncIterator[ingest.Row]) -> schemas.UserImportResult:
+    patients: List[Tuple[int, schemas.PatientImport]] = []
+    errors: List[schemas.UserImportError] = []
+    seen, failed = set(), 0
+    async for row_no, data, error in rows:
+        if error is None:
+            try: patient = schemas.PatientImport(**data)
+            except ValidationError as exc: error = ingest.format_validation_error(exc)
+        if error is None and patient.email in seen: error = "Email повторяется в файле"
+        if error is not None:
+            failed += 1
+            if len(errors) < ingest.MAX_REPORTED_ERRORS: errors.append(schemas.UserImportError(row=row_no, error=error))
+            continue
+        seen.add(patient.email); patients.append((row_no, patient))
+    existing = await crud.get_existing_emails(db, [patient.email for _, patient in patients])
+    await db.rollback() # Чтение открыло транзакцию: закрываем ее и отдаем соединение в пул на время хэширования
+    new_patients = [patient for _, patient in patients if patient.email not in existing]
+    hashed = await hash_passwords([patient.password for patient in new_patients])
+    created = await crud.create_users_bulk(db, new_patients, hashed) if new_patients else 0
+    return schemas.UserImportResult(created=created, skipped=len(patients) - len(new_patients), failed=failed, errors=errors)
@@ -0,0 +1,95 @@
+# backend/app/passwords.py
+
+import asyncio
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+from .config import settings
+
+# Модуль намеренно ничего не импортирует из приложения, кроме настроек:
+# он же загружается в процессах пула хэширования.
+
+# Стоимость bcrypt задается настройкой. Хэши с другой стоимостью считаются устаревшими
+# (needs_update) и прозрачно пересчитываются при следующем успешном входе.
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto",
+    bcrypt__rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
+
+class HasherBusyError(Exception):
+    """Очередь на хэширование заполнена — запрос нужно отклонить, а не ждать."""
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+# Ограничение на число задач в работе и в очереди пула
+_slots = threading.BoundedSemaphore(max(settings.PASSWORD_HASH_MAX_PENDING, 1))
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS)
+    return _pool
+
+def _submit(fn, *args) -> Future:
+    """
+    Отправляет bcrypt в отдельный процесс пула, чтобы он не занимал API.
+    Если в очереди уже PASSWORD_HASH_MAX_PENDING задач, сразу бросает HasherBusyError.
+    """
+    if not _slots.acquire(blocking=False):
+        raise HasherBusyError()
+    try:
+        future = _get_pool().submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+# Синхронный вызов держит свой поток все время bcrypt. Эндпоинты ждут через _run_async
+# (wrap_future, без потока); синхронные обертки — для скриптов, и чтобы случайный вызов
+# из sync-зависимости не выел пул потоков AnyIO (40), одновременно их ждет не больше стольких
+_SYNC_MAX_WAITERS = 8
+_sync_waiters = threading.BoundedSemaphore(_SYNC_MAX_WAITERS)
+
+def _run(fn, *args):
+    # При PASSWORD_HASH_WORKERS = 0 считаем в текущем потоке (удобно для тестов и скриптов)
+    if settings.PASSWORD_HASH_WORKERS <= 0:
+        return fn(*args)
+    if not _sync_waiters.acquire(blocking=False):
+        raise HasherBusyError()
+    try:
+        return _submit(fn, *args).result()
+    finally:
+        _sync_waiters.release()
+
+async def _run_async(fn, *args):
+    # Ожидание результата не держит ни поток, ни цикл событий
+    if settings.PASSWORD_HASH_WORKERS <= 0:
+        return await asyncio.to_thread(fn, *args)
+    return await asyncio.wrap_future(_submit(fn, *args))
+
+def hash_password(password: str) -> str:
+    return _run(_hash, password)
+
+def verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """(пароль верный, новый хэш или None, если пересчет не нужен)."""
+    return _run(_verify_and_update, password, hashed_password)
+
+async def hash_password_async(password: str) -> str:
+    return await _run_async(_hash, password)
+
+async def verify_and_update_async(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return await _run_async(_verify_and_update, password, hashed_password)
@@ -0,0 +1,72 @@
+# backend/app/refdata.py
+
+import asyncio
+import hashlib
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import Request, Response
+from pydantic import BaseModel
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .config import settings
+
+# Кэш справочников (аллергии, хронические заболевания): готовые байты JSON и сильный ETag
+# от их содержимого. Каждое изменение справочника увеличивает его версию в таблице
+# reference_data_versions в той же транзакции. Воркер сверяет версии одним маленьким
+# запросом не чаще раза в REFERENCE_DATA_VERSION_CHECK_SECONDS, а между проверками
+# отвечает вообще без запросов; клиенту с актуальным ETag уходит пустой 304.
+
+ALLERGIES = "allergies"
+CHRONIC_DISEASES = "chronic_diseases"
+
+# Данные общие для всех, но клиент должен перепроверять их при каждом показе
+CACHE_CONTROL = "public, no-cache"
+
+_entries: Dict[str, Tuple[int, str, bytes]] = {} # имя -> (версия, ETag, тело)
+_versions: Dict[str, int] = {}
+_checked_at: Optional[float] = None
+_lock = asyncio.Lock()
+
+async def bump_version(db: AsyncSession, name: str) -> None:
+    """Увеличивает версию справочника в текущей транзакции. После коммита вызовите invalidate()."""
+    stmt = update(models.ReferenceDataVersion).where(models.ReferenceDataVersion.name == name).values(version=models.ReferenceDataVersion.version + 1)
+    if (await db.execute(stmt)).rowcount: return
+    try:
+        async with db.begin_nested():
+            db.add(models.ReferenceDataVersion(name=name, version=1))
+    except IntegrityError:
+        await db.execute(stmt) # Строку версии параллельно создал другой запрос
+
+def invalidate() -> None:
+    """Заставляет этот воркер сверить версии при следующем запросе, не дожидаясь интервала."""
+    global _checked_at
+    _checked_at = None
+
+async def _refresh_versions(db: AsyncSession) -> None:
+    global _checked_at
+    if _checked_at is not None and time.monotonic() - _checked_at < settings.REFERENCE_DATA_VERSION_CHECK_SECONDS: return
+    rows = (await db.execute(select(models.ReferenceDataVersion.name, models.ReferenceDataVersion.version))).all()
+    _versions.clear(); _versions.update(rows)
+    _checked_at = time.monotonic()
+
+async def respond(request: Request, db: AsyncSession, name: str, load: Callable[[AsyncSession], Awaitable[list]], schema: BaseModel) -> Response:
+    """Ответ для справочника `name`: 304 по If-None-Match или закэшированные байты списка `schema`."""
+    await _refresh_versions(db)
+    version = _versions.get(name, 0)
+    entry = _entries.get(name)
+    if entry is None or entry[0] != version:
+        async with _lock:
+            entry = _entries.get(name)
+            if entry is None or entry[0] != version:
+                items = await load(db)
+                body = ("[" + ",".join(schema.from_orm(item).json() for item in items) + "]").encode()
+                entry = _entries[name] = (version, f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+    _, etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,226 @@
+# backend/app/rollups.py
+
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, delete, event, func, inspect, or_, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import models, schemas, sync
+
+# Агрегаты замеров (vitals_rollups): count, min, max, sum и сумма квадратов по
+# (владелец, тип, корзина) за час и за сутки UTC. Из них собирается статистика за любой
+# диапазон (GET /vitals/stats): внутренние сутки — суточными корзинами, края — часовыми,
+# неполные часы по краям — сырыми замерами. Цена запроса зависит от числа корзин, а не замеров.
+# Агрегаты ведутся в той же транзакции, что и замеры: новые ORM-замеры прибавляются в after_flush
+# (UPSERT), измененные и удаленные пересчитывают свои корзины по сырым строкам; вставки в обход
+# ORM (insert_vitals_chunk) вызывают add_readings сами. Починка и первое заполнение — backfill
+# (python -m app.cli backfill-vitals-rollups).
+
+HOUR, DAY, WEEK, MONTH = "hour", "day", "week", "month"
+INTERVALS = (HOUR, DAY, WEEK, MONTH)
+_STEPS = {HOUR: timedelta(hours=1), DAY: timedelta(days=1)}
+BACKFILL_BATCH_SIZE = 10000
+
+Key = Tuple[int, str, str, datetime] # (владелец, тип, гранулярность, начало корзины)
+Reading = Tuple[int, str, datetime, float] # (владелец, тип, время, значение)
+
+class Stats:
+    """Сводка по набору замеров, которую можно складывать; дисперсия — из суммы квадратов."""
+    __slots__ = ("count", "min", "max", "sum", "sum_sq")
+
+    def __init__(self, count: int = 0, min: float = math.inf, max: float = -math.inf, sum: float = 0.0, sum_sq: float = 0.0):
+        self.count, self.min, self.max, self.sum, self.sum_sq = count, min, max, sum, sum_sq
+
+    def add(self, value: float) -> None:
+        self.count += 1; self.sum += value; self.sum_sq += value * value
+        if value < self.min: self.min = value
+        if value > self.max: self.max = value
+
+    def merge(self, other: "Stats") -> None:
+        self.count += other.count; self.sum += other.sum; self.sum_sq += other.sum_sq
+        if other.min < self.min: self.min = other.min
+        if other.max > self.max: self.max = other.max
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    @property
+    def stddev(self) -> Optional[float]:
+        """Выборочное СКО; для одного замера не определено."""
+        if self.count < 2: return None
+        return math.sqrt(max(self.sum_sq - self.sum * self.sum / self.count, 0.0) / (self.count - 1))
+
+def to_utc(value: datetime) -> datetime:
+    """Наивное UTC, как хранятся даты в БД."""
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+def floor(value: datetime, granularity: str) -> datetime:
+    value = to_utc(value).replace(minute=0, second=0, microsecond=0)
+    return value if granularity == HOUR else value.replace(hour=0)
+
+def _ceil(value: datetime, granularity: str) -> datetime:
+    start = floor(value, granularity)
+    return start if start == value else start + _STEPS[granularity]
+
+def interval_start(value: datetime, interval: str) -> datetime:
+    """Начало интервала ответа (недели — с понедельника, UTC)."""
+    if interval in _STEPS: return floor(value, interval)
+    day = floor(value, DAY)
+    return day - timedelta(days=day.weekday()) if interval == WEEK else day.replace(day=1)
+
+# --- Ведение агрегатов ---
+def aggregate(readings: Iterable[Reading], into: Optional[Dict[Key, Stats]] = None) -> Dict[Key, Stats]:
+    """Часовые и суточные сводки замеров (добавляются к `into`, если он передан)."""
+    result = {} if into is None else into
+    for owner_id, vitals_type, timestamp, value in readings:
+        for granularity in _STEPS:
+            key = (owner_id, vitals_type, granularity, floor(timestamp, granularity))
+            stats = result.get(key)
+            if stats is None: stats = result[key] = Stats()
+            stats.add(value)
+    return result
+
+def _rows(aggregates: Dict[Key, Stats]) -> List[dict]:
+    return [{"owner_id": owner_id, "type": vitals_type, "granularity": granularity, "bucket": bucket, "count": stats.count,
+             "min": stats.min, "max": stats.max, "sum": stats.sum, "sum_sq": stats.sum_sq}
+            for (owner_id, vitals_type, granularity, bucket), stats in aggregates.items()]
+
+# INSERT ... ON CONFLICT DO UPDATE и функции min/max двух аргументов для поддерживаемых СУБД
+_UPSERTS = {"postgresql": (postgresql_insert, func.least, func.greatest), "sqlite": (sqlite_insert, func.min, func.max)}
+
+def upsert(conn, aggregates: Dict[Key, Stats]) -> None:
+    """Прибавляет сводки к корзинам одним executemany; несуществующие корзины создаются."""
+    if not aggregates: return
+    make_insert, least, greatest = _UPSERTS[conn.dialect.name]
+    table = models.VitalsRollup.__table__
+    stmt = make_insert(table)
+    stmt = stmt.on_conflict_do_update(index_elements=[column.name for column in table.primary_key], set_={
+        "count": table.c.count + stmt.excluded.count, "sum": table.c.sum + stmt.excluded.sum, "sum_sq": table.c.sum_sq + stmt.excluded.sum_sq,
+        "min": least(table.c.min, stmt.excluded.min), "max": greatest(table.c.max, stmt.excluded.max),
+    })
+    conn.execute(stmt, _rows(aggregates))
+
+def _rebuild(conn, keys: Iterable[Key]) -> None:
+    """Пересчитывает корзины по сырым замерам — после изменения или удаления (min/max не вычесть)."""
+    Rollup, Vitals = models.VitalsRollup, models.VitalsRecord
+    for owner_id, vitals_type, granularity, bucket in keys:
+        conn.execute(delete(Rollup).where(Rollup.owner_id == owner_id, Rollup.type == vitals_type, Rollup.granularity == granularity, Rollup.bucket == bucket))
+        values = conn.scalars(select(Vitals.value).where(Vitals.owner_id == owner_id, Vitals.type == vitals_type, Vitals.timestamp >= bucket, Vitals.timestamp < bucket + _STEPS[granularity])).all()
+        if not values: continue
+        stats = Stats()
+        for value in values: stats.add(value)
+        conn.execute(Rollup.__table__.insert(), _rows({(owner_id, vitals_type, granularity, bucket): stats}))
+
+_READING_FIELDS = ("owner_id", "type", "timestamp", "value")
+
+def _keys(reading: Reading) -> List[Key]:
+    owner_id, vitals_type, timestamp, _ = reading
+    return [(owner_id, vitals_type, granularity, floor(timestamp, granularity)) for granularity in _STEPS]
+
+def _committed_reading(obj: models.VitalsRecord) -> Reading:
+    """Замер, каким он был до этого flush (для измененных и удаленных)."""
+    attrs = inspect(obj).attrs
+    return tuple(attrs[name].history.deleted[0] if attrs[name].history.deleted else getattr(obj, name) for name in _READING_FIELDS)
+
+@event.listens_for(Session, "after_flush")
+def _track_vitals(session: Session, flush_context) -> None:
+    # После flush строки уже в БД, а new/dirty/deleted и история атрибутов — еще как до него
+    added, stale = [], set()
+    for obj in session.new:
+        if type(obj) is models.VitalsRecord: added.append(obj)
+    for obj in session.dirty:
+        if type(obj) is models.VitalsRecord and any(inspect(obj).attrs[name].history.has_changes() for name in _READING_FIELDS):
+            stale.update(_keys(_committed_reading(obj)))
+            stale.update(_keys(tuple(getattr(obj, name) for name in _READING_FIELDS)))
+    for obj in session.deleted:
+        if type(obj) is models.VitalsRecord: stale.update(_keys(_committed_reading(obj)))
+    if not (added or stale): return
+    conn = session.connection()
+    if stale: _rebuild(conn, stale)
+    # Корзины, пересчитанные по сырым строкам, уже учитывают и новые замеры
+    new_readings = aggregate(tuple(getattr(obj, name) for name in _READING_FIELDS) for obj in added)
+    upsert(conn, {key: stats for key, stats in new_readings.items() if key not in stale})
+
+async def add_aggregates(db: AsyncSession, aggregates: Dict[Key, Stats]) -> None:
+    if aggregates: await db.run_sync(lambda session: upsert(session.connection(), aggregates))
+
+async def add_readings(db: AsyncSession, readings: Iterable[Reading]) -> None:
+    """Для вставок замеров в обход ORM: прибавляет их к агрегатам в текущей транзакции."""
+    await add_aggregates(db, aggregate(readings))
+
+async def backfill(db: AsyncSession, owner_ids: Optional[Iterable[int]] = None, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """
+    Пересобирает агрегаты владельцев (по умолчанию — всех) по сырым замерам; каждый владелец —
+    своя транзакция. Строка владельца блокируется (bump_versions) — параллельные вставки его
+    замеров ждут, и агрегаты не разойдутся с данными. Возвращает число корзин.
+    """
+    Rollup, Vitals = models.VitalsRollup, models.VitalsRecord
+    if owner_ids is None: owner_ids = (await db.scalars(select(Vitals.owner_id).union(select(Rollup.owner_id)))).all()
+    total = 0
+    for owner_id in owner_ids:
+        await sync.bump_versions(db, [owner_id], [sync.VITALS_ROLLUPS])
+        await db.execute(delete(Rollup).where(Rollup.owner_id == owner_id))
+        aggregates: Dict[Key, Stats] = {}
+        stmt = select(Vitals.owner_id, Vitals.type, Vitals.timestamp, Vitals.value).where(Vitals.owner_id == owner_id)
+        async for rows in (await db.stream(stmt.execution_options(yield_per=batch_size))).partitions():
+            aggregate(rows, aggregates)
+        await add_aggregates(db, aggregates)
+        await db.commit()
+        total += len(aggregates)
+    return total
+
+# --- Статистика за диапазон ---
+def _cover(start: datetime, end: datetime, interval: Optional[str]) -> Tuple[List[Tuple[str, datetime, datetime]], List[Tuple[datetime, datetime]]]:
+    """
+    Разбивает [start, end) на корзины: ([(гранулярность, от, до), ...], [(от, до) сырых замеров]).
+    Для почасовой разбивки суточные корзины не берутся — они шире интервала ответа.
+    """
+    buckets, raw, hour_spans = [], [], [(start, end)]
+    if interval != HOUR:
+        first_day, last_day = _ceil(start, DAY), floor(end, DAY)
+        if first_day < last_day:
+            buckets.append((DAY, first_day, last_day)); hour_spans = [(start, first_day), (last_day, end)]
+    for low, high in hour_spans:
+        if low >= high: continue
+        first_hour, last_hour = _ceil(low, HOUR), floor(high, HOUR)
+        if first_hour < last_hour:
+            buckets.append((HOUR, first_hour, last_hour)); raw.extend(span for span in ((low, first_hour), (last_hour, high)) if span[0] < span[1])
+        else: raw.append((low, high))
+    return buckets, raw
+
+async def range_stats(db: AsyncSession, owner_id: int, vitals_type: str, start: Optional[datetime] = None, end: Optional[datetime] = None, interval: Optional[str] = None) -> schemas.VitalsStats:
+    """Сводка замеров одного типа за [start, end) и, если задан interval, по интервалам — не больше трех запросов."""
+    Rollup, Vitals = models.VitalsRollup, models.VitalsRecord
+    buckets, raw = _cover(to_utc(start) if start else datetime.min, to_utc(end) if end else floor(datetime.max, DAY), interval)
+    pieces: List[Tuple[datetime, Stats]] = []
+    for granularity in _STEPS:
+        spans = [and_(Rollup.bucket >= low, Rollup.bucket < high) for bucket_granularity, low, high in buckets if bucket_granularity == granularity]
+        if not spans: continue
+        stmt = (select(Rollup.bucket, Rollup.count, Rollup.min, Rollup.max, Rollup.sum, Rollup.sum_sq)
+                .where(Rollup.owner_id == owner_id, Rollup.type == vitals_type, Rollup.granularity == granularity, or_(*spans)))
+        pieces.extend((bucket, Stats(*values)) for bucket, *values in await db.execute(stmt))
+    if raw:
+        stmt = select(Vitals.timestamp, Vitals.value).where(Vitals.owner_id == owner_id, Vitals.type == vitals_type, or_(*(and_(Vitals.timestamp >= low, Vitals.timestamp < high) for low, high in raw)))
+        for timestamp, value in await db.execute(stmt):
+            stats = Stats(); stats.add(value)
+            pieces.append((timestamp, stats))
+    total, by_interval = Stats(), {}
+    for timestamp, stats in pieces:
+        total.merge(stats)
+        if interval:
+            key = interval_start(timestamp, interval)
+            if key not in by_interval: by_interval[key] = Stats()
+            by_interval[key].merge(stats)
+    series = [(key, by_interval[key]) for key in sorted(by_interval)]
+    return schemas.VitalsStats(
+        type=vitals_type, interval=interval, count=total.count,
+        min=total.min if total.count else None, max=total.max if total.count else None, mean=total.mean, stddev=total.stddev,
+        starts=[key for key, _ in series], counts=[stats.count for _, stats in series], mins=[stats.min for _, stats in series],
+        maxs=[stats.max for _, stats in series], means=[stats.mean for _, stats in series], stddevs=[stats.stddev for _, stats in series],
+    )
@@ -0,0 +1,263 @@
+# backend/app/scheduler.py
+
+import asyncio
+import heapq
+import importlib
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Protocol, Sequence, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy import or_, select, tuple_, update
+
+from . import models, sync
+from .config import settings
+from .database import AsyncSessionLocal
+
+# Планировщик напоминаний внутри процесса приложения.
+# Источник истины — колонка reminders.next_fire_at (UTC): ее пересчитывает crud при каждом
+# изменении и сам планировщик после срабатывания, поэтому перезапуск ничего не теряет.
+# В памяти держится только min-куча ближайших срабатываний (окно REMINDER_HORIZON_SECONDS,
+# не больше REMINDER_MAX_PLANNED штук) — память не зависит от общего числа напоминаний.
+# Куча дочитывается из БД по индексу next_fire_at только за пределами уже загруженного окна,
+# плюс просроченные строки — это и есть догон после простоя.
+# Срабатывание — условный UPDATE по паре (id, next_fire_at), так что при нескольких воркерах
+# каждое напоминание доставляется один раз тем, кто успел первым. Доставка — после коммита
+# (не больше одного раза): упавший sink не приводит к повторной рассылке.
+
+logger = logging.getLogger(__name__)
+
+_ONE_MICROSECOND = timedelta(microseconds=1)
+
+def utcnow() -> datetime:
+    return datetime.utcnow()
+
+def zone(name: Optional[str]) -> ZoneInfo:
+    """Часовой пояс пользователя; пустой или неизвестный — пояс по умолчанию."""
+    if name:
+        try: return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError): logger.warning("Неизвестный часовой пояс %r", name)
+    return ZoneInfo(settings.DEFAULT_TIMEZONE)
+
+def next_fire_time(at: time, days_of_week: Optional[Sequence[int]], tz: ZoneInfo, after: datetime) -> datetime:
+    """
+    Первое срабатывание строго позже `after` (UTC без tzinfo, как все даты в БД) в наивном UTC.
+    Время и дни недели — местные для пояса `tz`; пустой список дней — однократное напоминание
+    (ближайшее такое время в любой день).
+    """
+    local_after = after.replace(tzinfo=timezone.utc).astimezone(tz)
+    days = set(days_of_week or range(7))
+    start: date = local_after.date()
+    for offset in range(8):
+        day = start + timedelta(days=offset)
+        if day.weekday() not in days: continue
+        # Несуществующее из-за перевода часов время zoneinfo сам сдвигает на величину перевода
+        fire_at = datetime.combine(day, at.replace(tzinfo=None), tzinfo=tz).astimezone(timezone.utc).replace(tzinfo=None)
+        if fire_at > after: return fire_at
+    raise ValueError(f"Некорректные дни недели: {days_of_week!r}")
+
+def plan_reminder(reminder: models.Reminder, timezone_name: Optional[str], after: Optional[datetime] = None) -> None:
+    """Пересчитывает next_fire_at напоминания (выключенное не планируется)."""
+    reminder.next_fire_at = next_fire_time(reminder.time, reminder.days_of_week, zone(timezone_name), after or utcnow()) if reminder.is_active else None
+
+# --- Доставка ---
+@dataclass
+class ReminderNotification:
+    reminder_id: int
+    owner_id: int
+    title: str
+    fire_at: datetime # Плановое время срабатывания, UTC
+    local_time: datetime # То же время в поясе пользователя
+    late_seconds: float # Насколько позже плана доставлено (после простоя — заметно больше нуля)
+
+class ReminderSink(Protocol):
+    async def deliver(self, notifications: List[ReminderNotification]) -> None: ...
+
+class LoggingSink:
+    """Sink по умолчанию: только пишет в лог. Настоящая отправка (push, SMS) подключается через REMINDER_SINK."""
+    async def deliver(self, notifications: List[ReminderNotification]) -> None:
+        for item in notifications:
+            logger.info("Напоминание %s пользователю %s: %s (%s, опоздание %.3f с)", item.reminder_id, item.owner_id, item.title, item.local_time.isoformat(), item.late_seconds)
+
+class MemorySink:
+    """Локальная замена для тестов и отладки: копит доставленные уведомления в списке."""
+    def __init__(self):
+        self.delivered: List[ReminderNotification] = []
+    async def deliver(self, notifications: List[ReminderNotification]) -> None:
+        self.delivered.extend(notifications)
+
+def load_sink(path: str) -> ReminderSink:
+    """Создает sink по пути вида "пакет.модуль:Класс"."""
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)()
+
+def _log_unplannable(reminder_id: int, exc: ValueError) -> None:
+    logger.warning("Напоминание %s выключено, его нельзя запланировать: %s", reminder_id, exc)
+
+# --- Планировщик ---
+class ReminderScheduler:
+    def __init__(self, sink: Optional[ReminderSink] = None):
+        self.sink = sink
+        self._heap: List[Tuple[datetime, int]] = []
+        self._planned: Dict[int, datetime] = {} # id -> актуальное время в куче; остальные записи кучи устарели
+        self._loaded_until: Optional[datetime] = None # Все срабатывания до этого момента уже в куче
+        self._truncated = False # Окно не влезло в REMINDER_MAX_PLANNED
+        self._next_refill_at: Optional[datetime] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.sink is None: self.sink = load_sink(settings.REMINDER_SINK)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = self._wakeup = None
+        self._heap, self._planned, self._loaded_until, self._truncated, self._next_refill_at = [], {}, None, False, None
+
+    def plan(self, reminder_id: int, fire_at: Optional[datetime]) -> None:
+        """Учитывает изменение напоминания после коммита; fire_at=None — удалено или выключено."""
+        if self._wakeup is None: return # Планировщик в этом процессе не запущен (CLI, REMINDERS_ENABLED=false)
+        self._planned.pop(reminder_id, None)
+        if fire_at is None or self._loaded_until is None or fire_at > self._loaded_until: return # Подхватит дочитка окна
+        if len(self._planned) >= settings.REMINDER_MAX_PLANNED:
+            self._loaded_until = fire_at - _ONE_MICROSECOND; self._truncated = True; return
+        self._push(reminder_id, fire_at)
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {"planned": len(self._planned), "heap": len(self._heap), "loaded_until": self._loaded_until, "truncated": self._truncated}
+
+    def _push(self, reminder_id: int, fire_at: datetime) -> None:
+        self._planned[reminder_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, reminder_id))
+        if len(self._heap) > 2 * len(self._planned) + 1024: # Слишком много устаревших записей — пересобираем
+            self._heap = [(at, rid) for rid, at in self._planned.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_due(self, now: datetime) -> List[Tuple[int, datetime]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, reminder_id = heapq.heappop(self._heap)
+            if self._planned.get(reminder_id) == fire_at:
+                del self._planned[reminder_id]
+                due.append((reminder_id, fire_at))
+        return due
+
+    async def _run(self) -> None:
+        unscheduled_planned = False
+        while True:
+            try:
+                if not unscheduled_planned:
+                    await self._plan_unscheduled(); unscheduled_planned = True
+                self._wakeup.clear()
+                now = utcnow()
+                if self._next_refill_at is None or now >= self._next_refill_at or (self._truncated and len(self._planned) < settings.REMINDER_MAX_PLANNED // 2):
+                    await self._refill(now)
+                due = self._pop_due(now)
+                if due:
+                    await self._fire(due, now); continue
+                timeout = (self._next_refill_at - now).total_seconds()
+                if self._heap: timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                try: await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError: pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Reminder scheduler error")
+                await asyncio.sleep(1)
+
+    async def _plan_unscheduled(self) -> None:
+        """Проставляет next_fire_at включенным напоминаниям, созданным до появления планировщика."""
+        while True:
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(
+                    select(models.Reminder, models.User.timezone).join(models.User, models.User.id == models.Reminder.owner_id)
+                    .where(models.Reminder.is_active.is_(True), models.Reminder.next_fire_at.is_(None))
+                    .limit(settings.REMINDER_FIRE_BATCH_SIZE)
+                )).all()
+                if not rows: return
+                for reminder, timezone_name in rows:
+                    try: plan_reminder(reminder, timezone_name)
+                    except ValueError as exc: _log_unplannable(reminder.id, exc); reminder.is_active = False # Иначе строка попадала бы в каждую пачку
+                await db.commit()
+
+    async def _refill(self, now: datetime) -> None:
+        until = now + timedelta(seconds=settings.REMINDER_HORIZON_SECONDS)
+        self._next_refill_at = now + timedelta(seconds=settings.REMINDER_REFILL_SECONDS)
+        room = settings.REMINDER_MAX_PLANNED - len(self._planned)
+        if room <= 0: return
+        Reminder = models.Reminder
+        stmt = select(Reminder.id, Reminder.next_fire_at).where(Reminder.is_active.is_(True), Reminder.next_fire_at <= until)
+        if self._loaded_until is not None:
+            # Новое за пределами загруженного окна + просроченное, которое никто не отправил
+            # (изменено процессом без планировщика или воркер лежал)
+            missed = now - timedelta(seconds=settings.REMINDER_MISSED_AFTER_SECONDS)
+            stmt = stmt.where(or_(Reminder.next_fire_at > self._loaded_until, Reminder.next_fire_at < missed))
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(stmt.order_by(Reminder.next_fire_at, Reminder.id).limit(room))).all()
+        for reminder_id, fire_at in rows:
+            if self._planned.get(reminder_id) != fire_at: self._push(reminder_id, fire_at)
+        self._truncated = len(rows) == room
+        # Строки с тем же временем, что и последняя, могли не влезть — следующая дочитка начнет с него
+        self._loaded_until = rows[-1][1] - _ONE_MICROSECOND if self._truncated else until
+
+    async def _fire(self, due: List[Tuple[int, datetime]], now: datetime) -> None:
+        for start in range(0, len(due), settings.REMINDER_FIRE_BATCH_SIZE):
+            notifications = await self._claim(due[start:start + settings.REMINDER_FIRE_BATCH_SIZE], now)
+            if not notifications: continue
+            try: await self.sink.deliver(notifications)
+            except Exception: logger.exception("Reminder sink failed, %s notifications lost", len(notifications))
+
+    async def _claim(self, due: Iterable[Tuple[int, datetime]], now: datetime) -> List[ReminderNotification]:
+        """
+        Забирает срабатывания одной транзакцией: UPDATE с RETURNING блокирует строки, у которых
+        next_fire_at все еще равен ожидаемому (иначе напоминание изменили или его уже отправил
+        другой воркер), затем все они разом переводятся на следующее срабатывание.
+        """
+        Reminder = models.Reminder
+        due = list(due)
+        async with AsyncSessionLocal() as db:
+            # Версии для /sync — до захвата напоминаний: строки пользователей блокируются раньше
+            # строк напоминаний, в том же порядке, что и в транзакциях API (иначе возможна взаимоблокировка)
+            owner_ids = (await db.scalars(select(Reminder.owner_id).where(Reminder.id.in_([reminder_id for reminder_id, _ in due])).distinct())).all()
+            versions = await sync.bump_versions(db, owner_ids, ["reminders"])
+            claimed = (await db.execute(
+                update(Reminder)
+                .where(tuple_(Reminder.id, Reminder.next_fire_at).in_(due), Reminder.is_active.is_(True))
+                .values(next_fire_at=Reminder.next_fire_at)
+                .returning(Reminder.id, Reminder.owner_id, Reminder.title, Reminder.time, Reminder.days_of_week, Reminder.next_fire_at)
+                .execution_options(synchronize_session=False)
+            )).all()
+            if not claimed:
+                await db.rollback(); return []
+            owner_ids = {row.owner_id for row in claimed}
+            zones = {owner_id: zone(name) for owner_id, name in (await db.execute(select(models.User.id, models.User.timezone).where(models.User.id.in_(owner_ids)))).all()}
+            changes, notifications = [], []
+            catchup = timedelta(seconds=settings.REMINDER_CATCHUP_SECONDS)
+            for row in claimed:
+                tz = zones.get(row.owner_id) or zone(None)
+                change = {"id": row.id, "next_fire_at": None, "is_active": False} # Однократное
+                if row.days_of_week:
+                    try: change = {"id": row.id, "next_fire_at": next_fire_time(row.time, row.days_of_week, tz, max(row.next_fire_at, now))}
+                    except ValueError as exc: _log_unplannable(row.id, exc) # Остальная пачка срабатывает как обычно
+                change.update(sync_version=versions.get(row.owner_id), updated_at=now)
+                changes.append(change)
+                late = now - row.next_fire_at
+                if late > catchup: continue # Пропущено слишком давно — не шлем, только переносим на следующий раз
+                notifications.append(ReminderNotification(
+                    reminder_id=row.id, owner_id=row.owner_id, title=row.title, fire_at=row.next_fire_at,
+                    local_time=row.next_fire_at.replace(tzinfo=timezone.utc).astimezone(tz), late_seconds=late.total_seconds(),
+                ))
+            await db.execute(update(Reminder), [{"is_active": True, **change} for change in changes])
+            await db.commit()
+        for change in changes: self.plan(change["id"], change["next_fire_at"])
+        skipped = len(changes) - len(notifications)
+        if skipped: logger.info("Пропущено %s давно просроченных напоминаний", skipped)
+        return notifications
+
+scheduler = ReminderScheduler()
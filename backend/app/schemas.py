@@ -1,12 +1,14 @@
 # backend/app/schemas.py
 
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, validator
+from typing import Dict, Optional, List
 from datetime import datetime, date
 from datetime import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 # --- Базовая конфигурация для всех схем ---
 class _BaseConfig:
     orm_mode = True
+    from_attributes = True # То же самое для Pydantic v2 (orm_mode там только переименован)
 
 # --- Схемы для Справочников ---
 class Allergy(BaseModel):
@@ -18,6 +20,7 @@ class ChronicDisease(BaseModel):
     id: int
     name: str
     icd10_code: Optional[str] = None
+    name_kk: Optional[str] = None
     class Config(_BaseConfig): pass
 
 # --- Схемы для Замеров (Vitals) ---
@@ -34,6 +37,61 @@ class VitalsRecord(VitalsRecordBase):
     owner_id: int
     class Config(_BaseConfig): pass
 
+class VitalsBatchError(BaseModel):
+    row: int # Номер строки в загруженном файле, с 1
+    error: str
+
+class VitalsBatchResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[VitalsBatchError] = []
+
+class VitalsSeries(BaseModel):
+    """Прореженный ряд одного типа замеров в колоночном виде (для графиков)."""
+    type: str
+    total: int # Сколько сырых замеров попало в диапазон
+    timestamps: List[datetime]
+    values: List[float]
+
+class VitalsStats(BaseModel):
+    """Сводка замеров одного типа за диапазон (из часовых и суточных агрегатов) и разбивка по интервалам в колоночном виде."""
+    type: str
+    interval: Optional[str] = None # "hour" / "day" / "week" / "month"; без него — только итог
+    count: int
+    min: Optional[float] = None
+    max: Optional[float] = None
+    mean: Optional[float] = None
+    stddev: Optional[float] = None # Выборочное; нет для одного замера
+    starts: List[datetime] = [] # Начала интервалов (UTC, недели — с понедельника); пустые не выводятся
+    counts: List[int] = []
+    mins: List[float] = []
+    maxs: List[float] = []
+    means: List[float] = []
+    stddevs: List[Optional[float]] = []
+
+# --- Схемы для Анализов (числовые результаты) ---
+class LabTest(BaseModel):
+    test_name: str
+    count: int
+    last_date: datetime
+
+class LabTrend(BaseModel):
+    """Ряд одного показателя в колоночном виде + флаги выхода за норму и тренд."""
+    test_name: str
+    unit: Optional[str] = None # Единица последнего результата; ряд и тренд — только в ней
+    dates: List[datetime]
+    values: List[float]
+    ref_low: List[Optional[float]]
+    ref_high: List[Optional[float]]
+    flags: List[Optional[str]] # "low" / "high" / "normal" / null (норма не указана)
+    record_ids: List[int]
+    out_of_range: int
+    min: Optional[float] = None
+    max: Optional[float] = None
+    mean: Optional[float] = None
+    slope_per_year: Optional[float] = None
+    direction: Optional[str] = None # "up" / "down" / "stable"
+
 # --- Схемы для Записей в ленте ---
 class RecordBase(BaseModel):
     date: datetime
@@ -54,6 +112,7 @@ class RecordCreate(RecordBase): pass
 
 class RecordForTimeline(RecordBase):
     id: int
+    thumbnail_url: Optional[str] = None # Легкое превью вложения, появляется после фоновой обработки
     class Config(_BaseConfig): pass
 
 # --- Схемы для Профиля ---
@@ -105,6 +164,14 @@ class UserUpdate(BaseModel):
     first_name: Optional[str] = None
     last_name: Optional[str] = None
     birth_date: Optional[date] = None
+    timezone: Optional[str] = None # IANA, напр. "Asia/Almaty"; по нему срабатывают напоминания
+
+    @validator("timezone")
+    def _known_timezone(cls, value):
+        if value is None: return value
+        try: ZoneInfo(value)
+        except (ZoneInfoNotFoundError, ValueError): raise ValueError("Неизвестный часовой пояс")
+        return value
 
 class UserCreate(UserBase):
     password: str
@@ -118,10 +185,34 @@ class UserCreate(UserBase):
 class User(UserBase):
     id: int
     is_active: bool
+    timezone: Optional[str] = None
     allergies: List[Allergy] = []
     chronic_diseases: List[ChronicDisease] = []
     class Config(_BaseConfig): pass
 
+# --- Массовый импорт пациентов ---
+class PatientImport(UserBase, ProfileBase):
+    """Строка импорта: пользователь и его профиль. Аллергии — по названию, заболевания — по названию или коду МКБ-10."""
+    password: str
+    allergies: List[str] = []
+    chronic_diseases: List[str] = []
+
+    @validator("allergies", "chronic_diseases", pre=True)
+    def _split_names(cls, value):
+        # В CSV список приходит одной ячейкой: "Пенициллин; Орехи"
+        if isinstance(value, str): return [name.strip() for name in value.split(";") if name.strip()]
+        return value or []
+
+class UserImportError(BaseModel):
+    row: int # Номер строки в загруженном файле, с 1
+    error: str
+
+class UserImportResult(BaseModel):
+    created: int
+    skipped: int # Email уже зарегистрирован
+    failed: int
+    errors: List[UserImportError] = []
+
 # --- Схемы для Жалоб ---
 class ComplaintBase(BaseModel):
     complaint_text: str
@@ -147,23 +238,33 @@ class TokenData(BaseModel):
     email: Optional[str] = None
 
 class SharedHealthData(BaseModel):
-    profile: Profile
-    records: List[RecordForTimeline]
-    vitals: List[VitalsRecord]
+    # Разделы, не запрошенные через ?sections=, приходят как null
+    profile: Optional[Profile] = None
+    records: Optional[List[RecordForTimeline]] = None
+    vitals: Optional[List[VitalsRecord]] = None
+    # Курсоры следующих страниц при ?limit= (передаются в records_before / vitals_before)
+    next_records_cursor: Optional[str] = None
+    next_vitals_cursor: Optional[str] = None
     class Config(_BaseConfig): pass
     
 class ReminderBase(BaseModel):
     title: str
     time: time
-    days_of_week: List[int] # Список дней недели [0, 1, 2, 3, 4, 5, 6]
+    days_of_week: List[int] # Список дней недели [0, 1, 2, 3, 4, 5, 6]; пустой — однократно
     is_active: bool = True
 
+    @validator("days_of_week")
+    def _valid_days(cls, value):
+        if any(day < 0 or day > 6 for day in value): raise ValueError("Дни недели: 0 (Пн) ... 6 (Вс)")
+        return sorted(set(value))
+
 class ReminderCreate(ReminderBase):
     pass
 
 class Reminder(ReminderBase):
     id: int
     owner_id: int
+    next_fire_at: Optional[datetime] = None # UTC
 
     class Config:
         orm_mode = True
@@ -179,3 +280,39 @@ class TreatmentCourse(TreatmentCourseBase):
     records: List[RecordForTimeline] = []
     complaints: List[Complaint] = [] # <-- Добавлено
     class Config(_BaseConfig): pass
+
+class TreatmentCourseItem(TreatmentCourseBase):
+    """Курс без вложенных коллекций (для /sync)."""
+    id: int; owner_id: int
+    class Config(_BaseConfig): pass
+
+class TreatmentCourseSummary(TreatmentCourseBase):
+    """Курс для списка: счетчики и даты вместо самих записей и жалоб."""
+    id: int; owner_id: int
+    records_count: int = 0
+    complaints_count: int = 0
+    first_record_date: Optional[datetime] = None
+    last_record_date: Optional[datetime] = None
+    last_activity_at: Optional[datetime] = None # Последняя запись или жалоба курса
+
+# --- Инкрементальная синхронизация ---
+class SyncChanges(BaseModel):
+    cursor: str # Передать в следующий запрос как since
+    reset: bool # true — это полный снимок: локальные данные заменить целиком
+    records: List[RecordForTimeline] = []
+    vitals: List[VitalsRecord] = []
+    complaints: List[Complaint] = []
+    reminders: List[Reminder] = []
+    courses: List[TreatmentCourseItem] = []
+    deleted: Dict[str, List[int]] = {} # коллекция -> id удаленных объектов
+
+# --- Импорт FHIR ---
+class FhirImportError(BaseModel):
+    row: int # Номер строки NDJSON, с 1
+    error: str
+
+class FhirImportResult(BaseModel):
+    created: int
+    updated: int # Включая ресурсы, дополнившие уже загруженный визит (диагноз, препарат)
+    failed: int
+    errors: List[FhirImportError] = []
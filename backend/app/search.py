@@ -0,0 +1,87 @@
+# backend/app/search.py
+
+import logging
+import re
+from typing import Optional
+
+from sqlalchemy import column, event, func, literal_column, or_, select, table, text
+from sqlalchemy.exc import OperationalError
+
+from . import models
+
+# Полнотекстовый поиск по записям ленты. Индекс живет в самой БД и обновляется ею же,
+# поэтому не расходится с данными ни при изменениях через crud, ни при фоновом UPDATE
+# извлеченного из вложений текста:
+#  * Postgres — генерируемая колонка tsvector (русская морфология, веса полей) + GIN-индекс;
+#  * SQLite — таблица FTS5 поверх records, синхронизируемая триггерами (для локальных прогонов).
+# Схема ставится при каждом create_all и идемпотентна, так что подхватывается и на старых БД.
+# На других СУБД (или SQLite без FTS5) поиск откатывается к ILIKE по полям записи.
+
+logger = logging.getLogger(__name__)
+
+# Поля записи, по которым ищем, и их вес в ранжировании Postgres (A — самый значимый)
+FIELDS = {"doctor_name": "A", "clinic_name": "A", "test_name": "A", "conclusion_text": "B", "patient_complaints": "B", "attachment_text": "C"}
+
+_PG_VECTOR = " || ".join(f"setweight(to_tsvector('russian', coalesce({name}, '')), '{weight}')" for name, weight in FIELDS.items())
+
+_PG_DDL = [
+    f"ALTER TABLE records ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({_PG_VECTOR}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_records_search_vector ON records USING GIN (search_vector)",
+]
+
+_FTS_COLUMNS = ", ".join(FIELDS)
+_FTS_NEW = ", ".join(f"new.{name}" for name in FIELDS)
+_FTS_OLD = ", ".join(f"old.{name}" for name in FIELDS)
+_SQLITE_DDL = [
+    f"CREATE VIRTUAL TABLE records_fts USING fts5({_FTS_COLUMNS}, content='records', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS records_fts_ai AFTER INSERT ON records BEGIN INSERT INTO records_fts(rowid, {_FTS_COLUMNS}) VALUES (new.id, {_FTS_NEW}); END",
+    f"CREATE TRIGGER IF NOT EXISTS records_fts_ad AFTER DELETE ON records BEGIN INSERT INTO records_fts(records_fts, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.id, {_FTS_OLD}); END",
+    f"CREATE TRIGGER IF NOT EXISTS records_fts_au AFTER UPDATE ON records BEGIN "
+    f"INSERT INTO records_fts(records_fts, rowid, {_FTS_COLUMNS}) VALUES ('delete', old.id, {_FTS_OLD}); "
+    f"INSERT INTO records_fts(rowid, {_FTS_COLUMNS}) VALUES (new.id, {_FTS_NEW}); END",
+    "INSERT INTO records_fts(records_fts) VALUES ('rebuild')", # Индексируем записи, созданные до появления поиска
+]
+
+_fts_available: Optional[bool] = None
+
+@event.listens_for(models.Base.metadata, "after_create")
+def install(target, connection, **kw) -> None:
+    global _fts_available
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        for statement in _PG_DDL: connection.execute(text(statement))
+    elif dialect == "sqlite":
+        if connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'records_fts'")).first():
+            _fts_available = True; return
+        try:
+            with connection.begin_nested():
+                for statement in _SQLITE_DDL: connection.execute(text(statement))
+            _fts_available = True
+        except OperationalError as exc:
+            logger.warning("SQLite FTS5 недоступен, поиск по записям будет через LIKE: %s", exc)
+            _fts_available = False
+
+_records_fts = table("records_fts", column("rowid"), column("rank"))
+_WORD = re.compile(r"\w+")
+
+def fts5_query(query: str) -> Optional[str]:
+    """Слова запроса как префиксы, все обязательны: "кардиолог прием" -> "кардиолог"* "прием"*."""
+    words = _WORD.findall(query.lower())
+    return " ".join(f'"{word}"*' for word in words) if words else None
+
+def build_search(dialect: str, owner_id: int, query: str):
+    """SELECT записей владельца по запросу, от самых релевантных; None — запрос пустой."""
+    owned = select(models.Record).where(models.Record.owner_id == owner_id)
+    if dialect == "postgresql":
+        tsquery = func.websearch_to_tsquery("russian", query)
+        vector = literal_column("records.search_vector")
+        return owned.where(vector.op("@@")(tsquery)).order_by(func.ts_rank(vector, tsquery).desc(), models.Record.date.desc(), models.Record.id.desc())
+    if dialect == "sqlite" and _fts_available:
+        match = fts5_query(query)
+        if match is None: return None
+        return (owned.join(_records_fts, _records_fts.c.rowid == models.Record.id)
+                .where(literal_column("records_fts").op("MATCH")(match))
+                .order_by(_records_fts.c.rank, models.Record.date.desc(), models.Record.id.desc()))
+    words = _WORD.findall(query)
+    if not words: return None
+    return owned.where(*(or_(*(getattr(models.Record, name).ilike(f"%{word}%") for name in FIELDS)) for word in words)).order_by(models.Record.date.desc(), models.Record.id.desc())
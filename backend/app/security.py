@@ -1,25 +1,55 @@
 # backend/app/security.py
 
+import uuid
 from datetime import datetime, timedelta, timezone
-from typing import Optional
-from passlib.context import CryptContext
+from typing import Optional, Tuple
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from . import models, crud
+from . import schemas, crud, passwords
+from .cache import TTLCache
 from .config import settings
-from .database import get_db
+from .database import get_async_db
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+pwd_context = passwords.pwd_context
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+# Кэш аутентифицированных пользователей: email (subject токена) -> schemas.User.
+# Храним отвязанный от сессии снимок, а не ORM-объект, чтобы его можно было отдавать между запросами.
+_principal_cache = TTLCache(max_size=settings.AUTH_CACHE_MAX_SIZE, ttl=settings.AUTH_CACHE_TTL_SECONDS)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+def invalidate_cached_user(email: str) -> None:
+    """Сбрасывает закэшированного пользователя после изменения или деактивации."""
+    _principal_cache.pop(email)
+
+def get_auth_cache_stats() -> dict:
+    return _principal_cache.stats()
+
+def _hashing_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Сервер перегружен, повторите попытку позже",
+        headers={"Retry-After": "1"},
+    )
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Проверяет пароль; вторым элементом возвращает новый хэш, если стоимость bcrypt изменилась."""
+    try:
+        return await passwords.verify_and_update_async(plain_password, hashed_password)
+    except passwords.HasherBusyError:
+        raise _hashing_busy()
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return (await verify_and_update_password(plain_password, hashed_password))[0]
+
+async def get_password_hash(password: str) -> str:
+    try:
+        return await passwords.hash_password_async(password)
+    except passwords.HasherBusyError:
+        raise _hashing_busy()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -34,31 +64,80 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 # Новая функция для создания временного токена
 def create_sharing_token(email: str) -> str:
-    """Создает короткоживущий токен для обмена данными."""
-    expires_delta = timedelta(minutes=10)
-    to_encode = {"sub": email, "scope": "sharing"}
+    """Создает короткоживущий токен для обмена данными. jti — ключ кэша снимков просмотра."""
+    expires_delta = timedelta(minutes=settings.SHARE_TOKEN_EXPIRE_MINUTES)
+    to_encode = {"sub": email, "scope": "sharing", "jti": uuid.uuid4().hex}
     expire = datetime.now(timezone.utc) + expires_delta
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-def get_current_active_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
-    credentials_exception = HTTPException(
+ATTACHMENT_SCOPE = "attachment"
+
+def create_attachment_token(email: str, record_id: int) -> str:
+    """
+    Токен на скачивание вложения одной записи: его можно класть в URL ссылок и <img>, в отличие
+    от токена входа. Срок выровнен по окну ATTACHMENT_TOKEN_EXPIRE_MINUTES (живет от одного до
+    двух окон): в пределах окна токен, а с ним и URL, один и тот же — браузер берет файл из кэша.
+    """
+    window = settings.ATTACHMENT_TOKEN_EXPIRE_MINUTES * 60
+    expire = (int(datetime.now(timezone.utc).timestamp()) // window + 2) * window
+    to_encode = {"sub": email, "scope": ATTACHMENT_SCOPE, "rid": record_id, "exp": expire}
+    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode(token: str) -> dict:
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email: Optional[str] = payload.get("sub")
-        if email is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
-    
-    user = crud.get_user_by_email(db, email=email)
+        raise _credentials_exception()
+    if payload.get("sub") is None:
+        raise _credentials_exception()
+    return payload
+
+async def get_current_active_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> schemas.User:
+    payload = _decode(token)
+    # Токены со scope (ссылка для врача, скачивание вложения) дают доступ только к своему ресурсу
+    if payload.get("scope") is not None:
+        raise _credentials_exception()
+    return await _active_user(payload["sub"], db)
+
+async def _active_user(email: str, db: AsyncSession) -> schemas.User:
+    # В кэш попадают только активные пользователи, поэтому попадание не требует запроса к БД
+    principal = _principal_cache.get(email)
+    if principal is not None:
+        return principal
+    user = await crud.get_user_by_email(db, email=email)
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
-    return user
\ No newline at end of file
+    principal = schemas.User.from_orm(user)
+    _principal_cache.set(email, principal)
+    return principal
+
+async def get_current_active_user_for_files(record_id: int, token: Optional[str] = Depends(oauth2_scheme_optional), access_token: Optional[str] = Query(None), db: AsyncSession = Depends(get_async_db)) -> schemas.User:
+    """
+    Доступ к вложению записи: обычный токен в заголовке Authorization либо параметр ?access_token=
+    для ссылок и <img>, которые не умеют слать заголовок. В параметре принимается только токен
+    на скачивание именно этой записи (create_attachment_token), но не токен входа.
+    """
+    if token:
+        return await get_current_active_user(token=token, db=db)
+    if not access_token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    payload = _decode(access_token)
+    if payload.get("scope") != ATTACHMENT_SCOPE or payload.get("rid") != record_id:
+        raise _credentials_exception()
+    return await _active_user(payload["sub"], db)
+
+async def get_current_admin_user(current_user: schemas.User = Depends(get_current_active_user)) -> schemas.User:
+    if current_user.email not in settings.ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Недостаточно прав")
+    return current_user
@@ -0,0 +1,86 @@
+# backend/app/sharing.py
+
+import hashlib
+import threading
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+from .cache import TTLCache
+from .config import settings
+
+# Снимки просмотра по ссылке для врача: готовые байты JSON, собранные один раз на токен
+# (и набор параметров). Снимок живет не дольше токена и сбрасывается, когда пациент
+# меняет свои данные: у каждого владельца есть счетчик поколений, снимок старого поколения
+# считается устаревшим. Кэш живет в процессе, поэтому при нескольких воркерах
+# устаревание между процессами ограничено SHARE_SNAPSHOT_TTL_SECONDS.
+
+SECTIONS = ("profile", "records", "vitals")
+
+_snapshots = TTLCache(max_size=settings.SHARE_SNAPSHOT_CACHE_MAX_SIZE, ttl=settings.SHARE_SNAPSHOT_TTL_SECONDS)
+# Поколение владельца — значение общего счетчика при его последнем изменении. Владельцы,
+# не менявшие данных дольше снимков и окна read-your-writes, удаляются из словарей; их
+# поколением считается значение счетчика на момент очистки — оно не меньше любого удаленного,
+# так что старые снимки не оживают, а словари не растут с числом владельцев.
+_generations: Dict[int, int] = {}
+_changed_at: Dict[int, float] = {} # владелец -> time.monotonic() последнего изменения, от старых к новым
+_generation_counter = 0
+_pruned_generation = 0
+_generations_lock = threading.Lock()
+
+def parse_sections(raw: Optional[str]) -> Tuple[str, ...]:
+    """"records,vitals" -> ("records", "vitals") в каноническом порядке. Пусто — все разделы."""
+    if not raw: return SECTIONS
+    requested = {part.strip() for part in raw.split(",") if part.strip()}
+    unknown = requested - set(SECTIONS)
+    if unknown: raise ValueError(f"Неизвестные разделы: {', '.join(sorted(unknown))}")
+    return tuple(section for section in SECTIONS if section in requested)
+
+def token_key(payload: dict, token: str) -> str:
+    """Ключ снимка: jti токена; для старых токенов без jti — хэш самого токена."""
+    return payload.get("jti") or hashlib.sha256(token.encode()).hexdigest()
+
+def owner_generation(owner_id: int) -> int:
+    return _generations.get(owner_id, _pruned_generation)
+
+def invalidate_owner(owner_id: int) -> None:
+    """Вызывается после коммита изменений записей, замеров или профиля пациента."""
+    global _generation_counter
+    now = time.monotonic()
+    with _generations_lock:
+        _generation_counter += 1
+        _generations[owner_id] = _generation_counter
+        _changed_at.pop(owner_id, None); _changed_at[owner_id] = now
+        _prune(now)
+
+def _prune(now: float) -> None:
+    global _pruned_generation
+    horizon = max(settings.SHARE_SNAPSHOT_TTL_SECONDS, settings.READ_YOUR_WRITES_SECONDS)
+    expired = []
+    for owner_id, changed_at in _changed_at.items():
+        if now - changed_at <= horizon: break
+        expired.append(owner_id)
+    if not expired: return
+    for owner_id in expired: del _changed_at[owner_id], _generations[owner_id]
+    _pruned_generation = _generation_counter
+
+def changed_within(owner_id: int, seconds: float) -> bool:
+    """Менял ли владелец данные в последние `seconds` — реплика может их еще не видеть."""
+    changed_at = _changed_at.get(owner_id)
+    return changed_at is not None and time.monotonic() - changed_at < seconds
+
+def get_snapshot(key: Hashable) -> Optional[bytes]:
+    entry = _snapshots.get(key)
+    if entry is None: return None
+    owner_id, generation, body = entry
+    if generation != owner_generation(owner_id):
+        _snapshots.pop(key)
+        return None
+    return body
+
+def put_snapshot(key: Hashable, owner_id: int, generation: int, body: bytes, expires_at: float) -> None:
+    """generation берется до чтения данных: если пациент успел что-то записать, снимок сразу будет устаревшим."""
+    ttl = min(expires_at - time.time(), settings.SHARE_SNAPSHOT_TTL_SECONDS)
+    if ttl > 0: _snapshots.set(key, (owner_id, generation, body), ttl=ttl)
+
+def get_snapshot_stats() -> dict:
+    return _snapshots.stats()
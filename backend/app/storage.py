@@ -0,0 +1,135 @@
+# backend/app/storage.py
+
+import hashlib
+import mimetypes
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from .config import settings
+
+# Контентно-адресуемое хранилище вложений: каждый уникальный файл лежит на диске один раз,
+# по пути blobs/<первые 2 символа sha256>/<sha256><расширение> внутри UPLOAD_DIR.
+BLOB_DIR = "blobs"
+TMP_DIR = "tmp"
+CHUNK_SIZE = 1024 * 1024
+
+@dataclass
+class StoredBlob:
+    sha256: str
+    size: int
+    content_type: Optional[str]
+    storage_path: str # Относительно UPLOAD_DIR
+    tmp_path: Optional[str] = None # Копия загрузки, живет до коммита записи (см. settle)
+
+def attachment_url(record_id: int) -> str:
+    return f"/records/{record_id}/attachment"
+
+def thumbnail_url(record_id: int) -> str:
+    return f"/records/{record_id}/attachment?variant=thumbnail"
+
+LEGACY_URL_PREFIX = "/uploads/"
+
+def legacy_storage_path(url: Optional[str]) -> Optional[str]:
+    """Путь внутри UPLOAD_DIR для старых вложений вида /uploads/<файл>; None для чужих/битых путей."""
+    if not url or not url.startswith(LEGACY_URL_PREFIX): return None
+    path = os.path.normpath(url[len(LEGACY_URL_PREFIX):])
+    if path.startswith("..") or os.path.isabs(path): return None
+    return path
+
+def absolute_path(storage_path: str) -> str:
+    return os.path.join(settings.UPLOAD_DIR, storage_path)
+
+def _find_existing(sha256: str) -> Optional[str]:
+    """Ищет уже сохраненный блоб с таким хэшем (расширение у него может быть другим)."""
+    shard = os.path.join(BLOB_DIR, sha256[:2])
+    try:
+        names = os.listdir(os.path.join(settings.UPLOAD_DIR, shard))
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if name.startswith(sha256): return os.path.join(shard, name)
+    return None
+
+def _open_temp():
+    tmp_dir = os.path.join(settings.UPLOAD_DIR, TMP_DIR)
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=tmp_dir)
+    return os.fdopen(fd, "wb"), path
+
+def _write_chunk(buffer, hasher, chunk: bytes) -> None:
+    hasher.update(chunk)
+    buffer.write(chunk)
+
+def _link(tmp_path: str, storage_path: str) -> None:
+    os.makedirs(os.path.dirname(absolute_path(storage_path)), exist_ok=True)
+    try:
+        os.link(tmp_path, absolute_path(storage_path))
+    except FileExistsError:
+        pass # Тот же файл параллельно положила другая загрузка — содержимое идентично
+
+def _finalize(tmp_path: str, sha256: str, extension: str) -> str:
+    """
+    Ставит временный файл на место блоба жесткой ссылкой (если такого блоба еще нет).
+    Сама временная копия остается до коммита записи: блоб, найденный на диске, может
+    в это время удалить параллельное удаление последней ссылавшейся на него записи.
+    """
+    existing = _find_existing(sha256)
+    if existing: return existing
+    storage_path = os.path.join(BLOB_DIR, sha256[:2], f"{sha256}{extension}")
+    _link(tmp_path, storage_path)
+    return storage_path
+
+async def save_upload(file: UploadFile) -> StoredBlob:
+    """
+    Потоково принимает загрузку кусками по CHUNK_SIZE, одновременно считая SHA-256,
+    и кладет файл в хранилище под его хэшем. Дисковые операции идут в пуле потоков.
+    """
+    extension = os.path.splitext(file.filename or "")[1].lower()
+    hasher = hashlib.sha256()
+    size = 0
+    buffer, tmp_path = await run_in_threadpool(_open_temp)
+    try:
+        while True:
+            chunk = await file.read(CHUNK_SIZE)
+            if not chunk: break
+            size += len(chunk)
+            await run_in_threadpool(_write_chunk, buffer, hasher, chunk)
+        await run_in_threadpool(buffer.close)
+        sha256 = hasher.hexdigest()
+        storage_path = await run_in_threadpool(_finalize, tmp_path, sha256, extension)
+    except BaseException:
+        buffer.close()
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    content_type = file.content_type or mimetypes.guess_type(storage_path)[0]
+    return StoredBlob(sha256=sha256, size=size, content_type=content_type, storage_path=storage_path, tmp_path=tmp_path)
+
+def settle(blob: StoredBlob) -> None:
+    """
+    Вызывается после коммита записи со ссылкой на блоб. Если параллельное удаление успело
+    стереть файл (оно проверяло ссылки до нашего коммита), возвращает его из временной копии.
+    """
+    if blob.tmp_path is None: return
+    if not os.path.exists(absolute_path(blob.storage_path)): _link(blob.tmp_path, blob.storage_path)
+    discard(blob)
+
+def discard(blob: StoredBlob) -> None:
+    """Удаляет временную копию загрузки (запрос завершился, запись не сохранена или уже settle)."""
+    if blob.tmp_path is None: return
+    try:
+        os.remove(blob.tmp_path)
+    except FileNotFoundError:
+        pass
+    blob.tmp_path = None
+
+def delete_blob(storage_path: str) -> None:
+    """Удаляет файл блоба (или его превью); что на него больше никто не ссылается, проверяет вызывающий."""
+    try:
+        os.remove(absolute_path(storage_path))
+    except FileNotFoundError:
+        pass
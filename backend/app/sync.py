@@ -0,0 +1,130 @@
+# backend/app/sync.py
+
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import event, insert, inspect, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import fastjson, models, schemas
+
+# Инкрементальная синхронизация коллекций пользователя (GET /sync?since=<курсор>).
+# У каждого пользователя есть счетчик users.sync_version. Транзакция, меняющая его записи,
+# замеры, жалобы, напоминания или курсы, увеличивает счетчик (UPDATE ... RETURNING) и ставит
+# новое значение измененным строкам; удаленные объекты оставляют tombstone с той же версией.
+# Строка пользователя блокируется до коммита, поэтому версии коммитятся строго по порядку и
+# клиент с курсором N не пропустит изменение с версией <= N, закоммиченное позже.
+# ORM-изменения помечаются автоматически (before_flush); массовые UPDATE/INSERT в обход ORM
+# должны сами вызвать bump_versions и проставить sync_version/updated_at.
+# Та же версия записывается в collection_versions для каждой измененной коллекции (плюс "profile"
+# для пользователя, профиля, аллергий и заболеваний) — по ней GET-эндпоинты строят ETag (см. httpcache.py).
+
+# Коллекция -> (модель, схема ответа)
+COLLECTIONS = {
+    "records": (models.Record, schemas.RecordForTimeline),
+    "vitals": (models.VitalsRecord, schemas.VitalsRecord),
+    "complaints": (models.Complaint, schemas.Complaint),
+    "reminders": (models.Reminder, schemas.Reminder),
+    "courses": (models.TreatmentCourse, schemas.TreatmentCourseItem),
+}
+_COLLECTION_BY_MODEL = {model: name for name, (model, _) in COLLECTIONS.items()}
+
+PROFILE = "profile" # Не синхронизируется через /sync, но версионируется для ETag
+LABS = "labs" # lab_results, пересобранные в обход записей (backfill)
+VITALS_ROLLUPS = "vitals_rollups" # Агрегаты замеров, пересобранные в обход замеров (backfill)
+# Модель -> (коллекция, атрибут владельца) для collection_versions
+_VERSIONED = {**{model: (name, "owner_id") for model, name in _COLLECTION_BY_MODEL.items()}, models.Profile: (PROFILE, "user_id"), models.User: (PROFILE, "id")}
+_USER_COLLECTIONS = ("allergies", "chronic_diseases")
+
+def _bump(conn, touched: Dict[int, Set[str]]) -> Dict[int, int]:
+    """
+    Новые версии владельцев одним UPDATE ... RETURNING (строки пользователей заблокированы до конца
+    транзакции) и те же версии для затронутых коллекций. Строки collection_versions вставляются
+    при первом изменении коллекции; гонки вставки нет — строка владельца уже заблокирована.
+    """
+    versions = dict(conn.execute(
+        update(models.User).where(models.User.id.in_(list(touched)))
+        .values(sync_version=models.User.sync_version + 1)
+        .returning(models.User.id, models.User.sync_version)
+        .execution_options(synchronize_session=False)
+    ).all())
+    Version = models.CollectionVersion
+    for owner_id, version in versions.items():
+        names = touched[owner_id]
+        existing = set(conn.scalars(update(Version).where(Version.owner_id == owner_id, Version.collection.in_(names)).values(version=version).returning(Version.collection)))
+        if names - existing: conn.execute(insert(Version), [{"owner_id": owner_id, "collection": name, "version": version} for name in names - existing])
+    return versions
+
+async def bump_versions(db: AsyncSession, owner_ids: Iterable[int], collections: Iterable[str]) -> Dict[int, int]:
+    """Новые версии владельцев для изменений коллекций `collections` в обход ORM."""
+    touched = {owner_id: set(collections) for owner_id in owner_ids}
+    if not touched: return {}
+    return await db.run_sync(lambda session: _bump(session.connection(), touched))
+
+def _profile_changed(session: Session, user: models.User) -> bool:
+    state = inspect(user)
+    return session.is_modified(user, include_collections=False) or any(state.attrs[name].history.has_changes() for name in _USER_COLLECTIONS)
+
+@event.listens_for(Session, "before_flush")
+def _stamp_changes(session: Session, flush_context, instances) -> None:
+    changed = defaultdict(list)
+    deleted = defaultdict(list)
+    touched = defaultdict(set)
+    for obj in session.new:
+        if type(obj) in _VERSIONED: changed[_owner(obj)].append(obj)
+    for obj in session.dirty:
+        if type(obj) is models.User:
+            if _profile_changed(session, obj): changed[obj.id].append(obj)
+        elif type(obj) in _VERSIONED and session.is_modified(obj, include_collections=False): changed[_owner(obj)].append(obj)
+    for obj in session.deleted:
+        if type(obj) in _VERSIONED: deleted[_owner(obj)].append(obj)
+    for owner_id, objects in (*changed.items(), *deleted.items()):
+        touched[owner_id].update(_VERSIONED[type(obj)][0] for obj in objects)
+    touched.pop(None, None) # Новый пользователь (и его профиль) еще без id — менять нечего
+    if not touched: return
+    versions = _bump(session.connection(), touched)
+    now = datetime.utcnow()
+    for owner_id, objects in changed.items():
+        for obj in objects:
+            if type(obj) in _COLLECTION_BY_MODEL: obj.sync_version, obj.updated_at = versions.get(owner_id), now
+    for owner_id, objects in deleted.items():
+        for obj in objects:
+            if type(obj) in _COLLECTION_BY_MODEL:
+                session.add(models.SyncTombstone(owner_id=owner_id, collection=_COLLECTION_BY_MODEL[type(obj)], object_id=obj.id, sync_version=versions[owner_id], deleted_at=now))
+
+def _owner(obj) -> Optional[int]:
+    return getattr(obj, _VERSIONED[type(obj)][1])
+
+def encode_cursor(version: int) -> str:
+    return str(version)
+
+def decode_cursor(cursor: str) -> int:
+    """Версия из курсора. Бросает ValueError на битом курсоре."""
+    version = int(cursor)
+    if version < 0: raise ValueError("Invalid sync cursor")
+    return version
+
+async def changes(db: AsyncSession, owner_id: int, since: Optional[int]) -> bytes:
+    """
+    JSON ответа /sync: все, что изменилось после версии `since`, и курсор текущей версии.
+    since=None (или курсор из будущего, например после восстановления БД) — полный снимок
+    с reset=true: клиент заменяет локальные данные целиком.
+    """
+    current = await db.scalar(select(models.User.sync_version).where(models.User.id == owner_id)) or 0
+    reset = since is None or since > current
+    body = {"cursor": encode_cursor(current), "reset": reset}
+    if not reset and since == current: # Клиент в актуальном состоянии — больше запросов нет
+        return fastjson.dumps({**body, **{name: [] for name in COLLECTIONS}, "deleted": {}})
+    for name, (model, schema) in COLLECTIONS.items():
+        stmt = select(*fastjson.columns(model, schema)).where(model.owner_id == owner_id)
+        if not reset: stmt = stmt.where(model.sync_version > since, model.sync_version <= current)
+        body[name] = [dict(zip(fastjson.field_names(schema), row)) for row in await db.execute(stmt.order_by(model.id))]
+    deleted: Dict[str, List[int]] = {}
+    if not reset:
+        Tombstone = models.SyncTombstone
+        rows = await db.execute(select(Tombstone.collection, Tombstone.object_id).where(Tombstone.owner_id == owner_id, Tombstone.sync_version > since, Tombstone.sync_version <= current).order_by(Tombstone.id))
+        for collection, object_id in rows: deleted.setdefault(collection, []).append(object_id)
+    body["deleted"] = deleted
+    return fastjson.dumps(body)
@@ -0,0 +1,139 @@
+# backend/benchmarks/datagen.py
+
+# Генератор синтетических пациентов для бенчмарков: пользователи с профилем, курсами лечения,
+# записями (визиты и анализы), замерами и жалобами. Пишет пачками через executemany в обход ORM,
+# так что 10k пользователей × 5k замеров (50 млн строк) генерируются за разумное время.
+# Данные детерминированы (seed) и адресуются по email bench-<n>@example.com с паролем PASSWORD;
+# уже существующие пользователи пропускаются — повторный запуск догенерирует недостающих.
+# Отдельно (в БД из DATABASE_URL, например локальный Postgres):
+#     python -m benchmarks.datagen --users 10000 --vitals 5000 [--records 500 ...]
+
+import argparse
+import random
+import time
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timedelta
+from typing import Iterator, List
+
+from sqlalchemy import insert, select
+from sqlalchemy.engine import Engine
+
+from app import models, passwords, rollups
+
+PASSWORD = "benchmark"
+START = datetime(2015, 1, 1)
+USER_CHUNK_SIZE = 200 # Пользователей на транзакцию
+ROW_CHUNK_SIZE = 10000 # Строк на один executemany
+
+_VITALS = (("heart_rate", "уд/мин", 72, 12), ("blood_pressure_sys", "мм рт. ст.", 125, 15), ("blood_pressure_dia", "мм рт. ст.", 80, 10), ("blood_sugar", "ммоль/л", 5.6, 1.2))
+_TESTS = (("Глюкоза", "ммоль/л", "3.9-6.1", 5.2, 1.0), ("Гемоглобин", "г/л", "120-160", 138, 12), ("Холестерин общий", "ммоль/л", "< 5.2", 5.0, 0.9), ("СРБ", "мг/л", "0-5", 3, 2.5))
+_DIAGNOSES = ("I10", "E11", "J45", "K29", "M15", "J06.9", None)
+_DOCTORS = tuple(f"Врач {i}" for i in range(50))
+_CLINICS = ("Городская поликлиника №1", "Медицинский центр «Сункар»", "Клиника семейной медицины")
+_COMPLAINTS = ("Головная боль по утрам", "Слабость и быстрая утомляемость", "Боль в суставах при нагрузке", "Сухой кашель", "Изжога после еды")
+
+@dataclass
+class Scale:
+    """Сколько строк каждого вида на одного пользователя."""
+    users: int = 200
+    vitals: int = 2000
+    records: int = 300
+    complaints: int = 20
+    courses: int = 3
+
+def email(n: int) -> str:
+    return f"bench-{n}@example.com"
+
+def _chunks(rows: Iterator[dict], size: int) -> Iterator[List[dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk; chunk = []
+    if chunk: yield chunk
+
+def _vitals(rnd: random.Random, owner_id: int, count: int) -> Iterator[dict]:
+    step = timedelta(days=3650) / max(count, 1) # Десять лет истории независимо от плотности
+    for i in range(count):
+        vitals_type, unit, mean, spread = _VITALS[i % len(_VITALS)]
+        yield {"owner_id": owner_id, "type": vitals_type, "unit": unit, "value": round(rnd.gauss(mean, spread), 1), "timestamp": START + step * i}
+
+# executemany требует одинаковый набор ключей во всех строках пачки
+_RECORD_FIELDS = dict.fromkeys(("lab_name", "test_name", "result", "reference_range", "doctor_name", "clinic_name", "diagnosis_code", "patient_complaints", "conclusion_text"))
+
+def _records(rnd: random.Random, owner_id: int, count: int, course_ids: List[int]) -> Iterator[dict]:
+    step = timedelta(days=3650) / max(count, 1)
+    for i in range(count):
+        row = dict(_RECORD_FIELDS, owner_id=owner_id, date=START + step * i, course_id=rnd.choice(course_ids) if course_ids and i % 4 == 0 else None)
+        if i % 3 == 0: # Каждая третья запись — анализ с числовым результатом
+            test_name, unit, reference_range, mean, spread = rnd.choice(_TESTS)
+            row.update(resource_type="Observation", lab_name=rnd.choice(_CLINICS), test_name=test_name, result=f"{max(rnd.gauss(mean, spread), 0):.1f} {unit}", reference_range=reference_range)
+        else:
+            row.update(resource_type="Encounter", doctor_name=rnd.choice(_DOCTORS), clinic_name=rnd.choice(_CLINICS), diagnosis_code=rnd.choice(_DIAGNOSES),
+                       patient_complaints=rnd.choice(_COMPLAINTS), conclusion_text="Состояние удовлетворительное. Рекомендовано наблюдение у терапевта, повторный визит через месяц.")
+        yield row
+
+def _complaints(rnd: random.Random, owner_id: int, count: int, course_ids: List[int]) -> Iterator[dict]:
+    step = timedelta(days=3650) / max(count, 1)
+    for i in range(count):
+        created_at = START + step * i
+        yield {"owner_id": owner_id, "complaint_text": rnd.choice(_COMPLAINTS), "start_date": created_at.date(), "created_at": created_at,
+               "status": "active" if i % 5 == 0 else "resolved", "course_id": rnd.choice(course_ids) if course_ids and i % 2 == 0 else None}
+
+def _insert(conn, model, rows: Iterator[dict]) -> int:
+    total = 0
+    for chunk in _chunks(rows, ROW_CHUNK_SIZE):
+        conn.execute(insert(model), chunk); total += len(chunk)
+    return total
+
+def generate(engine: Engine, scale: Scale, seed: int = 0, progress: bool = True) -> int:
+    """Создает недостающих пользователей bench-0..bench-<users-1> со всеми данными; возвращает число созданных."""
+    models.Base.metadata.create_all(bind=engine)
+    hashed_password = passwords.hash_password(PASSWORD) # Один хэш на всех: bcrypt на каждого занял бы часы
+    created, started = 0, time.perf_counter()
+    for offset in range(0, scale.users, USER_CHUNK_SIZE):
+        numbers = range(offset, min(offset + USER_CHUNK_SIZE, scale.users))
+        with engine.begin() as conn:
+            existing = set(conn.scalars(select(models.User.email).where(models.User.email.in_([email(n) for n in numbers]))))
+            numbers = [n for n in numbers if email(n) not in existing]
+            if not numbers: continue
+            conn.execute(insert(models.User), [{"email": email(n), "hashed_password": hashed_password, "is_active": True, "first_name": "Тест", "last_name": f"Пациент {n}",
+                                                "birth_date": date(1950, 1, 1) + timedelta(days=n * 7919 % 20000)} for n in numbers])
+            emails = [email(n) for n in numbers]
+            ids = dict(conn.execute(select(models.User.email, models.User.id).where(models.User.email.in_(emails))).all())
+            conn.execute(insert(models.Profile), [{"user_id": ids[value], "address": "г. Алматы", "height": 170.0, "weight": 75.0} for value in emails])
+            for value in emails:
+                owner_id = ids[value]
+                rnd = random.Random(f"{seed}:{value}")
+                course_ids = list(conn.execute(insert(models.TreatmentCourse).returning(models.TreatmentCourse.id), [
+                    {"owner_id": owner_id, "name": f"Курс {i + 1}", "start_date": (START + timedelta(days=365 * i)).date(), "status": "active" if i == 0 else "completed"}
+                    for i in range(scale.courses)
+                ]).scalars()) if scale.courses else []
+                _insert(conn, models.Record, _records(rnd, owner_id, scale.records, course_ids))
+                vitals = list(_vitals(rnd, owner_id, scale.vitals))
+                _insert(conn, models.VitalsRecord, iter(vitals))
+                rollups.upsert(conn, rollups.aggregate((owner_id, row["type"], row["timestamp"], row["value"]) for row in vitals)) # Как insert_vitals_chunk
+                _insert(conn, models.Complaint, _complaints(rnd, owner_id, scale.complaints, course_ids))
+        created += len(emails)
+        if progress: print(f"  пользователей: {min(offset + USER_CHUNK_SIZE, scale.users)}/{scale.users} ({time.perf_counter() - started:.0f} с)", flush=True)
+    return created
+
+def add_scale_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = Scale()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f"--{name}", type=int, default=value, help=f"по умолчанию {value}" + ("" if name == "users" else " на пользователя"))
+    parser.add_argument("--seed", type=int, default=0)
+
+def scale_from_args(args: argparse.Namespace) -> Scale:
+    return Scale(**{name: getattr(args, name) for name in asdict(Scale())})
+
+def main(argv=None) -> None:
+    from app.database import engine
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.datagen", description="Синтетические пациенты для бенчмарков")
+    add_scale_arguments(parser)
+    args = parser.parse_args(argv)
+    created = generate(engine, scale_from_args(args), seed=args.seed)
+    print(f"Создано пользователей: {created} (пароль {PASSWORD!r})")
+
+if __name__ == "__main__":
+    main()
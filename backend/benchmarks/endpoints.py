@@ -0,0 +1,181 @@
+# backend/benchmarks/endpoints.py
+
+# Нагрузочный бенчмарк основных эндпоинтов: /token, /records/ (и его перепроверка по ETag), /vitals/, /share/view/{token}.
+# Каждый сценарий гоняется на нескольких уровнях параллельности; на выходе — пропускная способность
+# и p50/p95/p99 задержки. Результат сравнивается с сохраненным baseline: рост p95 или падение
+# пропускной способности больше чем на --tolerance считается регрессией, и запуск завершается с кодом 1.
+# Запуск из каталога backend:
+#     python -m benchmarks.endpoints                      # приложение в процессе, временная SQLite
+#     python -m benchmarks.endpoints --save-baseline      # переснять benchmarks/baseline.json
+#     BENCH_DATABASE_URL=postgresql://... python -m benchmarks.endpoints --url http://localhost:8000
+# С --url запросы идут по HTTP в уже запущенный сервер; он должен смотреть в ту же БД
+# (BENCH_DATABASE_URL) — данные генерируются в нее, если их там еще нет (см. datagen.py).
+# baseline зависит от машины: переснимайте его на той же машине, где сравниваете.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List
+
+_tmpdir = tempfile.mkdtemp(prefix="meddata-bench-")
+os.environ["DATABASE_URL"] = os.environ.get("BENCH_DATABASE_URL", f"sqlite:///{_tmpdir}/bench.sqlite")
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_tmpdir, "uploads"))
+
+import httpx
+
+from app.database import engine
+
+from . import datagen
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+@dataclass
+class Scenario:
+    name: str
+    # (клиент, пользователь) -> ответ; пользователь — словарь с email, headers и share_token
+    request: Callable[[httpx.AsyncClient, dict], Awaitable[httpx.Response]]
+
+SCENARIOS = {
+    "token": Scenario("POST /token", lambda client, user: client.post("/token", data={"username": user["email"], "password": datagen.PASSWORD})),
+    "records": Scenario("GET /records/?limit=50", lambda client, user: client.get("/records/", params={"limit": 50}, headers=user["headers"])),
+    "records_all": Scenario("GET /records/", lambda client, user: client.get("/records/", headers=user["headers"])),
+    "records_304": Scenario("GET /records/?limit=50 (304)", lambda client, user: client.get("/records/", params={"limit": 50}, headers={**user["headers"], "If-None-Match": user["records_etag"]})),
+    "vitals": Scenario("GET /vitals/?limit=500", lambda client, user: client.get("/vitals/", params={"limit": 500}, headers=user["headers"])),
+    "share_view": Scenario("GET /share/view/{token}", lambda client, user: client.get(f"/share/view/{user['share_token']}")),
+}
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Процентиль с линейной интерполяцией (как numpy по умолчанию)."""
+    if not sorted_values: return 0.0
+    pos = (len(sorted_values) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (pos - low)
+
+async def _login(client: httpx.AsyncClient, email: str) -> dict:
+    response = await client.post("/token", data={"username": email, "password": datagen.PASSWORD})
+    response.raise_for_status()
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = await client.post("/share/generate-token", headers=headers)
+    response.raise_for_status()
+    share_token = response.json()["access_token"]
+    response = await client.get("/records/", params={"limit": 50}, headers=headers)
+    response.raise_for_status()
+    return {"email": email, "headers": headers, "share_token": share_token, "records_etag": response.headers["ETag"]}
+
+async def measure(client: httpx.AsyncClient, scenario: Scenario, users: List[dict], concurrency: int, requests: int, rnd: random.Random) -> dict:
+    """Гоняет `requests` запросов в `concurrency` параллельных потоков; пользователи выбираются случайно."""
+    latencies, errors, remaining = [], 0, requests
+    async def worker():
+        nonlocal errors, remaining
+        while remaining > 0:
+            remaining -= 1
+            user = rnd.choice(users)
+            started = time.perf_counter()
+            response = await scenario.request(client, user)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400: errors += 1
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies), "errors": errors, "rps": round(len(latencies) / elapsed, 1),
+        **{f"p{q}_ms": round(percentile(latencies, q / 100) * 1000, 2) for q in (50, 95, 99)},
+    }
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Регрессии относительно baseline: ошибки, рост p95 и падение rps больше допуска."""
+    regressions = []
+    for key, current in results.items():
+        if current["errors"]: regressions.append(f"{key}: {current['errors']} ошибочных ответов")
+        base = baseline.get(key)
+        if base is None: continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {current['p95_ms']} мс против {base['p95_ms']} мс в baseline")
+        if current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{key}: {current['rps']} запр/с против {base['rps']} в baseline")
+    return regressions
+
+def _meta(args: argparse.Namespace) -> dict:
+    """Условия прогона: сравнивать имеет смысл только прогоны с одинаковыми условиями."""
+    return {
+        "scale": vars(datagen.scale_from_args(args)), "seed": args.seed, "requests": args.requests,
+        "transport": "http" if args.url else "asgi", "database": engine.url.get_backend_name(),
+    }
+
+async def run(args: argparse.Namespace) -> Dict[str, dict]:
+    print(f"БД: {engine.url.render_as_string(hide_password=True)}")
+    started = time.perf_counter()
+    created = await asyncio.to_thread(datagen.generate, engine, datagen.scale_from_args(args), args.seed)
+    print(f"Данные готовы: новых пользователей {created} ({time.perf_counter() - started:.1f} с)")
+    async with AsyncExitStack() as stack:
+        if args.url:
+            limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+            client = await stack.enter_async_context(httpx.AsyncClient(base_url=args.url, limits=limits, timeout=None))
+        else:
+            from app.main import app
+            await stack.enter_async_context(app.router.lifespan_context(app)) # Как при запуске сервера: фоновые воркеры, индекс МКБ
+            client = await stack.enter_async_context(httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None))
+        rnd = random.Random(args.seed)
+        sample = rnd.sample(range(args.users), min(args.sample_users, args.users))
+        users = [await _login(client, datagen.email(n)) for n in sample]
+        results = {}
+        print(f"{'сценарий':<28} {'парал.':>6} {'запр/с':>9} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'ошибок':>7}")
+        for name in args.scenarios:
+            scenario = SCENARIOS[name]
+            for concurrency in args.concurrency:
+                await measure(client, scenario, users, concurrency, min(args.warmup, args.requests), rnd) # Прогрев: кэши, пул соединений
+                result = await measure(client, scenario, users, concurrency, args.requests, rnd)
+                results[f"{name}@{concurrency}"] = result
+                print(f"{scenario.name:<28} {concurrency:>6} {result['rps']:>9} {result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9} {result['errors']:>7}", flush=True)
+    return results
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.endpoints", description="Задержка и пропускная способность эндпоинтов MedData.KZ")
+    datagen.add_scale_arguments(parser)
+    parser.add_argument("--url", help="Базовый URL запущенного сервера; без него приложение гоняется в процессе")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=300, help="Запросов на сценарий и уровень параллельности")
+    parser.add_argument("--warmup", type=int, default=30)
+    parser.add_argument("--sample-users", type=int, default=20, help="Сколько пользователей участвуют в запросах")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Записать результаты как новый baseline вместо сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Допустимое ухудшение p95 и запр/с, доля (0.3 = 30%%)")
+    args = parser.parse_args(argv)
+    try: results = asyncio.run(run(args))
+    finally: shutil.rmtree(_tmpdir, ignore_errors=True)
+    meta = _meta(args)
+    if args.save_baseline:
+        meta.update(python=platform.python_version(), machine=platform.machine())
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({"meta": meta, "results": results}, file, ensure_ascii=False, indent=2); file.write("\n")
+        print(f"baseline сохранен: {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"baseline {args.baseline} не найден — сравнивать не с чем (снимите его с --save-baseline)")
+        return
+    with open(args.baseline, encoding="utf-8") as file: baseline = json.load(file)
+    mismatched = {key: (baseline["meta"].get(key), value) for key, value in meta.items() if baseline["meta"].get(key) != value}
+    if mismatched:
+        sys.exit(f"baseline снят в других условиях ({mismatched}); запустите с теми же параметрами или переснимите его")
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print("Регрессии:"); print("\n".join(f"  {line}" for line in regressions))
+        sys.exit(1)
+    print(f"Регрессий нет (допуск {args.tolerance:.0%})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# backend/benchmarks/list_serialization.py
+
+# Сравнение быстрого пути списков (колонки + fastjson) с прежним (ORM-объекты + response_model)
+# на лентах замеров и записей. Запуск из каталога backend:
+#     python -m benchmarks.list_serialization [--rows 10000 100000] [--repeat 3]
+# По умолчанию работает на временной SQLite; другую БД (например, пустой Postgres) можно задать
+# через BENCH_DATABASE_URL — таблицы будут созданы, а тестовый пользователь с данными добавлен в нее.
+
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+_tmpdir = tempfile.mkdtemp(prefix="meddata-bench-")
+os.environ["DATABASE_URL"] = os.environ.get("BENCH_DATABASE_URL", f"sqlite:///{_tmpdir}/bench.sqlite")
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+import httpx
+from fastapi import Depends, Response
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, fastjson, models, schemas, security
+from app.database import engine, get_async_db
+from app.main import _paginate, app
+
+# Прежние версии эндпоинтов — для сравнения на тех же данных и том же стеке FastAPI
+@app.get("/bench/orm/vitals/", response_model=List[schemas.VitalsRecord])
+async def _orm_vitals(response: Response, limit: Optional[int] = None, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await _paginate(response, lambda **page: crud.get_vitals_by_user(db=db, user_id=current_user.id, **page), "timestamp", limit, None, None)
+
+@app.get("/bench/orm/records/", response_model=List[schemas.RecordForTimeline])
+async def _orm_records(response: Response, limit: Optional[int] = None, db: AsyncSession = Depends(get_async_db), current_user: models.User = Depends(security.get_current_active_user)):
+    return await _paginate(response, lambda **page: crud.get_records_by_owner(db=db, owner_id=current_user.id, **page), "date", limit, None, None)
+
+def _seed(rows: int) -> str:
+    """Новый пользователь с `rows` замерами и `rows` записями; возвращает его email."""
+    email = f"bench-{rows}-{time.time_ns()}@example.com"
+    start = datetime(2015, 1, 1)
+    with engine.begin() as conn:
+        user_id = conn.execute(insert(models.User).values(email=email, hashed_password="-", is_active=True)).inserted_primary_key[0]
+        for offset in range(0, rows, 10000):
+            batch = range(offset, min(offset + 10000, rows))
+            conn.execute(insert(models.VitalsRecord), [
+                {"owner_id": user_id, "type": ("pulse", "weight", "glucose")[i % 3], "value": 60 + i % 40 + 0.5, "unit": "ед", "timestamp": start + timedelta(minutes=37 * i)}
+                for i in batch
+            ])
+            conn.execute(insert(models.Record), [
+                {"owner_id": user_id, "date": start + timedelta(hours=5 * i), "resource_type": "Encounter", "doctor_name": f"Врач {i % 50}",
+                 "clinic_name": "Городская поликлиника №1", "conclusion_text": "Состояние удовлетворительное, рекомендовано наблюдение." * 2,
+                 "diagnosis_code": "I10", "result": f"{i % 9}.{i % 10} ммоль/л"}
+                for i in batch
+            ])
+    return email
+
+async def _time(client: httpx.AsyncClient, path: str, headers: dict, repeat: int) -> tuple:
+    timings, size = [], 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        timings.append(time.perf_counter() - started)
+        response.raise_for_status(); size = len(response.content)
+    return statistics.median(timings), size
+
+async def run(row_counts: List[int], repeat: int) -> None:
+    models.Base.metadata.create_all(bind=engine)
+    print(f"БД: {engine.url.render_as_string(hide_password=True)}; JSON: {'orjson' if fastjson.orjson else 'stdlib json'}")
+    print(f"{'строк':>8} {'лента':<8} {'ORM+Pydantic, с':>16} {'быстрый путь, с':>16} {'ускорение':>10} {'ответ, МБ':>10}")
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for rows in row_counts:
+            email = _seed(rows)
+            headers = {"Authorization": f"Bearer {security.create_access_token({'sub': email})}"}
+            for name, fast_path, orm_path in (("vitals", "/vitals/", "/bench/orm/vitals/"), ("records", "/records/", "/bench/orm/records/")):
+                await client.get(fast_path, headers=headers) # Прогрев: кэш пользователя, план запроса
+                orm, orm_size = await _time(client, orm_path, headers, repeat)
+                fast, fast_size = await _time(client, fast_path, headers, repeat)
+                assert orm_size == fast_size, f"{name}: ответы разного размера ({orm_size} и {fast_size})"
+                print(f"{rows:>8} {name:<8} {orm:>16.3f} {fast:>16.3f} {orm / fast:>9.1f}x {fast_size / 1e6:>10.1f}")
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.list_serialization")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    try: asyncio.run(run(args.rows, args.repeat))
+    finally: shutil.rmtree(_tmpdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 // frontend/src/components/CoursesPage.tsx
 import React, { useState, useEffect } from 'react';
-import { TreatmentCourse, Record, Complaint } from '../types';
+import { TreatmentCourse, TreatmentCourseSummary } from '../types';
 import styles from './CoursesPage.module.css';
 
 // Вспомогательный компонент для отображения детализации
@@ -29,8 +29,10 @@ const CourseDetails = ({ course }: { course: TreatmentCourse }) => (
 );
 
 export const CoursesPage: React.FC<{ token: string }> = ({ token }) => {
-    const [courses, setCourses] = useState<TreatmentCourse[]>([]);
-    const [selectedCourse, setSelectedCourse] = useState<TreatmentCourse | null>(null);
+    const [courses, setCourses] = useState<TreatmentCourseSummary[]>([]);
+    const [selectedCourse, setSelectedCourse] = useState<TreatmentCourseSummary | null>(null);
+    // Записи и жалобы грузятся только для выбранного курса
+    const [courseDetails, setCourseDetails] = useState<TreatmentCourse | null>(null);
     const [loading, setLoading] = useState(true);
     
     // Состояния для формы
@@ -40,7 +42,7 @@ export const CoursesPage: React.FC<{ token: string }> = ({ token }) => {
     const fetchCourses = async () => {
         try {
             setLoading(true);
-            const response = await fetch('http://127.0.0.1:8000/courses/', {
+            const response = await fetch('http://127.0.0.1:8000/courses/summary', {
                 headers: { 'Authorization': `Bearer ${token}` }
             });
             if (response.ok) {
@@ -54,6 +56,17 @@ export const CoursesPage: React.FC<{ token: string }> = ({ token }) => {
         if(token) fetchCourses();
     }, [token]);
 
+    const selectCourse = async (course: TreatmentCourseSummary) => {
+        setSelectedCourse(course);
+        setCourseDetails(null);
+        try {
+            const response = await fetch(`http://127.0.0.1:8000/courses/${course.id}`, {
+                headers: { 'Authorization': `Bearer ${token}` }
+            });
+            if (response.ok) setCourseDetails(await response.json());
+        } catch(e) { console.error(e); }
+    };
+
     const handleSubmit = async (e: React.FormEvent) => {
         e.preventDefault();
         try {
@@ -110,9 +123,10 @@ export const CoursesPage: React.FC<{ token: string }> = ({ token }) => {
                     </form>
                     <ul className={styles.courseList}>
                         {courses.map(c => (
-                            <li key={c.id} className={`${styles.courseItem} ${selectedCourse?.id === c.id ? styles.active : ''}`} onClick={() => setSelectedCourse(c)}>
+                            <li key={c.id} className={`${styles.courseItem} ${selectedCourse?.id === c.id ? styles.active : ''}`} onClick={() => selectCourse(c)}>
                                 <p className={styles.courseName}>{c.name}</p>
                                 <p className={styles.courseMeta}>Статус: {c.status} | Начало: {c.start_date ? new Date(c.start_date).toLocaleDateString('ru-RU') : '—'}</p>
+                                <p className={styles.courseMeta}>Записей: {c.records_count} | Жалоб: {c.complaints_count}{c.last_activity_at ? ` | Активность: ${new Date(c.last_activity_at).toLocaleDateString('ru-RU')}` : ''}</p>
                             </li>
                         ))}
                     </ul>
@@ -120,7 +134,7 @@ export const CoursesPage: React.FC<{ token: string }> = ({ token }) => {
                 <div className={styles.card}>
                     <h3>Детали курса: {selectedCourse ? `"${selectedCourse.name}"` : ''}</h3>
                     {selectedCourse ? (
-                        <CourseDetails course={selectedCourse} />
+                        courseDetails?.id === selectedCourse.id ? <CourseDetails course={courseDetails} /> : <p>Загрузка...</p>
                     ) : (
                         <p>Выберите курс из списка слева, чтобы увидеть его детали, включая связанные записи и жалобы.</p>
                     )}
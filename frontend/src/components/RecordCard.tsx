@@ -1,6 +1,6 @@
 // frontend/src/components/RecordCard.tsx
 
-import React from 'react';
+import React, { useEffect, useState } from 'react';
 import { Record } from '../types';
 import styles from './RecordCard.module.css';
 
@@ -21,12 +21,39 @@ const RecordIcon = ({ type }: { type: string }) => {
   return <div className={styles.icon}>{iconSVG}</div>;
 };
 
+// Токены на скачивание вложений: сервер выдает их на 5-10 минут, поэтому держим не дольше 4 минут.
+// Пока токен тот же, тот же и URL — браузер берет превью и файл из своего кэша
+const ATTACHMENT_TOKEN_TTL_MS = 4 * 60 * 1000;
+const attachmentTokens = new Map<number, { token: string; expiresAt: number }>();
+
+const fetchAttachmentToken = async (recordId: number, token: string): Promise<string> => {
+  const cached = attachmentTokens.get(recordId);
+  if (cached && cached.expiresAt > Date.now()) return cached.token;
+  const response = await fetch(`http://127.0.0.1:8000/records/${recordId}/attachment-token`, { method: 'POST', headers: { 'Authorization': `Bearer ${token}` } });
+  if (!response.ok) throw new Error('Не удалось получить доступ к вложению');
+  const data = await response.json();
+  attachmentTokens.set(recordId, { token: data.access_token, expiresAt: Date.now() + ATTACHMENT_TOKEN_TTL_MS });
+  return data.access_token;
+};
+
 // 2. Убеждаемся, что компонент принимает все свойства
 export const RecordCard: React.FC<RecordCardProps> = ({ record, onEdit, onDelete, token, onCreateReminder }) => {
-  
-  const attachmentFullUrl = record.attachment_url 
-      ? `http://127.0.0.1:8000${record.attachment_url}` 
-      : null;
+  const [attachmentToken, setAttachmentToken] = useState<string | null>(null);
+
+  useEffect(() => {
+    if (!record.attachment_url) return;
+    let cancelled = false;
+    fetchAttachmentToken(record.id, token)
+      .then(value => { if (!cancelled) setAttachmentToken(value); })
+      .catch(error => console.error(error));
+    return () => { cancelled = true; };
+  }, [record.id, record.attachment_url, token]);
+
+  // Ссылка и <img> не шлют заголовок Authorization, поэтому в параметре идет токен на файлы только этой записи
+  const attachmentBaseUrl = attachmentToken ? `http://127.0.0.1:8000/records/${record.id}/attachment?access_token=${encodeURIComponent(attachmentToken)}` : null;
+  const attachmentFullUrl = record.attachment_url ? attachmentBaseUrl : null;
+  // В ленте показываем только превью на несколько КБ, оригинал открывается по ссылке
+  const thumbnailFullUrl = record.thumbnail_url && attachmentBaseUrl ? `${attachmentBaseUrl}&variant=thumbnail` : null;
 
   const handleDeleteClick = () => {
     if (window.confirm('Вы уверены, что хотите удалить эту запись? Это действие необратимо.')) {
@@ -82,6 +109,11 @@ export const RecordCard: React.FC<RecordCardProps> = ({ record, onEdit, onDelete
               <a href={attachmentFullUrl} target="_blank" rel="noopener noreferrer" style={{color: 'var(--primary-color)', fontWeight: '600'}}>
                 Посмотреть файл
               </a>
+              {thumbnailFullUrl && (
+                <a href={attachmentFullUrl} target="_blank" rel="noopener noreferrer" style={{display: 'block', marginTop: '0.5rem'}}>
+                  <img src={thumbnailFullUrl} alt="Превью вложения" loading="lazy" referrerPolicy="no-referrer" style={{maxWidth: '160px', maxHeight: '160px', borderRadius: '8px'}} />
+                </a>
+              )}
             </p>
           )}
         </div>
@@ -1,7 +1,7 @@
 // frontend/src/components/RecordForm.tsx
 
 import React, { useState, useEffect } from 'react';
-import { Record as RecordData, RecordCreate, ChronicDisease, TreatmentCourse } from '../types';
+import { Record as RecordData, RecordCreate, ChronicDisease, TreatmentCourseSummary } from '../types';
 import styles from './RecordForm.module.css';
 
 interface RecordFormProps {
@@ -37,7 +37,7 @@ export const RecordForm: React.FC<RecordFormProps> = ({ onClose, onRecordAdded,
   // Состояния для поиска и курсов
   const [diagnosisQuery, setDiagnosisQuery] = useState('');
   const [icdResults, setIcdResults] = useState<ChronicDisease[]>([]);
-  const [courses, setCourses] = useState<TreatmentCourse[]>([]);
+  const [courses, setCourses] = useState<TreatmentCourseSummary[]>([]);
   const [selectedCourseId, setSelectedCourseId] = useState<number | null>(null);
 
   // Заполняем форму данными при редактировании
@@ -65,7 +65,7 @@ export const RecordForm: React.FC<RecordFormProps> = ({ onClose, onRecordAdded,
     const fetchCourses = async () => {
         if (token) {
             try {
-                const response = await fetch('http://127.0.0.1:8000/courses/', {
+                const response = await fetch('http://127.0.0.1:8000/courses/summary', {
                     headers: { 'Authorization': `Bearer ${token}` }
                 });
                 if (response.ok) {
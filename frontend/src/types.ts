@@ -69,6 +69,7 @@ export interface Record {
   diagnosis_code?: string;
   medication_name?: string;
   attachment_url?: string;
+  thumbnail_url?: string; // Легкое превью вложения (появляется после фоновой обработки)
   lab_name?: string;
   test_name?: string;
   result?: string;
@@ -113,4 +114,18 @@ export interface TreatmentCourse {
   status: string;
   records: Record[];
   complaints: Complaint[];
+}
+
+// Курс в списке: счетчики и даты вместо записей и жалоб (GET /courses/summary)
+export interface TreatmentCourseSummary {
+  id: number;
+  owner_id: number;
+  name: string;
+  start_date?: string;
+  status: string;
+  records_count: number;
+  complaints_count: number;
+  first_record_date?: string;
+  last_record_date?: string;
+  last_activity_at?: string;
 }
\ No newline at end of file